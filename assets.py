@@ -0,0 +1,167 @@
+# vim: set fileencoding=utf-8
+import asyncio
+import gzip
+import hashlib
+import mimetypes
+import os
+import time
+
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+try:
+    import brotli  # type: ignore
+except ImportError:
+    brotli = None
+
+
+class Asset(NamedTuple):
+    path: str
+    etag: str
+    media_type: str
+    encodings: Dict[str, bytes]
+    mtime: float
+
+
+class AssetPipeline:
+    """
+    Fingerprints every file under the plugin's static folder once, so the
+    webui can hand out long-lived cache headers and ETags and answer repeat
+    requests with a 304. Text assets are also precompressed with gzip, and
+    with brotli when it is installed, so they are never compressed per request.
+    An asset whose file changes on disk is fingerprinted again, at most one
+    stat per asset per CHECK_INTERVAL, and generation counts those changes.
+    Names that don't exist are remembered for as long, so pages asking for
+    images that were never dumped don't hit the disk every time. Request
+    handlers call ready() first, which fingerprints everything on a worker
+    thread rather than on the event loop.
+    """
+
+    COMPRESSIBLE = ['.json', '.css', '.js', '.html', '.svg']
+    CHECK_INTERVAL = 5.0
+    MISSING_SIZE = 65536
+
+    def __init__(self, root: str) -> None:
+        self.root = root
+        self.generation = 0
+        self.__assets: Optional[Dict[str, Asset]] = None
+        self.__checked: Dict[str, float] = {}
+        self.__missing: Dict[str, float] = {}
+        self.__building: Optional[asyncio.Future] = None
+
+    def __fingerprint(self, path: str) -> Asset:
+        mtime = os.stat(path).st_mtime
+        with open(path, 'rb') as fp:
+            content = fp.read()
+
+        encodings: Dict[str, bytes] = {}
+        if os.path.splitext(path)[1].lower() in self.COMPRESSIBLE:
+            encodings['identity'] = content
+            encodings['gzip'] = gzip.compress(content, compresslevel=9)
+            if brotli is not None:
+                encodings['br'] = brotli.compress(content)
+
+        return Asset(
+            path,
+            hashlib.sha256(content).hexdigest()[:16],
+            mimetypes.guess_type(path)[0] or 'application/octet-stream',
+            encodings,
+            mtime,
+        )
+
+    def build(self) -> None:
+        assets: Dict[str, Asset] = {}
+        now = time.monotonic()
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                assets[os.path.relpath(path, self.root).replace(os.sep, '/')] = self.__fingerprint(path)
+        self.__checked = {name: now for name in assets}
+        self.__missing = {}
+        self.__assets = assets
+        self.generation = self.generation + 1
+
+    async def ready(self) -> None:
+        """
+        Make sure every asset is fingerprinted, without holding up the event loop.
+        """
+        if self.__assets is not None:
+            return
+        if self.__building is None:
+            self.__building = asyncio.get_running_loop().run_in_executor(None, self.build)
+        try:
+            await asyncio.shield(self.__building)
+        finally:
+            if self.__building is not None and self.__building.done():
+                # Tried again by the next request if it failed
+                self.__building = None
+
+    def __refresh(self, name: str, asset: Asset) -> Optional[Asset]:
+        now = time.monotonic()
+        if (now - self.__checked.get(name, 0.0)) < self.CHECK_INTERVAL:
+            return asset
+        self.__checked[name] = now
+
+        try:
+            mtime = os.stat(asset.path).st_mtime
+        except FileNotFoundError:
+            del self.__assets[name]
+            del self.__checked[name]
+            self.generation = self.generation + 1
+            return None
+        if mtime == asset.mtime:
+            return asset
+
+        asset = self.__fingerprint(asset.path)
+        self.__assets[name] = asset
+        self.generation = self.generation + 1
+        return asset
+
+    def get(self, name: str) -> Optional[Asset]:
+        if self.__assets is None:
+            self.build()
+        asset = self.__assets.get(name)
+        if asset is not None:
+            return self.__refresh(name, asset)
+
+        now = time.monotonic()
+        missing = self.__missing.get(name)
+        if missing is not None and (now - missing) < self.CHECK_INTERVAL:
+            return None
+
+        # Images may be dumped after startup, pick them up as they are asked for
+        path = os.path.realpath(os.path.join(self.root, name))
+        if not path.startswith(os.path.realpath(self.root) + os.sep) or not os.path.isfile(path):
+            if len(self.__missing) >= self.MISSING_SIZE:
+                self.__missing.clear()
+            self.__missing[name] = now
+            return None
+        self.__missing.pop(name, None)
+        asset = self.__fingerprint(path)
+        self.__assets[name] = asset
+        self.__checked[name] = now
+        self.generation = self.generation + 1
+        return asset
+
+    def url(self, name: str) -> str:
+        """
+        Return a fingerprinted URL for an asset, suitable for caching forever.
+        """
+        asset = self.get(name)
+        if asset is None:
+            return f'/static/plugin/iidx/{name}'
+        return f'/plugin/iidx/asset?name={name}&v={asset.etag}'
+
+    def read(self, asset: Asset, accept_encoding: str) -> Tuple[str, bytes]:
+        """
+        Return the best encoding the client accepts, along with the content.
+        """
+        accepted: List[str] = [
+            encoding.split(';')[0].strip() for encoding in accept_encoding.split(',')
+        ]
+        for encoding in ['br', 'gzip']:
+            if encoding in accepted and encoding in asset.encodings:
+                return encoding, asset.encodings[encoding]
+        if 'identity' in asset.encodings:
+            return 'identity', asset.encodings['identity']
+        with open(asset.path, 'rb') as fp:
+            return 'identity', fp.read()
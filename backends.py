@@ -0,0 +1,615 @@
+# vim: set fileencoding=utf-8
+import argparse
+import asyncio
+import atexit
+import contextlib
+import hashlib
+import hmac
+import json
+import os
+import pickle
+import random
+import struct
+import sys
+import tempfile
+import time
+
+from collections import OrderedDict
+from multiprocessing import resource_tracker, shared_memory
+from typing import Any, Callable, Dict, Generic, Hashable, IO, Iterable, Iterator, List, Optional, Tuple, TypeVar
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+T = TypeVar('T')
+
+
+class CacheBackend(Generic[T]):
+    """
+    What every cache backend shared between worker processes provides. get()
+    returns None for anything missing or older than the cache's ttl, put()
+    overwrites, and invalidate() and clear() are seen by every process sharing
+    the backend by the time they return. Backends may have to talk to another
+    process, so everything but stats() is a coroutine.
+    """
+
+    async def get(self, key: Hashable) -> Optional[T]:
+        raise Exception('Implement in specific cache backend!')
+
+    async def get_many(self, keys: Iterable[Hashable]) -> Dict[Hashable, T]:
+        """
+        Return the values found for any of the given keys, by key.
+        """
+        found: Dict[Hashable, T] = {}
+        for key in keys:
+            value = await self.get(key)
+            if value is not None:
+                found[key] = value
+        return found
+
+    async def put(self, key: Hashable, value: T) -> None:
+        raise Exception('Implement in specific cache backend!')
+
+    async def invalidate(self, key: Hashable) -> None:
+        raise Exception('Implement in specific cache backend!')
+
+    async def clear(self) -> None:
+        raise Exception('Implement in specific cache backend!')
+
+    def stats(self) -> Dict[str, Any]:
+        raise Exception('Implement in specific cache backend!')
+
+
+class LazyCache(CacheBackend[T]):
+    """
+    Creates the real backend the first time the cache is used rather than
+    when it is declared, so importing a module that declares a cache never
+    attaches shared memory or opens lock files in processes that never use it.
+    """
+
+    def __init__(self, create: Callable[[], CacheBackend[T]]) -> None:
+        self.__create = create
+        self.__backend: Optional[CacheBackend[T]] = None
+
+    @property
+    def backend(self) -> CacheBackend[T]:
+        if self.__backend is None:
+            self.__backend = self.__create()
+        return self.__backend
+
+    async def get(self, key: Hashable) -> Optional[T]:
+        return await self.backend.get(key)
+
+    async def get_many(self, keys: Iterable[Hashable]) -> Dict[Hashable, T]:
+        return await self.backend.get_many(keys)
+
+    async def put(self, key: Hashable, value: T) -> None:
+        await self.backend.put(key, value)
+
+    async def invalidate(self, key: Hashable) -> None:
+        if self.__backend is not None:
+            await self.__backend.invalidate(key)
+
+    async def clear(self) -> None:
+        if self.__backend is not None:
+            await self.__backend.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        if self.__backend is None:
+            return {'backend': 'unused', 'hits': 0, 'misses': 0}
+        return self.__backend.stats()
+
+
+def key_bytes(namespace: str, key: Hashable) -> bytes:
+    """
+    Stable encoding of a cache key for backends shared between processes,
+    where Python's own hash() differs per process. Keys are expected to be
+    made of strings, numbers and tuples of those.
+    """
+    return f'{namespace}:{key!r}'.encode('utf-8')
+
+
+class SharedMemoryCache(CacheBackend[Tuple[Any, ...]]):
+    """
+    Fixed-width records in a shared memory block that every worker on the host
+    attaches to, for small hot aggregates. The block is a hash table of slots
+    probed linearly. Readers take no lock and retry if a slot's sequence
+    number shows a write in progress, writers serialise on a lock file.
+    Values are tuples packed with the given struct format. The block counts
+    the workers attached to it and the last one to exit unlinks it, blocks
+    left behind by workers that crashed are removed with --unlink-shm.
+    """
+
+    PREFIX = 'iidx_'
+    PROBES = 8
+    BLOCK_HEADER = struct.Struct('<I')
+    SLOT_HEADER = struct.Struct('<IQd')
+
+    def __init__(self, namespace: str, slots: int, record: str, ttl: Optional[float] = None) -> None:
+        self.namespace = namespace
+        self.slots = slots
+        self.record = struct.Struct(record)
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.slot_size = self.SLOT_HEADER.size + self.record.size
+
+        # The layout is part of the name, so a changed format never reads an old block
+        layout = hashlib.sha1(f'{slots}:{record}:attached'.encode('utf-8')).hexdigest()[:8]
+        name = f'{self.PREFIX}{namespace}_{layout}'
+        self.__lockpath = os.path.join(tempfile.gettempdir(), f'{name}.lock')
+        self.__lockfile: Optional[IO[str]] = None
+
+        # Attaching and detaching share the lock with writers, so the last
+        # worker never unlinks a block that another one is just attaching to
+        with self.__locked():
+            try:
+                self.__shm = shared_memory.SharedMemory(
+                    name=name,
+                    create=True,
+                    size=self.BLOCK_HEADER.size + slots * self.slot_size,
+                )
+            except FileExistsError:
+                self.__shm = shared_memory.SharedMemory(name=name)
+            # Outlive whichever worker happened to create the block, it is
+            # unlinked by the last worker to detach instead
+            resource_tracker.unregister(self.__shm._name, 'shared_memory')
+            self.__attach(1)
+        self.__closed = False
+        atexit.register(self.close)
+
+    def __attach(self, delta: int) -> int:
+        attached = max(0, self.BLOCK_HEADER.unpack_from(self.__shm.buf, 0)[0] + delta)
+        self.BLOCK_HEADER.pack_into(self.__shm.buf, 0, attached)
+        return attached
+
+    def __hash(self, key: Hashable) -> int:
+        digest = hashlib.blake2b(key_bytes(self.namespace, key), digest_size=8).digest()
+        # Zero marks an empty slot
+        return int.from_bytes(digest, 'little') | 1
+
+    def __offset(self, slot: int) -> int:
+        return self.BLOCK_HEADER.size + slot * self.slot_size
+
+    def __read(self, slot: int) -> Tuple[int, float, Optional[Tuple[Any, ...]]]:
+        buf = self.__shm.buf
+        offset = self.__offset(slot)
+        for _ in range(4):
+            seq, keyhash, stored = self.SLOT_HEADER.unpack_from(buf, offset)
+            if seq & 1:
+                continue
+            record = self.record.unpack_from(buf, offset + self.SLOT_HEADER.size)
+            if self.SLOT_HEADER.unpack_from(buf, offset)[0] == seq:
+                return keyhash, stored, record
+        # Kept being written to while we looked, treat as a miss
+        return 0, 0.0, None
+
+    def __write(self, slot: int, keyhash: int, stored: float, record: Optional[Tuple[Any, ...]]) -> None:
+        buf = self.__shm.buf
+        offset = self.__offset(slot)
+        seq = self.SLOT_HEADER.unpack_from(buf, offset)[0]
+        self.SLOT_HEADER.pack_into(buf, offset, seq + 1, keyhash, stored)
+        if record is not None:
+            self.record.pack_into(buf, offset + self.SLOT_HEADER.size, *record)
+        self.SLOT_HEADER.pack_into(buf, offset, (seq + 2) & 0xFFFFFFFF, keyhash, stored)
+
+    @contextlib.contextmanager
+    def __locked(self) -> Iterator[None]:
+        if self.__lockfile is None:
+            self.__lockfile = open(self.__lockpath, 'a')
+        if fcntl is not None:
+            fcntl.flock(self.__lockfile, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(self.__lockfile, fcntl.LOCK_UN)
+
+    def __probe(self, keyhash: int) -> range:
+        return range(keyhash % self.slots, (keyhash % self.slots) + self.PROBES)
+
+    async def get(self, key: Hashable) -> Optional[Tuple[Any, ...]]:
+        keyhash = self.__hash(key)
+        for slot in self.__probe(keyhash):
+            slothash, stored, record = self.__read(slot % self.slots)
+            if slothash != keyhash:
+                continue
+            if self.ttl is not None and (time.time() - stored) > self.ttl:
+                break
+            self.hits = self.hits + 1
+            return record
+        self.misses = self.misses + 1
+        return None
+
+    async def put(self, key: Hashable, value: Tuple[Any, ...]) -> None:
+        keyhash = self.__hash(key)
+        now = time.time()
+        with self.__locked():
+            victim = None
+            oldest = None
+            for slot in self.__probe(keyhash):
+                slot = slot % self.slots
+                slothash, stored, _ = self.__read(slot)
+                if slothash == keyhash or slothash == 0:
+                    victim = slot
+                    break
+                if oldest is None or stored < oldest:
+                    victim = slot
+                    oldest = stored
+            self.__write(victim, keyhash, now, value)
+
+    async def invalidate(self, key: Hashable) -> None:
+        keyhash = self.__hash(key)
+        with self.__locked():
+            for slot in self.__probe(keyhash):
+                slot = slot % self.slots
+                if self.__read(slot)[0] == keyhash:
+                    self.__write(slot, 0, 0.0, None)
+
+    async def clear(self) -> None:
+        with self.__locked():
+            for slot in range(self.slots):
+                self.__write(slot, 0, 0.0, None)
+
+    def close(self) -> None:
+        """
+        Detach from the block, unlinking it if no other worker is attached.
+        Called on exit.
+        """
+        if self.__closed:
+            return
+        self.__closed = True
+        with self.__locked():
+            if self.__attach(-1) == 0:
+                # unlink() also tells the resource tracker, which must know the block
+                resource_tracker.register(self.__shm._name, 'shared_memory')
+                self.__shm.unlink()
+            self.__shm.close()
+
+    @classmethod
+    def unlink_all(cls) -> List[str]:
+        """
+        Remove every block left in /dev/shm, for when workers crashed without
+        detaching. Only run this while no worker is running.
+        """
+        removed = []
+        shmdir = '/dev/shm'
+        if not os.path.isdir(shmdir):
+            return removed
+        for name in sorted(os.listdir(shmdir)):
+            if not name.startswith(cls.PREFIX):
+                continue
+            os.unlink(os.path.join(shmdir, name))
+            removed.append(name)
+        return removed
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'backend': 'shm',
+            'maxsize': self.slots,
+            'attached': self.BLOCK_HEADER.unpack_from(self.__shm.buf, 0)[0] if not self.__closed else 0,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+class SocketCache(CacheBackend[T]):
+    """
+    Client for CacheServer, a stand-in for a shared cache server such as
+    memcached that every worker talks to over localhost, on one connection
+    per worker opened with asyncio so a slow server never blocks the event
+    loop. Values are pickled on the client and signed with IIDX_CACHE_SECRET,
+    which has to be set, and anything that fails the signature is a miss, so
+    only a holder of the secret can make a worker unpickle something. The
+    server only ever sees opaque bytes. If the server can't be reached the
+    cache simply misses, and reconnecting is retried after RETRY seconds.
+    """
+
+    TIMEOUT = 0.25
+    RETRY = 5.0
+
+    def __init__(self, namespace: str, address: Tuple[str, int], ttl: Optional[float] = None) -> None:
+        self.namespace = namespace
+        self.address = address
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        self.__secret = os.environ.get('IIDX_CACHE_SECRET', '').encode('utf-8')
+        if not self.__secret:
+            raise Exception('Set IIDX_CACHE_SECRET to use the socket cache backend!')
+        self.__reader: Optional[asyncio.StreamReader] = None
+        self.__writer: Optional[asyncio.StreamWriter] = None
+        self.__lock: Optional[asyncio.Lock] = None
+        self.__down_until = 0.0
+
+    def __disconnect(self) -> None:
+        if self.__writer is not None:
+            self.__writer.close()
+        self.__reader = None
+        self.__writer = None
+
+    def close(self) -> None:
+        self.__disconnect()
+
+    async def __exchange(self, request: Dict[str, Any], payload: bytes) -> Tuple[Dict[str, Any], bytes]:
+        if self.__writer is None:
+            self.__reader, self.__writer = await asyncio.open_connection(*self.address)
+        write_frame(self.__writer, request, payload)
+        await self.__writer.drain()
+        return await read_frame(self.__reader)
+
+    async def __call(self, request: Dict[str, Any], payload: bytes = b'') -> Tuple[Dict[str, Any], bytes]:
+        if time.monotonic() < self.__down_until:
+            raise OSError('Cache server marked down')
+        if self.__lock is None:
+            # Created on first use, from inside the running loop
+            self.__lock = asyncio.Lock()
+
+        # Requests share the connection, so one at a time
+        async with self.__lock:
+            try:
+                return await asyncio.wait_for(self.__exchange(request, payload), self.TIMEOUT)
+            except (OSError, EOFError, asyncio.TimeoutError) as exception:
+                self.__disconnect()
+                self.__down_until = time.monotonic() + self.RETRY
+                raise OSError('Cache server unavailable') from exception
+            except BaseException:
+                # Cancelled halfway through, the connection can't be trusted anymore
+                self.__disconnect()
+                raise
+
+    def __sign(self, blob: bytes) -> bytes:
+        return hmac.new(self.__secret, blob, hashlib.sha256).digest() + blob
+
+    def __verify(self, payload: bytes) -> Optional[bytes]:
+        signature, blob = payload[:32], payload[32:]
+        if not hmac.compare_digest(signature, hmac.new(self.__secret, blob, hashlib.sha256).digest()):
+            return None
+        return blob
+
+    def __key(self, key: Hashable) -> str:
+        return key_bytes(self.namespace, key).decode('utf-8')
+
+    def __load(self, payload: bytes) -> Optional[T]:
+        blob = self.__verify(payload)
+        if blob is None:
+            self.misses = self.misses + 1
+            return None
+        self.hits = self.hits + 1
+        return pickle.loads(blob)
+
+    async def get(self, key: Hashable) -> Optional[T]:
+        try:
+            response, payload = await self.__call({'op': 'get', 'key': self.__key(key)})
+        except OSError:
+            self.errors = self.errors + 1
+            self.misses = self.misses + 1
+            return None
+
+        if not response.get('found'):
+            self.misses = self.misses + 1
+            return None
+        return self.__load(payload)
+
+    async def get_many(self, keys: Iterable[Hashable]) -> Dict[Hashable, T]:
+        keys = list(keys)
+        if not keys:
+            return {}
+        try:
+            response, payload = await self.__call({'op': 'get_many', 'keys': [self.__key(key) for key in keys]})
+        except OSError:
+            self.errors = self.errors + 1
+            self.misses = self.misses + len(keys)
+            return {}
+
+        found: Dict[Hashable, T] = {}
+        offset = 0
+        for key, length in zip(keys, response.get('lengths', [])):
+            if length < 0:
+                self.misses = self.misses + 1
+                continue
+            value = self.__load(payload[offset:(offset + length)])
+            offset = offset + length
+            if value is not None:
+                found[key] = value
+        return found
+
+    async def put(self, key: Hashable, value: T) -> None:
+        try:
+            await self.__call({'op': 'put', 'key': self.__key(key), 'ttl': self.ttl}, self.__sign(pickle.dumps(value)))
+        except OSError:
+            self.errors = self.errors + 1
+
+    async def invalidate(self, key: Hashable) -> None:
+        try:
+            await self.__call({'op': 'delete', 'key': self.__key(key)})
+        except OSError:
+            self.errors = self.errors + 1
+
+    async def clear(self) -> None:
+        try:
+            await self.__call({'op': 'clear', 'prefix': f'{self.namespace}:'})
+        except OSError:
+            self.errors = self.errors + 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'backend': 'socket',
+            'hits': self.hits,
+            'misses': self.misses,
+            'errors': self.errors,
+        }
+
+
+FRAME_HEADER = struct.Struct('<II')
+
+
+def write_frame(writer: asyncio.StreamWriter, request: Dict[str, Any], payload: bytes = b'') -> None:
+    header = json.dumps(request).encode('utf-8')
+    writer.write(FRAME_HEADER.pack(len(header), len(payload)) + header + payload)
+
+
+async def read_frame(reader: asyncio.StreamReader) -> Tuple[Dict[str, Any], bytes]:
+    headerlen, payloadlen = FRAME_HEADER.unpack(await reader.readexactly(FRAME_HEADER.size))
+    return json.loads(await reader.readexactly(headerlen)), await reader.readexactly(payloadlen)
+
+
+class CacheServer:
+    """
+    Minimal shared cache server for SocketCache, keeping opaque values in one
+    LRU with per-entry expiry. Run it with python -m plugins.iidx.backends.
+    """
+
+    def __init__(self, maxsize: int = 65536) -> None:
+        self.maxsize = maxsize
+        self.__entries: 'OrderedDict[str, Tuple[Optional[float], bytes]]' = OrderedDict()
+
+    def __get(self, key: str) -> Optional[bytes]:
+        entry = self.__entries.get(key)
+        if entry is None or (entry[0] is not None and time.monotonic() > entry[0]):
+            self.__entries.pop(key, None)
+            return None
+        self.__entries.move_to_end(key)
+        return entry[1]
+
+    def handle(self, request: Dict[str, Any], payload: bytes) -> Tuple[Dict[str, Any], bytes]:
+        op = request.get('op')
+        if op == 'get':
+            value = self.__get(request['key'])
+            if value is None:
+                return {'found': False}, b''
+            return {'found': True}, value
+        if op == 'get_many':
+            values = [self.__get(key) for key in request['keys']]
+            lengths = [len(value) if value is not None else -1 for value in values]
+            return {'lengths': lengths}, b''.join(value for value in values if value is not None)
+        if op == 'put':
+            ttl = request.get('ttl')
+            self.__entries[request['key']] = (time.monotonic() + ttl if ttl is not None else None, payload)
+            self.__entries.move_to_end(request['key'])
+            while len(self.__entries) > self.maxsize:
+                self.__entries.popitem(last=False)
+            return {}, b''
+        if op == 'delete':
+            self.__entries.pop(request['key'], None)
+            return {}, b''
+        if op == 'clear':
+            for key in [key for key in self.__entries if key.startswith(request['prefix'])]:
+                del self.__entries[key]
+            return {}, b''
+        return {'error': f'Unknown op {op}'}, b''
+
+    async def __client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                request, payload = await read_frame(reader)
+                response, payload = self.handle(request, payload)
+                write_frame(writer, response, payload)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, host: str, port: int) -> asyncio.AbstractServer:
+        return await asyncio.start_server(self.__client, host, port)
+
+    async def serve(self, host: str, port: int) -> None:
+        server = await self.start(host, port)
+        async with server:
+            await server.serve_forever()
+
+
+def parse_address(address: str) -> Tuple[str, int]:
+    host, _, port = address.rpartition(':')
+    return host or '127.0.0.1', int(port)
+
+
+async def bench(cache: CacheBackend[Tuple[Any, ...]], keys: int, operations: int, writes: float) -> Dict[str, float]:
+    """
+    Replay ghost average lookups against a cache backend: mostly gets of hot
+    keys, with a share of puts as averages are refreshed. Reports throughput
+    and per operation latency percentiles.
+    """
+    rng = random.Random(0)
+    latencies: List[float] = []
+    for key in range(keys):
+        await cache.put((0, key, 0), (key, 1, 0))
+
+    start = time.perf_counter()
+    for _ in range(operations):
+        key = (0, min(int(rng.paretovariate(1.2)) - 1, keys - 1), 0)
+        begin = time.perf_counter()
+        if rng.random() < writes:
+            await cache.put(key, (rng.randrange(4000), rng.randrange(100), 0))
+        else:
+            await cache.get(key)
+        latencies.append(time.perf_counter() - begin)
+    seconds = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        'operations': operations,
+        'operations_per_second': operations / seconds,
+        'p50': latencies[len(latencies) // 2],
+        'p99': latencies[min(len(latencies) - 1, (len(latencies) * 99) // 100)],
+    }
+
+
+async def bench_all(keys: int, operations: int, writes: float) -> List[Tuple[str, Dict[str, float]]]:
+    from .cache import LocalCache
+
+    # A throwaway server and secret, so the socket backend can be measured anywhere
+    os.environ.setdefault('IIDX_CACHE_SECRET', os.urandom(16).hex())
+    server = await CacheServer(keys * 2).start('127.0.0.1', 0)
+    address = server.sockets[0].getsockname()[:2]
+
+    shm = SharedMemoryCache('bench', keys * 2, '<iII', 300.0)
+    socket = SocketCache('bench', address, 300.0)
+    results = []
+    try:
+        for name, cache in [
+            ('local', LocalCache(keys * 2, 300.0)),
+            ('shm', shm),
+            ('socket', socket),
+        ]:
+            results.append((name, await bench(cache, keys, operations, writes)))
+    finally:
+        shm.close()
+        socket.close()
+        server.close()
+        # Let the server see the connection close before the loop goes away
+        await asyncio.sleep(0.1)
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Shared cache server for IIDX_CACHE_BACKEND=socket.")
+    parser.add_argument('--address', default='127.0.0.1:47200', help="Address to listen on, localhost only.")
+    parser.add_argument('--maxsize', type=int, default=65536, help="Entries to keep before evicting.")
+    parser.add_argument('--unlink-shm', action='store_true', help="Remove shared memory blocks left by crashed workers and exit.")
+    parser.add_argument('--bench', action='store_true', help="Compare the local, shm and socket backends and exit.")
+    parser.add_argument('--keys', type=int, default=4096, help="Keys to spread benchmark operations over.")
+    parser.add_argument('--operations', type=int, default=100000, help="Benchmark operations per backend.")
+    parser.add_argument('--writes', type=float, default=0.1, help="Share of benchmark operations that are puts.")
+    args = parser.parse_args()
+    if args.unlink_shm:
+        for name in SharedMemoryCache.unlink_all():
+            print(f"removed {name}")
+        sys.exit(0)
+    if args.bench:
+        for name, result in asyncio.run(bench_all(args.keys, args.operations, args.writes)):
+            print(
+                f"{name}: {result['operations_per_second']:.0f} ops/s, "
+                f"p50 {result['p50'] * 1000000:.1f}us, p99 {result['p99'] * 1000000:.1f}us"
+            )
+        sys.exit(0)
+    asyncio.run(CacheServer(args.maxsize).serve(*parse_address(args.address)))
+
+
+if __name__ == '__main__':
+    main()
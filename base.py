@@ -1,5 +1,6 @@
 # vim: set fileencoding=utf-8
 import struct
+import time
 
 from typing import Optional, Dict, Any, List, Tuple
 
@@ -9,6 +10,14 @@ from core.common import ValidatedDict, Model, GameConstants, DBConstants, Parall
 from core.data import Data, Score, Machine, UserID
 from core.protocol import Node
 
+from .browser import score_browser
+from .cache import ghost_averages, machines
+from .convention import convention_ranking
+from .events import AttemptRecorded, DanRaised, ProfileSaved, ScoreImproved, event_bus
+from .locks import profile_locks, settings_locks
+from .metrics import metrics
+from .playcount import IIDXPlayCounts
+
 
 class IIDXBase(CoreHandler, CardManagerHandler, PASELIHandler, Base):
     """
@@ -85,12 +94,38 @@ class IIDXBase(CoreHandler, CardManagerHandler, PASELIHandler, Base):
         else:
             self.omnimix = False
 
+    async def handle(self, request: Node) -> Optional[Node]:
+        if not metrics.enabled:
+            return await super().handle(request)
+
+        # Label by the handler method, and never by whatever a client sends
+        handler = f'{request.name}_{request.attribute("method")}'
+        if not hasattr(self, f'handle_{handler}_request'):
+            handler = 'unknown'
+
+        data = self.data
+        self.data, tally = metrics.instrument(data)
+        response = None
+        failed = True
+        start = time.perf_counter()
+        try:
+            response = await super().handle(request)
+            failed = False
+            return response
+        finally:
+            self.data = data
+            metrics.record(handler, time.perf_counter() - start, tally, response, failed)
+
     @property
     def music_version(self) -> int:
         if self.omnimix:
             return DBConstants.OMNIMIX_VERSION_BUMP + self.version
         return self.version
 
+    @property
+    def play_counts(self) -> IIDXPlayCounts:
+        return IIDXPlayCounts(self.data, self.music_version, self.game)
+
     def previous_version(self) -> Optional['IIDXBase']:
         """
         Returns the previous version of the game, based on this game. Should
@@ -166,6 +201,15 @@ class IIDXBase(CoreHandler, CardManagerHandler, PASELIHandler, Base):
         profile = await self.get_profile(userid)
         return profile
 
+    async def put_profile(self, userid: UserID, profile: ValidatedDict) -> None:
+        await super().put_profile(userid, profile)
+        extid = profile.get_int('extid')
+        if extid == 0:
+            # Brand new profiles are only given an extid once they are stored
+            stored = await self.get_profile(userid)
+            extid = stored.get_int('extid') if stored is not None else 0
+        event_bus.publish(ProfileSaved(self.game, self.version, userid, profile.get('name', ''), extid))
+
     async def put_profile_by_extid(self, extid: Optional[int], request: Node) -> None:
         """
         Given an ExtID and a request node, unformat the profile and save it.
@@ -174,17 +218,53 @@ class IIDXBase(CoreHandler, CardManagerHandler, PASELIHandler, Base):
         if userid is None:
             return
 
-        oldprofile = await self.get_profile(userid)
-        newprofile = await self.unformat_profile(userid, request, oldprofile)
-        if newprofile is not None:
-            await self.put_profile(userid, newprofile)
+        async with profile_locks.hold(userid):
+            oldprofile = await self.get_profile(userid)
+            newprofile = await self.unformat_profile(userid, request, oldprofile)
+            if newprofile is None:
+                return
+
+            newprofile['settings'] = oldprofile.get('settings') or {}
+            newprofile['settings_version'] = oldprofile.get('settings_version', 0)
+            await self.put_profile_keeping_settings(userid, newprofile)
+
+    async def put_profile_keeping_settings(self, userid: UserID, profile: ValidatedDict) -> None:
+        """
+        Save a profile that the game changed, and which was read along with
+        the web UI settings and settings version it carries. The game never
+        changes those settings, so if the web UI saved newer ones since, in
+        this process or another, they are kept instead of being overwritten.
+        Expects the caller to hold the user's profile lock.
+        """
+        async with settings_locks.hold(userid):
+            current = await self.get_profile(userid)
+            if current is not None and current.get('settings_version', 0) != profile.get('settings_version', 0):
+                profile['settings'] = current.get('settings') or {}
+                profile['settings_version'] = current.get('settings_version', 0)
+            await self.put_profile(userid, profile)
 
     async def get_machine_by_id(self, shop_id: int) -> Optional[Machine]:
-        pcbid = await self.data.local.machine.from_machine_id(shop_id)
-        if pcbid is not None:
-            return self.data.local.machine.get_machine(pcbid)
-        else:
-            return None
+        return await machines.by_id(self.data, shop_id)
+
+    async def get_current_machine(self) -> Optional[Machine]:
+        """
+        Look up the machine this request came from.
+        """
+        return await machines.by_pcbid(self.data, self.config['machine']['pcbid'])
+
+    async def get_machine_id(self) -> int:
+        machine = await self.get_current_machine()
+        if machine is None:
+            return await super().get_machine_id()
+        return machine.id
+
+    async def update_machine_name(self, newname: Optional[str]) -> None:
+        await super().update_machine_name(newname)
+        await machines.invalidate(self.config['machine']['pcbid'])
+
+    async def update_machine_data(self, newdata: Dict[str, Any]) -> None:
+        await super().update_machine_data(newdata)
+        await machines.invalidate(self.config['machine']['pcbid'])
 
     async def update_score(
             self,
@@ -293,6 +373,8 @@ class IIDXBase(CoreHandler, CardManagerHandler, PASELIHandler, Base):
 
         # Look up where this score was earned
         lid = await self.get_machine_id()
+        machine = await self.get_current_machine()
+        arcade = machine.arcade if machine is not None else None
 
         if userid is not None:
             # Write the new score back
@@ -307,6 +389,20 @@ class IIDXBase(CoreHandler, CardManagerHandler, PASELIHandler, Base):
                 scoredata,
                 highscore,
             )
+            score_browser.invalidate(self.music_version, userid, songid, chart)
+            if score_raised:
+                event_bus.publish(ScoreImproved(
+                    self.game,
+                    self.music_version,
+                    userid,
+                    songid,
+                    chart,
+                    ex_score,
+                    oldscore.points if oldscore is not None else 0,
+                    scoredata.get_int('clear_status'),
+                    lid,
+                    arcade,
+                ))
 
         # Save the history of this score too
         await self.data.local.music.put_attempt(
@@ -320,6 +416,46 @@ class IIDXBase(CoreHandler, CardManagerHandler, PASELIHandler, Base):
             history,
             score_raised and miss_count_reduced,
         )
+        event_bus.publish(AttemptRecorded(
+            self.game,
+            self.music_version,
+            userid,
+            songid,
+            chart,
+            old_ex_score,
+            clear_status,
+            miss_count,
+            lid,
+            score_raised and miss_count_reduced,
+            arcade,
+        ))
+
+        if userid is not None:
+            # Keep the most played index in step with attempt history
+            await self.play_counts.record_play(userid, songid)
+
+            # Count towards the arcade's shop convention if this song is in it
+            await self.update_convention(userid, songid, chart, old_ex_score)
+
+    async def update_convention(self, userid: UserID, songid: int, chart: int, ex_score: int) -> None:
+        """
+        Given a user's play, add it to the shop convention leaderboard of the
+        arcade it was played in, if the song is part of that arcade's course.
+        """
+        machine = await self.get_current_machine()
+        if machine is None or machine.arcade is None:
+            return
+
+        await convention_ranking.record(
+            self.data,
+            self.game,
+            self.music_version,
+            machine.arcade,
+            userid,
+            songid,
+            chart,
+            ex_score,
+        )
 
     async def update_rank(
             self,
@@ -363,12 +499,17 @@ class IIDXBase(CoreHandler, CardManagerHandler, PASELIHandler, Base):
 
         if cleared:
             # Update profile if needed
-            profile = await self.get_profile(userid)
-            if profile is None:
-                profile = ValidatedDict()
+            async with profile_locks.hold(userid):
+                profile = await self.get_profile(userid)
+                if profile is None:
+                    profile = ValidatedDict()
 
-            profile.replace_int(dantype, max(rank, profile.get_int(dantype, -1)))
-            await self.put_profile(userid, profile)
+                old_rank = profile.get_int(dantype, -1)
+                profile.replace_int(dantype, max(rank, old_rank))
+                await self.put_profile_keeping_settings(userid, profile)
+
+            if rank > old_rank:
+                event_bus.publish(DanRaised(self.game, self.version, userid, dantype, rank, old_rank))
 
         # Update achievement to track pass rate
         dan_score = await self.data.local.user.get_achievement(
@@ -532,6 +673,11 @@ class IIDXBase(CoreHandler, CardManagerHandler, PASELIHandler, Base):
         return new_ex_score, struct.pack('b' * ghost_length, *delta_ghost)
 
     def user_joined_arcade(self, machine: Machine, profile: Optional[ValidatedDict]) -> bool:
+        """
+        Given a machine and a profile, return whether the profile's owner joined
+        the same arcade. Only consults the machine cache, so callers should
+        prefetch the machines for the profiles they are about to check.
+        """
         if profile is None:
             return False
 
@@ -544,12 +690,12 @@ class IIDXBase(CoreHandler, CardManagerHandler, PASELIHandler, Base):
             # is the current machine.
             return True
 
-        their_machine = self.get_machine_by_id(machineid)
-        if their_machine is None:
+        their_arcade = machines.cached_arcade_by_id(machineid)
+        if their_arcade is None:
             return False
 
         # The machine they joined matches the arcade of the current machine
-        return their_machine.arcade == machine.arcade
+        return their_arcade == machine.arcade
 
     async def get_ghost(
             self,
@@ -576,6 +722,18 @@ class IIDXBase(CoreHandler, CardManagerHandler, PASELIHandler, Base):
                         'pid': rival_profile.get_int('pid'),
                     }
 
+        if ghost_type == self.GHOST_TYPE_GLOBAL_AVERAGE:
+            # The network wide average only moves when somebody's best does,
+            # so it is shared between workers instead of rescanning the chart
+            cached = await ghost_averages.get((self.music_version, musicid, chart))
+            if cached is not None and cached[2] == ghost_length:
+                if cached[1] == 0:
+                    return None
+                return {
+                    'score': cached[0],
+                    'ghost': bytes([0] * ghost_length),
+                }
+
         if (
                 ghost_type == self.GHOST_TYPE_GLOBAL_TOP or
                 ghost_type == self.GHOST_TYPE_LOCAL_TOP or
@@ -600,14 +758,22 @@ class IIDXBase(CoreHandler, CardManagerHandler, PASELIHandler, Base):
 
                 if 'shop_location' in my_profile:
                     shop_id = my_profile.get_int('shop_location')
-                    machine = self.get_machine_by_id(shop_id)
+                    machine = await self.get_machine_by_id(shop_id)
                 else:
                     machine = None
 
                 if machine is not None:
+                    profiles = dict(await self.get_any_profiles(list({score[0] for score in all_scores})))
+                    await machines.prefetch(
+                        self.data,
+                        [
+                            profile.get_int('shop_location') for profile in profiles.values()
+                            if profile is not None and 'shop_location' in profile
+                        ],
+                    )
                     all_scores = [
                         score for score in all_scores
-                        if self.user_joined_arcade(machine, await self.get_any_profile(score[0]))
+                        if self.user_joined_arcade(machine, profiles.get(score[0]))
                     ]
                 else:
                     # Not joined an arcade, so nobody matches our scores
@@ -626,7 +792,7 @@ class IIDXBase(CoreHandler, CardManagerHandler, PASELIHandler, Base):
                 for potential_top in all_scores:
                     top_userid = potential_top[0]
                     top_score = potential_top[1]
-                    top_profile = self.get_any_profile(top_userid)
+                    top_profile = await self.get_any_profile(top_userid)
                     if top_profile is not None:
                         ghost_score = {
                             'score': top_score.points,
@@ -647,6 +813,11 @@ class IIDXBase(CoreHandler, CardManagerHandler, PASELIHandler, Base):
                         'score': average_score,
                         'ghost': bytes([0] * ghost_length),
                     }
+                if ghost_type == self.GHOST_TYPE_GLOBAL_AVERAGE:
+                    await ghost_averages.put(
+                        (self.music_version, musicid, chart),
+                        (average_score or 0, len(all_scores), ghost_length),
+                    )
 
         if (
                 ghost_type == self.GHOST_TYPE_DAN_TOP or
@@ -684,7 +855,7 @@ class IIDXBase(CoreHandler, CardManagerHandler, PASELIHandler, Base):
                     for potential_top in relevant_scores:
                         top_userid = potential_top[0]
                         top_score = potential_top[1]
-                        top_profile = self.get_any_profile(top_userid)
+                        top_profile = await self.get_any_profile(top_userid)
                         if top_profile is not None:
                             ghost_score = {
                                 'score': top_score.points,
@@ -726,7 +897,7 @@ class IIDXBase(CoreHandler, CardManagerHandler, PASELIHandler, Base):
                 for potential_top in all_scores:
                     top_userid = potential_top[0]
                     top_score = potential_top[1]
-                    top_profile = self.get_any_profile(top_userid)
+                    top_profile = await self.get_any_profile(top_userid)
                     if top_profile is not None:
                         ghost_score = {
                             'score': top_score.points,
@@ -0,0 +1,307 @@
+# vim: set fileencoding=utf-8
+import argparse
+import asyncio
+import bisect
+import itertools
+import random
+import time
+
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional, Tuple
+
+from core.common import GameConstants, ValidatedDict
+from core.data import Data, UserID
+
+from .cache import LRUCache
+from .events import ScoreImproved, event_bus
+
+
+Cursor = Tuple[int, ...]
+
+
+class ScoreBrowser:
+    """
+    Paged views over high scores for the webui: a player's scores ordered by
+    song and chart, optionally narrowed to a clear lamp or song level, and a
+    chart's scores ordered by EX score. Core's score queries take no offset or
+    limit, so pages are cut in memory: each view is loaded whole with one query
+    filtered to its player or chart, sorted by its key and kept until a score
+    in it changes, and pages are found with a binary search on the cursor
+    instead of an offset, so deep pages cost the same as the first one.
+    Requests that find a view missing while it is being loaded wait for that
+    load rather than starting their own. Only the first page of a view costs
+    a query, the pages after it are served from memory. Rows are plain lists
+    in the order of COLUMNS.
+    """
+
+    USER_COLUMNS = ['songid', 'chart', 'ex_score', 'clear_status', 'miss_count', 'level']
+    CHART_COLUMNS = ['userid', 'ex_score', 'clear_status', 'miss_count']
+
+    def __init__(self, game: str = GameConstants.IIDX, ttl: float = 600.0) -> None:
+        self.game = game
+        self.__users: LRUCache[List[Tuple[Cursor, List[int]]]] = LRUCache(1024, ttl)
+        self.__charts: LRUCache[List[Tuple[Cursor, List[int]]]] = LRUCache(1024, ttl)
+        self.__levels: LRUCache[Dict[Tuple[int, int], int]] = LRUCache(8, 3600.0)
+        self.__loading: Dict[Tuple[str, Hashable], asyncio.Task] = {}
+
+    @staticmethod
+    def encode_cursor(cursor: Optional[Cursor]) -> Optional[str]:
+        if cursor is None:
+            return None
+        return '.'.join(str(part) for part in cursor)
+
+    @staticmethod
+    def decode_cursor(cursor: Optional[str]) -> Optional[Cursor]:
+        if not cursor:
+            return None
+        return tuple(int(part) for part in cursor.split('.'))
+
+    async def __get_levels(self, data: Data, version: int) -> Dict[Tuple[int, int], int]:
+        levels = self.__levels.get(version)
+        if levels is None:
+            levels = {
+                (song.id, song.chart): song.data.get_int('difficulty')
+                for song in await data.local.music.get_all_songs(self.game, version)
+            }
+            self.__levels.put(version, levels)
+        return levels
+
+    async def __view(
+        self,
+        views: LRUCache[List[Tuple[Cursor, List[int]]]],
+        name: str,
+        key: Hashable,
+        loader: Callable[[], Awaitable[List[Tuple[Cursor, List[int]]]]],
+    ) -> List[Tuple[Cursor, List[int]]]:
+        entries = views.get(key)
+        if entries is not None:
+            return entries
+
+        task = self.__loading.get((name, key))
+        if task is None:
+            task = asyncio.get_running_loop().create_task(loader())
+            self.__loading[(name, key)] = task
+
+            def loaded(task: asyncio.Task) -> None:
+                # Dropped by invalidate() if a score changed while loading, so
+                # a load that may have missed it is never kept
+                if self.__loading.get((name, key)) is task:
+                    del self.__loading[(name, key)]
+                    if not task.cancelled() and task.exception() is None:
+                        views.put(key, task.result())
+
+            task.add_done_callback(loaded)
+        return await asyncio.shield(task)
+
+    def __page(
+        self,
+        entries: List[Tuple[Cursor, List[int]]],
+        cursor: Optional[Cursor],
+        count: int,
+        matches: Optional[Callable[[List[int]], bool]] = None,
+    ) -> Tuple[List[List[int]], Optional[Cursor]]:
+        if count < 1:
+            raise Exception(f'Invalid page size {count}!')
+
+        start = 0 if cursor is None else bisect.bisect_right(entries, (cursor, [float('inf')]))
+        rows: List[List[int]] = []
+        last: Optional[Cursor] = None
+        for key, row in itertools.islice(entries, start, None):
+            if matches is not None and not matches(row):
+                continue
+            if len(rows) == count:
+                return rows, last
+            rows.append(row)
+            last = key
+        return rows, None
+
+    async def user(
+        self,
+        data: Data,
+        version: int,
+        userid: UserID,
+        cursor: Optional[Cursor],
+        count: int,
+        lamp: Optional[int] = None,
+        level: Optional[int] = None,
+    ) -> Tuple[List[List[int]], Optional[Cursor]]:
+        """
+        Return a page of a player's scores after the cursor, ordered by song
+        and chart, along with the cursor for the next page.
+        """
+        async def load() -> List[Tuple[Cursor, List[int]]]:
+            levels = await self.__get_levels(data, version)
+            return sorted(
+                (
+                    (score.id, score.chart),
+                    [
+                        score.id,
+                        score.chart,
+                        score.points,
+                        score.data.get_int('clear_status'),
+                        score.data.get_int('miss_count', -1),
+                        levels.get((score.id, score.chart), 0),
+                    ],
+                )
+                for score in await data.local.music.get_scores(self.game, version, userid)
+            )
+
+        entries = await self.__view(self.__users, 'user', (version, userid), load)
+
+        matches = None
+        if lamp is not None or level is not None:
+            def matches(row: List[int]) -> bool:
+                return (lamp is None or row[3] == lamp) and (level is None or row[5] == level)
+
+        return self.__page(entries, cursor, count, matches)
+
+    async def chart(
+        self,
+        data: Data,
+        version: int,
+        songid: int,
+        chart: int,
+        cursor: Optional[Cursor],
+        count: int,
+    ) -> Tuple[List[List[int]], Optional[Cursor]]:
+        """
+        Return a page of a chart's scores after the cursor, best EX score
+        first, along with the cursor for the next page.
+        """
+        async def load() -> List[Tuple[Cursor, List[int]]]:
+            return sorted(
+                (
+                    (-score.points, userid),
+                    [
+                        userid,
+                        score.points,
+                        score.data.get_int('clear_status'),
+                        score.data.get_int('miss_count', -1),
+                    ],
+                )
+                for userid, score in await data.local.music.get_all_scores(
+                    game=self.game,
+                    version=version,
+                    songid=songid,
+                    songchart=chart,
+                )
+            )
+
+        entries = await self.__view(self.__charts, 'chart', (version, songid, chart), load)
+
+        return self.__page(entries, cursor, count)
+
+    def invalidate(self, version: int, userid: Optional[UserID], songid: int, chart: int) -> None:
+        """
+        Drop the views a new score for this player and chart would change.
+        """
+        if userid is not None:
+            self.__users.invalidate((version, userid))
+            self.__loading.pop(('user', (version, userid)), None)
+        self.__charts.invalidate((version, songid, chart))
+        self.__loading.pop(('chart', (version, songid, chart)), None)
+
+
+score_browser = ScoreBrowser()
+
+
+async def invalidate_score_views(event: ScoreImproved) -> None:
+    # Also reached by scores saved in other workers when the event bridge is on
+    score_browser.invalidate(event.version, event.userid, event.songid, event.chart)
+
+
+event_bus.subscribe([ScoreImproved], invalidate_score_views)
+
+
+class BenchScore:
+    def __init__(self, songid: int, chart: int, points: int) -> None:
+        self.id = songid
+        self.chart = chart
+        self.points = points
+        self.data = ValidatedDict({'clear_status': points % 8, 'miss_count': points % 50})
+
+
+class BenchMusic:
+    """
+    Stands in for data.local.music, answering score queries from memory after
+    a simulated database delay.
+    """
+
+    def __init__(self, users: int, scores: int, latency: float) -> None:
+        self.latency = latency
+        self.queries = 0
+        rng = random.Random(0)
+        self.scores = {
+            userid: [BenchScore(songid, chart, rng.randrange(4000)) for songid, chart in zip(range(1000, 1000 + scores), itertools.cycle(range(10)))]
+            for userid in range(users)
+        }
+
+    async def get_scores(self, game: str, version: int, userid: UserID) -> List[BenchScore]:
+        self.queries = self.queries + 1
+        await asyncio.sleep(self.latency)
+        return self.scores.get(userid, [])
+
+    async def get_all_songs(self, game: str, version: int) -> List[Any]:
+        return []
+
+
+async def bench(users: int, scores: int, requests: int, concurrency: int, improve: float, latency: float) -> Dict[str, float]:
+    """
+    Replay score browser traffic: players paging through their scores from
+    the first page on, a few at a time, while some of them set new records
+    that drop their cached view. Reports page latency percentiles and how
+    many page requests had to query storage.
+    """
+    music = BenchMusic(users, scores, latency)
+    data: Any = type('BenchData', (), {'local': type('BenchLocal', (), {'music': music})()})()
+    browser = ScoreBrowser()
+    latencies: List[float] = []
+
+    async def client(seed: int) -> None:
+        rng = random.Random(seed)
+        for _ in range(requests // concurrency):
+            # A few players are far more active than the rest
+            userid = min(int(rng.paretovariate(1.2)) - 1, users - 1)
+            if rng.random() < improve:
+                browser.invalidate(0, userid, 1000, 0)
+            cursor: Optional[Cursor] = None
+            for _ in range(rng.randrange(1, 6)):
+                begin = time.perf_counter()
+                _, cursor = await browser.user(data, 0, userid, cursor, 100)
+                latencies.append(time.perf_counter() - begin)
+                if cursor is None:
+                    break
+
+    start = time.perf_counter()
+    await asyncio.gather(*[client(seed) for seed in range(concurrency)])
+    seconds = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        'pages': len(latencies),
+        'queries': music.queries,
+        'pages_per_second': len(latencies) / seconds,
+        'p50': latencies[len(latencies) // 2],
+        'p99': latencies[min(len(latencies) - 1, (len(latencies) * 99) // 100)],
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark paging through player scores in the score browser.")
+    parser.add_argument('--users', type=int, default=2000, help="Players whose scores are browsed.")
+    parser.add_argument('--scores', type=int, default=3000, help="High scores per player.")
+    parser.add_argument('--requests', type=int, default=5000, help="Browsing sessions to replay.")
+    parser.add_argument('--concurrency', type=int, default=50, help="Sessions running at once.")
+    parser.add_argument('--improve', type=float, default=0.05, help="Chance a session's player set a new record first.")
+    parser.add_argument('--latency', type=float, default=0.02, help="Simulated score query time, in seconds.")
+    args = parser.parse_args()
+
+    result = asyncio.run(bench(args.users, args.scores, args.requests, args.concurrency, args.improve, args.latency))
+    print(
+        f"{result['pages']:.0f} pages with {result['queries']:.0f} score queries, "
+        f"{result['pages_per_second']:.0f} pages/s, "
+        f"p50 {result['p50'] * 1000:.2f}ms, p99 {result['p99'] * 1000:.2f}ms"
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,501 @@
+# vim: set fileencoding=utf-8
+import asyncio
+import bisect
+import copy
+import hashlib
+import os
+import time
+
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Generic, Hashable, Iterable, List, Optional, Tuple, TypeVar
+
+from core.common import ValidatedDict, Time
+from core.data import Data, Machine, UserID
+from core.protocol import Node
+
+from .backends import CacheBackend, LazyCache, SharedMemoryCache, SocketCache, parse_address
+from .events import ArcadeSettingsChanged, MachineChanged, ProfileSaved, ScoreImproved, event_bus
+
+
+T = TypeVar('T')
+
+
+class LRUCache(Generic[T]):
+    """
+    Small bounded cache with optional expiry. Least recently used entries are
+    evicted once maxsize is reached, and entries older than ttl seconds are
+    treated as missing. Kept in process and used synchronously.
+    """
+
+    def __init__(self, maxsize: int, ttl: Optional[float] = None) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.__entries: 'OrderedDict[Hashable, Tuple[float, T]]' = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self.__entries)
+
+    def get(self, key: Hashable) -> Optional[T]:
+        entry = self.__entries.get(key)
+        if entry is None:
+            self.misses = self.misses + 1
+            return None
+
+        stored, value = entry
+        if self.ttl is not None and (time.monotonic() - stored) > self.ttl:
+            del self.__entries[key]
+            self.misses = self.misses + 1
+            return None
+
+        self.__entries.move_to_end(key)
+        self.hits = self.hits + 1
+        return value
+
+    def put(self, key: Hashable, value: T) -> None:
+        self.__entries[key] = (time.monotonic(), value)
+        self.__entries.move_to_end(key)
+        while len(self.__entries) > self.maxsize:
+            self.__entries.popitem(last=False)
+
+    def invalidate(self, key: Hashable) -> None:
+        self.__entries.pop(key, None)
+
+    def clear(self) -> None:
+        self.__entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'backend': 'local',
+            'size': len(self.__entries),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+class LocalCache(CacheBackend[T]):
+    """
+    The in-process cache backend, an LRUCache behind the backend interface.
+    """
+
+    def __init__(self, maxsize: int, ttl: Optional[float] = None) -> None:
+        self.__cache: LRUCache[T] = LRUCache(maxsize, ttl)
+
+    async def get(self, key: Hashable) -> Optional[T]:
+        return self.__cache.get(key)
+
+    async def put(self, key: Hashable, value: T) -> None:
+        self.__cache.put(key, value)
+
+    async def invalidate(self, key: Hashable) -> None:
+        self.__cache.invalidate(key)
+
+    async def clear(self) -> None:
+        self.__cache.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        return self.__cache.stats()
+
+
+def make_cache(namespace: str, maxsize: int, ttl: Optional[float] = None) -> CacheBackend[Any]:
+    """
+    Create a cache that should stay coherent between worker processes, using
+    the backend picked by IIDX_CACHE_BACKEND. "socket" shares it through the
+    cache server at IIDX_CACHE_SERVER, anything else keeps it in process.
+    """
+    if os.environ.get('IIDX_CACHE_BACKEND') == 'socket':
+        return SocketCache(namespace, parse_address(os.environ.get('IIDX_CACHE_SERVER', '127.0.0.1:47200')), ttl)
+    return LocalCache(maxsize, ttl)
+
+
+def make_record_cache(namespace: str, maxsize: int, record: str, ttl: Optional[float] = None) -> CacheBackend[Tuple[Any, ...]]:
+    """
+    Like make_cache(), for values that are tuples of the given struct format,
+    which "shm" can also keep in a shared memory block.
+    """
+    if os.environ.get('IIDX_CACHE_BACKEND') == 'shm':
+        return SharedMemoryCache(namespace, maxsize, record, ttl)
+    return make_cache(namespace, maxsize, ttl)
+
+
+class ResponseCache:
+    """
+    Idempotency cache for requests that cabinets retry on network hiccups.
+    Responses are keyed by a digest of the cabinet and the full request, so
+    a retry gets the previously built response back without touching storage.
+    A retry that arrives while the original is still being handled waits for
+    it instead of running the request a second time.
+    """
+
+    def __init__(self, maxsize: int = 4096, ttl: float = 60.0) -> None:
+        self.__cache: LRUCache[Node] = LRUCache(maxsize, ttl)
+        self.__pending: Dict[str, asyncio.Future] = {}
+        self.joined = 0
+
+    @property
+    def hits(self) -> int:
+        return self.__cache.hits
+
+    def __digest_node(self, digest: Any, node: Node) -> None:
+        digest.update(node.name.encode('utf-8'))
+        for name, value in sorted(node.attributes.items()):
+            digest.update(f'{name}={value};'.encode('utf-8'))
+        digest.update(repr(node.value).encode('utf-8'))
+        for child in node.children:
+            digest.update(b'<')
+            self.__digest_node(digest, child)
+            digest.update(b'>')
+
+    def key(self, pcbid: str, request: Node) -> str:
+        digest = hashlib.sha1(pcbid.encode('utf-8'))
+        self.__digest_node(digest, request)
+        return digest.hexdigest()
+
+    def get(self, key: str) -> Optional[Node]:
+        response = self.__cache.get(key)
+        if response is None:
+            return None
+        # The dispatcher may attach the response to its own tree, so never
+        # hand out the cached instance itself.
+        return copy.deepcopy(response)
+
+    def put(self, key: str, response: Node) -> None:
+        self.__cache.put(key, copy.deepcopy(response))
+
+    async def once(self, key: str, build: Callable[[], Awaitable[Node]]) -> Node:
+        """
+        Return the response for a request, calling build() to handle it only
+        if it is neither cached nor already being handled.
+        """
+        response = self.get(key)
+        if response is not None:
+            return response
+
+        pending = self.__pending.get(key)
+        if pending is not None:
+            self.joined = self.joined + 1
+            return copy.deepcopy(await asyncio.shield(pending))
+
+        future = asyncio.get_running_loop().create_future()
+        self.__pending[key] = future
+        try:
+            response = await build()
+        except BaseException as exception:
+            del self.__pending[key]
+            if not isinstance(exception, Exception):
+                # Retries waiting on a cancelled request must not look cancelled themselves
+                exception = Exception('Request was cancelled before it was handled')
+            future.set_exception(exception)
+            # Marks the error as seen, there may be nobody waiting for it
+            future.exception()
+            raise
+
+        del self.__pending[key]
+        self.put(key, response)
+        future.set_result(copy.deepcopy(response))
+        return response
+
+    def stats(self) -> Dict[str, Any]:
+        return dict(self.__cache.stats(), joined=self.joined, pending=len(self.__pending))
+
+
+class MachineCache:
+    """
+    Cache of machine rows, reachable by both PCBID and machine ID. Rows are
+    mirrored in a small in-process LRU so hot loops can read them
+    synchronously through the cached_* accessors once prefetch() has loaded
+    them, while misses go to the shared cache backend and then to storage.
+    Machine IDs never change for a PCBID, so only the machine rows themselves
+    need to be invalidated when a cabinet updates its name or settings, and
+    that is published as MachineChanged so every worker drops its copy.
+    """
+
+    def __init__(self, maxsize: int = 4096, ttl: float = 300.0) -> None:
+        self.__local: LRUCache[Machine] = LRUCache(maxsize, ttl)
+        self.__local_pcbids: LRUCache[str] = LRUCache(maxsize)
+        self.__machines: CacheBackend[Machine] = make_cache('machines', maxsize, ttl)
+        self.__pcbids: CacheBackend[str] = make_cache('machine_pcbids', maxsize)
+        event_bus.subscribe([MachineChanged], self.__changed)
+
+    async def __changed(self, event: MachineChanged) -> None:
+        self.__local.invalidate(event.pcbid)
+        await self.__machines.invalidate(event.pcbid)
+
+    def __remember(self, pcbid: str, machine: Machine) -> None:
+        self.__local.put(pcbid, machine)
+        self.__local_pcbids.put(machine.id, pcbid)
+
+    async def by_pcbid(self, data: Data, pcbid: str) -> Optional[Machine]:
+        machine = self.__local.get(pcbid)
+        if machine is not None:
+            return machine
+
+        machine = await self.__machines.get(pcbid)
+        if machine is None:
+            machine = await data.local.machine.get_machine(pcbid)
+            if machine is None:
+                return None
+            await self.__machines.put(pcbid, machine)
+            await self.__pcbids.put(machine.id, pcbid)
+        self.__remember(pcbid, machine)
+        return machine
+
+    async def by_id(self, data: Data, machineid: int) -> Optional[Machine]:
+        pcbid = self.__local_pcbids.get(machineid)
+        if pcbid is None:
+            pcbid = await self.__pcbids.get(machineid)
+        if pcbid is None:
+            pcbid = await data.local.machine.from_machine_id(machineid)
+            if pcbid is None:
+                return None
+            await self.__pcbids.put(machineid, pcbid)
+        return await self.by_pcbid(data, pcbid)
+
+    async def prefetch(self, data: Data, machineids: Iterable[int]) -> None:
+        """
+        Make sure every machine ID given is cached in this process, so that hot
+        loops can use the synchronous accessors below instead of awaiting a
+        lookup per row. Machines missing here are fetched from the shared
+        backend with one batched lookup per cache, and only the rest are loaded
+        from storage one at a time.
+        """
+        missing = {machineid for machineid in machineids if self.cached_by_id(machineid) is None}
+        if not missing:
+            return
+
+        pcbids = await self.__pcbids.get_many(missing)
+        found = await self.__machines.get_many(set(pcbids.values()))
+        for machineid in missing:
+            pcbid = pcbids.get(machineid)
+            machine = found.get(pcbid) if pcbid is not None else None
+            if machine is not None:
+                self.__remember(pcbid, machine)
+            else:
+                await self.by_id(data, machineid)
+
+    def cached_by_pcbid(self, pcbid: str) -> Optional[Machine]:
+        return self.__local.get(pcbid)
+
+    def cached_by_id(self, machineid: int) -> Optional[Machine]:
+        pcbid = self.__local_pcbids.get(machineid)
+        if pcbid is None:
+            return None
+        return self.__local.get(pcbid)
+
+    def cached_arcade_by_id(self, machineid: int) -> Optional[int]:
+        machine = self.cached_by_id(machineid)
+        if machine is None:
+            return None
+        return machine.arcade
+
+    async def invalidate(self, pcbid: str) -> None:
+        """
+        Drop a machine row here and in the shared backend, and tell every other
+        worker to drop its own copy.
+        """
+        await self.__changed(MachineChanged(pcbid))
+        event_bus.publish(MachineChanged(pcbid))
+
+    def stats(self) -> Dict[str, Any]:
+        return dict(self.__machines.stats(), local=len(self.__local))
+
+
+class ArcadeSettingsCache:
+    """
+    Write-through cache of per-arcade game settings. Every cabinet in an arcade
+    shares the same entry. Writes are checked against storage rather than the
+    cache, which may be behind another worker's write, and skipped when they
+    don't change anything. A write is published as ArcadeSettingsChanged so
+    every worker drops its copy. Missing settings are cached as empty so
+    polling cabinets don't keep asking.
+    """
+
+    def __init__(self, maxsize: int = 4096, ttl: float = 60.0) -> None:
+        self.__settings: CacheBackend[ValidatedDict] = make_cache('arcade_settings', maxsize, ttl)
+        event_bus.subscribe([ArcadeSettingsChanged], self.__changed)
+
+    async def __changed(self, event: ArcadeSettingsChanged) -> None:
+        await self.__settings.invalidate((event.arcade, event.game, event.version, event.setting))
+
+    async def get(self, data: Data, arcade: int, game: str, version: int, setting: str) -> ValidatedDict:
+        key = (arcade, game, version, setting)
+        settings = await self.__settings.get(key)
+        if settings is None:
+            settings = await data.local.machine.get_settings(arcade, game, version, setting)
+            if settings is None:
+                settings = ValidatedDict()
+            await self.__settings.put(key, settings)
+        return copy.deepcopy(settings)
+
+    async def put(self, data: Data, arcade: int, game: str, version: int, setting: str, settings: ValidatedDict) -> bool:
+        """
+        Save settings for an arcade, returning whether anything was written.
+        """
+        key = (arcade, game, version, setting)
+        stored = await data.local.machine.get_settings(arcade, game, version, setting)
+        if (stored if stored is not None else ValidatedDict()) == settings:
+            # Nothing to write, but the cache may still hold an older copy
+            await self.__settings.put(key, copy.deepcopy(settings))
+            return False
+
+        await data.local.machine.put_settings(arcade, game, version, setting, settings)
+        await self.__settings.put(key, copy.deepcopy(settings))
+        event_bus.publish(ArcadeSettingsChanged(arcade, game, version, setting))
+        return True
+
+    def stats(self) -> Dict[str, Any]:
+        return self.__settings.stats()
+
+
+class TimeSensitiveCache:
+    """
+    Cache of the currently active time sensitive setting, such as the daily
+    recommendations. An entry is kept until its end_time, so it refreshes at
+    the next day boundary on its own. When nothing is active we only remember
+    that for a short while, in case an operator schedules something.
+    """
+
+    EMPTY_RETRY = 300
+
+    def __init__(self) -> None:
+        self.__entries: Dict[Tuple[str, int, str], Tuple[int, Optional[Dict[str, Any]]]] = {}
+
+    async def get(self, data: Data, game: str, version: int, name: str) -> Optional[Dict[str, Any]]:
+        now = Time.now()
+        key = (game, version, name)
+        cached = self.__entries.get(key)
+        if cached is not None and now < cached[0]:
+            return cached[1]
+
+        entry = await data.local.game.get_time_sensitive_settings(game, version, name)
+        if entry is not None:
+            expires = entry['end_time']
+        else:
+            expires = now + self.EMPTY_RETRY
+        self.__entries[key] = (expires, entry)
+        return entry
+
+    def invalidate(self, game: str, version: int, name: str) -> None:
+        self.__entries.pop((game, version, name), None)
+
+
+class ProfileDirectory:
+    """
+    Sorted (userid, name, extid) summaries of every profile in a game version, for
+    user pickers that page through players. Core has no summary query, so the
+    directory is built from one bulk profile query per version and from then
+    on kept current from ProfileSaved events, including those other workers
+    send over the event bridge, instead of loading every profile again. A
+    second list sorted by lowercased name lets name prefix searches jump
+    straight to the matching players.
+    """
+
+    def __init__(self) -> None:
+        self.__summaries: Dict[Tuple[str, int], List[Tuple[UserID, str, int]]] = {}
+        self.__names: Dict[Tuple[str, int], List[Tuple[str, UserID]]] = {}
+        event_bus.subscribe([ProfileSaved], self.__saved)
+
+    async def __saved(self, event: ProfileSaved) -> None:
+        summaries = self.__summaries.get((event.game, event.version))
+        names = self.__names.get((event.game, event.version))
+        if summaries is None or names is None:
+            # Not built yet, it will be read from storage when it is
+            return
+
+        index = bisect.bisect_left(summaries, (event.userid,))
+        if index < len(summaries) and summaries[index][0] == event.userid:
+            oldname = (summaries[index][1].lower(), event.userid)
+            del names[bisect.bisect_left(names, oldname)]
+            summaries[index] = (event.userid, event.name, event.extid)
+        else:
+            summaries.insert(index, (event.userid, event.name, event.extid))
+        bisect.insort(names, (event.name.lower(), event.userid))
+
+    async def __get(self, data: Data, game: str, version: int) -> List[Tuple[UserID, str, int]]:
+        summaries = self.__summaries.get((game, version))
+        if summaries is None:
+            summaries = sorted(
+                (userid, profile.get('name', ''), profile.get_int('extid'))
+                for userid, profile in await data.local.user.get_all_profiles(game, version)
+            )
+            names = sorted((name.lower(), userid) for userid, name, _ in summaries)
+            # Another request may have built it while we were waiting
+            if (game, version) not in self.__summaries:
+                self.__summaries[(game, version)] = summaries
+                self.__names[(game, version)] = names
+            summaries = self.__summaries[(game, version)]
+        return summaries
+
+    async def page(
+        self,
+        data: Data,
+        game: str,
+        version: int,
+        cursor: Optional[UserID],
+        count: int,
+        prefix: Optional[str] = None,
+    ) -> Tuple[List[Tuple[UserID, str, int]], Optional[UserID]]:
+        """
+        Return up to count summaries with a userid after the cursor, optionally
+        only those whose name starts with prefix, along with the cursor for the
+        next page or None if this was the last one.
+        """
+        if count < 1:
+            raise Exception(f'Invalid page size {count}!')
+
+        summaries = await self.__get(data, game, version)
+        if prefix:
+            # Only the players whose name matches are looked at, in userid order
+            prefix = prefix.lower()
+            names = self.__names[(game, version)]
+            first = bisect.bisect_left(names, (prefix,))
+            last = bisect.bisect_left(names, (prefix + chr(0x10FFFF),))
+            summaries = [
+                summaries[bisect.bisect_left(summaries, (userid,))]
+                for userid in sorted(userid for _, userid in names[first:last])
+            ]
+
+        start = 0 if cursor is None else bisect.bisect_right(summaries, (cursor, chr(0x10FFFF)))
+        page = summaries[start:(start + count + 1)]
+        if len(page) > count:
+            return page[:count], page[count - 1][0]
+        return page, None
+
+    async def names(self, data: Data, game: str, version: int, userids: List[UserID]) -> Dict[UserID, str]:
+        """
+        Look up the names of several users at once, for leaderboard pages.
+        Users without a profile are left out.
+        """
+        summaries = await self.__get(data, game, version)
+        names: Dict[UserID, str] = {}
+        for userid in userids:
+            index = bisect.bisect_left(summaries, (userid,))
+            if index < len(summaries) and summaries[index][0] == userid:
+                names[userid] = summaries[index][1]
+        return names
+
+    def invalidate(self, game: str, version: int) -> None:
+        self.__summaries.pop((game, version), None)
+        self.__names.pop((game, version), None)
+
+
+# Handlers are created per request, so state that has to outlive a request
+# lives in module level instances like these, shared by every handler. The
+# other modules of this plugin keep theirs at the bottom of the module too.
+retry_responses = ResponseCache()
+machines = MachineCache()
+arcade_settings = ArcadeSettingsCache()
+time_sensitive_settings = TimeSensitiveCache()
+profile_directory = ProfileDirectory()
+
+# (average EX score, scores averaged, ghost length) per (version, songid, chart)
+ghost_averages: CacheBackend[Tuple[Any, ...]] = LazyCache(lambda: make_record_cache('ghost_averages', 16384, '<iII', 300.0))
+
+
+async def invalidate_ghost_averages(event: ScoreImproved) -> None:
+    await ghost_averages.invalidate((event.version, event.songid, event.chart))
+
+
+event_bus.subscribe([ScoreImproved], invalidate_ghost_averages)
@@ -0,0 +1,95 @@
+# vim: set fileencoding=utf-8
+import itertools
+import json
+import os
+import time
+
+from typing import Any, Dict, List, Optional, Tuple
+
+
+class Catalog:
+    """
+    In-memory index over one of the webui's catalog files (themeData.json or
+    qproData.json), mapping each type to its entries by ID, where the ID is the
+    entry's position in the file as the game sees it. Lets the server check a
+    submitted ID without the browser's help, and is reloaded whenever the file
+    changes on disk, at most one stat per CHECK_INTERVAL.
+    """
+
+    CHECK_INTERVAL = 5.0
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.__mtime: Optional[float] = None
+        self.__checked = 0.0
+        self.__entries: Dict[str, Dict[int, Dict[str, Any]]] = {}
+
+    def __refresh(self) -> None:
+        now = time.monotonic()
+        if self.__mtime is not None and (now - self.__checked) < self.CHECK_INTERVAL:
+            return
+        self.__checked = now
+
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except FileNotFoundError:
+            self.__mtime = None
+            self.__entries = {}
+            return
+        if mtime == self.__mtime:
+            return
+
+        with open(self.path, 'rb') as fp:
+            raw = json.load(fp)
+
+        entries: Dict[str, Dict[int, Dict[str, Any]]] = {}
+        for catalogtype, values in raw.items():
+            # Theme catalogs are plain name lists, qpro catalogs carry the ifs too
+            entries[catalogtype] = {
+                catalogid: value if isinstance(value, dict) else {'name': value}
+                for catalogid, value in enumerate(values)
+            }
+        self.__entries = entries
+        self.__mtime = mtime
+
+    @property
+    def version(self) -> str:
+        """
+        Changes whenever the catalog is reloaded, for use as an ETag.
+        """
+        self.__refresh()
+        return f'{self.__mtime or 0:.6f}'
+
+    def types(self) -> List[str]:
+        self.__refresh()
+        return list(self.__entries.keys())
+
+    def valid(self, catalogtype: str, catalogid: int) -> bool:
+        self.__refresh()
+        return catalogid in self.__entries.get(catalogtype, {})
+
+    def get(self, catalogtype: str, catalogid: int) -> Optional[Dict[str, Any]]:
+        self.__refresh()
+        return self.__entries.get(catalogtype, {}).get(catalogid)
+
+    def slice(
+        self,
+        catalogtype: str,
+        offset: int = 0,
+        count: Optional[int] = None,
+        search: Optional[str] = None,
+    ) -> List[Tuple[int, Dict[str, Any]]]:
+        """
+        Return (id, entry) tuples of a type in ID order, optionally only those
+        whose name contains the search string.
+        """
+        self.__refresh()
+        entries = self.__entries.get(catalogtype, {})
+        matches = iter(entries.items())
+        if search:
+            search = search.lower()
+            matches = (
+                (catalogid, entry) for catalogid, entry in matches
+                if search in entry['name'].lower()
+            )
+        return list(itertools.islice(matches, offset, None if count is None else offset + count))
@@ -0,0 +1,132 @@
+# vim: set fileencoding=utf-8
+from typing import Dict, List, Optional, Tuple
+
+from core.common import ValidatedDict
+from core.data import Data, UserID
+
+from .cache import arcade_settings
+from .events import ConventionImproved, event_bus
+from .locks import profile_locks
+from .ranking import SortedIndex
+
+
+class ConventionRanking:
+    """
+    Per-arcade shop convention leaderboards. Each arcade's leaderboard sums the
+    best EX score every player set on the four songs of the arcade's active
+    shop course, separately for every chart, and starts over whenever that
+    course changes. A player's convention scores are stored as an achievement
+    keyed by arcade, with the course's songs in the achievement type, so
+    leaderboards survive restarts, are the same in every worker, and a course
+    that is changed away from and back again starts from nothing. Leaderboards
+    are loaded one arcade course at a time on first use and kept current from
+    ConventionImproved events, including those published by other workers
+    over the event bridge.
+    """
+
+    ACHIEVEMENT_TYPE = 'shop_convention'
+
+    def __init__(self) -> None:
+        self.__boards: Dict[Tuple[str, int, int, Tuple[int, ...]], Dict[int, SortedIndex[UserID]]] = {}
+        event_bus.subscribe([ConventionImproved], self.__improved)
+
+    def music(self, course: ValidatedDict) -> Tuple[int, ...]:
+        if not course.get_bool('valid'):
+            return ()
+        return tuple(course.get_int(f'music_{i}') for i in range(4))
+
+    def achievement_type(self, music: Tuple[int, ...]) -> str:
+        return '_'.join([self.ACHIEVEMENT_TYPE] + [str(musicid) for musicid in music])
+
+    async def __improved(self, event: ConventionImproved) -> None:
+        self.__raise((event.game, event.version, event.arcade, tuple(event.music)), event.userid, event.chart, event.total)
+
+    def __raise(self, key: Tuple[str, int, int, Tuple[int, ...]], userid: UserID, chart: int, total: int) -> None:
+        boards = self.__boards.get(key)
+        if boards is None:
+            # Not loaded yet, it will be read from storage when it is
+            return
+        board = boards.setdefault(chart, SortedIndex())
+        old_total = board.get(userid)
+        if old_total is None or old_total < total:
+            board.update(userid, total)
+
+    async def record(
+        self,
+        data: Data,
+        game: str,
+        version: int,
+        arcade: int,
+        userid: UserID,
+        musicid: int,
+        chart: int,
+        ex_score: int,
+    ) -> None:
+        """
+        Record a play made in an arcade, if the song is part of its shop course.
+        """
+        course = await arcade_settings.get(data, arcade, game, version, 'shop_course')
+        music = self.music(course)
+        if musicid not in music:
+            return
+
+        achievementtype = self.achievement_type(music)
+        async with profile_locks.hold(userid):
+            entry = await data.local.user.get_achievement(game, version, userid, arcade, achievementtype)
+            if entry is None:
+                entry = ValidatedDict({'scores': {}})
+
+            scores = entry.get_dict('scores')
+            songs = list(scores.get(str(chart), [-1] * len(music)))
+            index = music.index(musicid)
+            if songs[index] >= ex_score:
+                return
+            songs[index] = ex_score
+            scores[str(chart)] = songs
+            entry['scores'] = scores
+            await data.local.user.put_achievement(game, version, userid, arcade, achievementtype, entry)
+
+        total = sum(max(score, 0) for score in songs)
+        self.__raise((game, version, arcade, music), userid, chart, total)
+        event_bus.publish(ConventionImproved(game, version, arcade, list(music), userid, chart, total))
+
+    async def leaderboard(
+        self,
+        data: Data,
+        game: str,
+        version: int,
+        arcade: int,
+        chart: int,
+    ) -> Tuple[List[int], Optional[SortedIndex[UserID]]]:
+        """
+        Return the arcade's course songs and the leaderboard for one chart, or
+        no leaderboard if the arcade has no convention running.
+        """
+        course = await arcade_settings.get(data, arcade, game, version, 'shop_course')
+        music = self.music(course)
+        if not music:
+            return list(music), None
+
+        key = (game, version, arcade, music)
+        boards = self.__boards.get(key)
+        if boards is None:
+            boards = {}
+            for userid, achievement in await data.local.user.get_all_achievements(
+                game,
+                version,
+                achievementid=arcade,
+                achievementtype=self.achievement_type(music),
+            ):
+                for entrychart, songs in achievement.data.get_dict('scores').items():
+                    if songs:
+                        boards.setdefault(int(entrychart), SortedIndex()).update(userid, sum(max(score, 0) for score in songs))
+
+            # Leaderboards of courses this arcade ran before are never asked for again
+            for oldkey in [oldkey for oldkey in self.__boards if oldkey[:3] == key[:3] and oldkey != key]:
+                del self.__boards[oldkey]
+            # Another request may have loaded it while we were waiting
+            boards = self.__boards.setdefault(key, boards)
+        return list(music), boards.setdefault(chart, SortedIndex())
+
+
+convention_ranking = ConventionRanking()
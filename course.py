@@ -1,7 +1,10 @@
 # vim: set fileencoding=utf-8
-from typing import Tuple
+from typing import Dict, Optional, Tuple
 
 from .base import IIDXBase
+from .events import CourseImproved, event_bus
+from .locks import profile_locks
+from .ranking import SortedIndex
 from core.common import ValidatedDict
 from core.data import UserID
 
@@ -12,9 +15,6 @@ class IIDXCourse(IIDXBase):
     COURSE_TYPE_INTERNET_RANKING = 'ir_course'
     COURSE_TYPE_CLASSIC = 'classic_course'
 
-    def id_and_chart_from_courseid(self, courseid: int) -> Tuple[int, int]:
-        return (int(courseid / 6), courseid % 6)
-
     async def update_course(
         self,
         userid: UserID,
@@ -46,27 +46,124 @@ class IIDXCourse(IIDXBase):
         ]:
             raise Exception(f"Invalid clear status value {clear_status}")
 
-        # Update achievement to track course statistics
-        course_score = await self.data.local.user.get_achievement(
-            self.game,
-            self.version,
-            userid,
-            courseid * 6 + chart,
-            coursetype,
+        # Merge into the course statistics and the course leaderboard
+        result = await course_results.record(self, userid, coursetype, courseid, chart, clear_status, pgreats, greats)
+        if result is not None:
+            event_bus.publish(CourseImproved(
+                self.game,
+                self.version,
+                userid,
+                coursetype,
+                courseid,
+                chart,
+                (result.get_int('pgnum') * 2) + result.get_int('gnum'),
+                result.get_int('clear_status'),
+            ))
+
+    async def get_course_leaderboard(self, coursetype: str, courseid: int, chart: int) -> SortedIndex[UserID]:
+        """
+        Return the EX score leaderboard for a course chart.
+        """
+        return await course_results.leaderboard(self, coursetype, courseid, chart)
+
+
+class CourseResults:
+    """
+    Course result pipeline. Results are merged into the user's stored best and
+    written straight back under the user's profile lock, re-reading the stored
+    best first so a better result saved by another worker is never lost.
+    Per-course leaderboards are ranked by EX score, loaded one course chart at
+    a time on first use and kept current from CourseImproved events,
+    including those published by other workers over the event bridge.
+    """
+
+    def __init__(self) -> None:
+        self.__boards: Dict[Tuple[str, int, str, int, int], SortedIndex[UserID]] = {}
+        event_bus.subscribe([CourseImproved], self.__improved)
+
+    async def __improved(self, event: CourseImproved) -> None:
+        self.__raise(
+            (event.game, event.version, event.coursetype, event.courseid, event.chart),
+            event.userid,
+            event.ex_score,
         )
-        if course_score is None:
-            course_score = ValidatedDict()
-        course_score.replace_int('clear_status', max(clear_status, course_score.get_int('clear_status')))
-        old_ex_score = (course_score.get_int('pgnum') * 2) + course_score.get_int('gnum')
-        if old_ex_score < ((pgreats * 2) + greats):
-            course_score.replace_int('pgnum', pgreats)
-            course_score.replace_int('gnum', greats)
-
-        await self.data.local.user.put_achievement(
-            self.game,
-            self.version,
+
+    def __raise(self, key: Tuple[str, int, str, int, int], userid: UserID, ex_score: int) -> None:
+        board = self.__boards.get(key)
+        if board is None:
+            # Not loaded yet, it will be read from storage when it is
+            return
+        old_ex_score = board.get(userid)
+        if old_ex_score is None or old_ex_score < ex_score:
+            board.update(userid, ex_score)
+
+    async def record(
+        self,
+        course: IIDXCourse,
+        userid: UserID,
+        coursetype: str,
+        courseid: int,
+        chart: int,
+        clear_status: int,
+        pgreats: int,
+        greats: int,
+    ) -> Optional[ValidatedDict]:
+        """
+        Merge a course play into the user's best result, returning the new
+        best if it changed.
+        """
+        async with profile_locks.hold(userid):
+            old_result = await course.data.local.user.get_achievement(
+                course.game,
+                course.version,
+                userid,
+                courseid * 6 + chart,
+                coursetype,
+            )
+            if old_result is None:
+                old_result = ValidatedDict()
+
+            course_score = ValidatedDict(old_result)
+            course_score.replace_int('clear_status', max(clear_status, course_score.get_int('clear_status')))
+            old_ex_score = (course_score.get_int('pgnum') * 2) + course_score.get_int('gnum')
+            if old_ex_score < ((pgreats * 2) + greats):
+                course_score.replace_int('pgnum', pgreats)
+                course_score.replace_int('gnum', greats)
+
+            if course_score == old_result:
+                return None
+
+            await course.data.local.user.put_achievement(
+                course.game,
+                course.version,
+                userid,
+                courseid * 6 + chart,
+                coursetype,
+                course_score,
+            )
+
+        self.__raise(
+            (course.game, course.version, coursetype, courseid, chart),
             userid,
-            courseid * 6 + chart,
-            coursetype,
-            course_score,
+            (course_score.get_int('pgnum') * 2) + course_score.get_int('gnum'),
         )
+        return course_score
+
+    async def leaderboard(self, course: IIDXCourse, coursetype: str, courseid: int, chart: int) -> SortedIndex[UserID]:
+        key = (course.game, course.version, coursetype, courseid, chart)
+        board = self.__boards.get(key)
+        if board is None:
+            board = SortedIndex()
+            for userid, achievement in await course.data.local.user.get_all_achievements(
+                course.game,
+                course.version,
+                achievementid=courseid * 6 + chart,
+                achievementtype=coursetype,
+            ):
+                board.update(userid, (achievement.data.get_int('pgnum') * 2) + achievement.data.get_int('gnum'))
+            # Another request may have loaded it while we were waiting
+            board = self.__boards.setdefault(key, board)
+        return board
+
+
+course_results = CourseResults()
@@ -0,0 +1,95 @@
+# vim: set fileencoding=utf-8
+import math
+import os
+
+from typing import Dict, List, Optional, Tuple
+
+from core.common import ValidatedDict
+from core.data import UserID
+
+from .ranking import AchievementRanking, SortedIndex
+
+
+class DJRankRanking(AchievementRanking):
+    """
+    Network-wide DJ rank ranking. Holds a sorted array of points for every
+    style and category, so a player's position and the point cutoff of each
+    medal tier are binary searches during profile load.
+    """
+
+    ACHIEVEMENT_TYPE = 'dj_rank'
+
+    CATEGORIES = 15
+
+    TIER_NAMES = ['platinum', 'gold', 'silver', 'bronze', 'white']
+
+    # Percentage of the ranked players, from the top, that reach each tier.
+    # The game only displays the cutoffs it is sent and nothing documents
+    # how they are chosen, so these are placeholders. Operators can set
+    # their own with IIDX_DJ_RANK_TIERS, e.g. "platinum=1,gold=5,silver=15,
+    # bronze=35,white=60".
+    DEFAULT_TIERS = 'platinum=1,gold=5,silver=15,bronze=35,white=60'
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.__boards: Dict[Tuple[str, int, int, int], SortedIndex[UserID]] = {}
+        self.tiers = self.parse_tiers(os.environ.get('IIDX_DJ_RANK_TIERS') or self.DEFAULT_TIERS)
+
+    @classmethod
+    def parse_tiers(cls, spec: str) -> List[Tuple[str, float]]:
+        tiers = dict(cls.parse_tiers_entry(entry) for entry in spec.split(',') if entry.strip())
+        for tier in cls.TIER_NAMES:
+            if tier not in tiers:
+                raise Exception(f'Missing DJ rank tier {tier}!')
+        return [(tier, tiers[tier] / 100.0) for tier in cls.TIER_NAMES]
+
+    @classmethod
+    def parse_tiers_entry(cls, entry: str) -> Tuple[str, float]:
+        tier, _, percent = entry.partition('=')
+        tier = tier.strip()
+        if tier not in cls.TIER_NAMES:
+            raise Exception(f'Unknown DJ rank tier {tier}!')
+        share = float(percent)
+        if share <= 0 or share > 100:
+            raise Exception(f'DJ rank tier {tier} must cover between 0 and 100 percent of players!')
+        return tier, share
+
+    def __board(self, game: str, version: int, style: int, category: int) -> SortedIndex[UserID]:
+        return self.__boards.setdefault((game, version, style, category), SortedIndex())
+
+    def update(self, game: str, version: int, userid: UserID, achievementid: int, achievement: ValidatedDict) -> None:
+        points = achievement.get_int_array('point', self.CATEGORIES)
+        for category in range(self.CATEGORIES):
+            board = self.__board(game, version, achievementid, category)
+            if points[category] > 0:
+                board.update(userid, points[category])
+            else:
+                board.remove(userid)
+
+    def reset(self, game: str, version: int) -> None:
+        for key in [key for key in self.__boards if key[:2] == (game, version)]:
+            del self.__boards[key]
+
+    def details(self, game: str, version: int, style: int, userid: UserID) -> List[Dict[str, int]]:
+        """
+        Return the ranking details for every category of a style, as the
+        game expects them in the dj_rank_ranking node.
+        """
+        details: List[Dict[str, int]] = []
+        for category in range(self.CATEGORIES):
+            board = self.__board(game, version, style, category)
+            rank: Optional[int] = board.rank(userid)
+            detail = {
+                'category': category,
+                'total_user': len(board),
+                'rank': rank or 0,
+            }
+            for tier, share in self.tiers:
+                tier_rank = max(1, math.ceil(len(board) * share)) if len(board) > 0 else 0
+                detail[f'{tier}_rank'] = tier_rank
+                detail[f'{tier}_point'] = board.value_at_rank(tier_rank) or 0
+            details.append(detail)
+        return details
+
+
+dj_rank_ranking = DJRankRanking()
@@ -0,0 +1,289 @@
+# vim: set fileencoding=utf-8
+import asyncio
+import json
+import os
+
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple, Type
+
+from core.data import UserID
+
+
+class ScoreImproved(NamedTuple):
+    game: str
+    version: int
+    userid: UserID
+    songid: int
+    chart: int
+    ex_score: int
+    old_ex_score: int
+    clear_status: int
+    location: int
+    arcade: Optional[int]
+
+
+class AttemptRecorded(NamedTuple):
+    game: str
+    version: int
+    userid: Optional[UserID]
+    songid: int
+    chart: int
+    ex_score: int
+    clear_status: int
+    miss_count: int
+    location: int
+    new_record: bool
+    arcade: Optional[int]
+
+
+class DanRaised(NamedTuple):
+    game: str
+    version: int
+    userid: UserID
+    dantype: str
+    rank: int
+    old_rank: int
+
+
+class CourseImproved(NamedTuple):
+    game: str
+    version: int
+    userid: UserID
+    coursetype: str
+    courseid: int
+    chart: int
+    ex_score: int
+    clear_status: int
+
+
+class ConventionImproved(NamedTuple):
+    game: str
+    version: int
+    arcade: int
+    music: List[int]
+    userid: UserID
+    chart: int
+    total: int
+
+
+class ArcadeSettingsChanged(NamedTuple):
+    arcade: int
+    game: str
+    version: int
+    setting: str
+
+
+class MachineChanged(NamedTuple):
+    pcbid: str
+
+
+class ProfileSaved(NamedTuple):
+    game: str
+    version: int
+    userid: UserID
+    name: str
+    extid: int
+
+
+EVENT_TYPES: Dict[str, Type[Any]] = {
+    event.__name__: event
+    for event in [ScoreImproved, AttemptRecorded, DanRaised, CourseImproved, ConventionImproved, ArcadeSettingsChanged, MachineChanged, ProfileSaved]
+}
+
+Handler = Callable[[Any], Awaitable[None]]
+
+
+class Subscription:
+    """
+    One subscriber's bounded queue and the task draining it. When the queue is
+    full the oldest event is dropped to make room, so a slow subscriber loses
+    history instead of holding up publishers.
+    """
+
+    def __init__(self, eventtypes: Iterable[Type[Any]], handler: Handler, maxsize: int) -> None:
+        self.eventtypes = tuple(eventtypes)
+        self.handler = handler
+        self.maxsize = maxsize
+        self.delivered = 0
+        self.dropped = 0
+        self.failed = 0
+        self.__queue: Optional[asyncio.Queue] = None
+        self.__task: Optional[asyncio.Task] = None
+
+    def offer(self, event: Any) -> None:
+        if self.__queue is None:
+            # Created on first use so subscribing doesn't need a running loop
+            self.__queue = asyncio.Queue(self.maxsize)
+            self.__task = asyncio.get_running_loop().create_task(self.__run())
+        if self.__queue.full():
+            self.__queue.get_nowait()
+            self.dropped = self.dropped + 1
+        self.__queue.put_nowait(event)
+
+    async def __run(self) -> None:
+        while True:
+            event = await self.__queue.get()
+            try:
+                await self.handler(event)
+                self.delivered = self.delivered + 1
+            except Exception:
+                # A broken subscriber must not take the others down with it
+                self.failed = self.failed + 1
+
+    def close(self) -> None:
+        if self.__task is not None:
+            self.__task.cancel()
+        self.__task = None
+        self.__queue = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'types': [eventtype.__name__ for eventtype in self.eventtypes],
+            'queued': self.__queue.qsize() if self.__queue is not None else 0,
+            'delivered': self.delivered,
+            'dropped': self.dropped,
+            'failed': self.failed,
+        }
+
+
+class EventBridge(asyncio.DatagramProtocol):
+    """
+    Forwards events between worker processes on the same host over UDP on
+    localhost. Every worker binds the first free port of a small range and
+    sends each local event to the rest of the range, so caches in one worker
+    hear about scores saved by another. Events sent while the port is still
+    being bound are held and sent once it is. Delivery is best effort.
+    """
+
+    BACKLOG_SIZE = 1024
+
+    def __init__(self, bus: 'EventBus', ports: List[int]) -> None:
+        self.bus = bus
+        self.ports = ports
+        self.port: Optional[int] = None
+        self.started = False
+        self.__ready = False
+        self.__transport: Optional[asyncio.DatagramTransport] = None
+        self.__backlog: List[Any] = []
+
+    @staticmethod
+    def parse_ports(spec: str) -> List[int]:
+        """
+        Parse a port range like "47100-47107".
+        """
+        first, _, last = spec.partition('-')
+        return list(range(int(first), int(last or first) + 1))
+
+    async def start(self) -> None:
+        loop = asyncio.get_running_loop()
+        for port in self.ports:
+            try:
+                self.__transport, _ = await loop.create_datagram_endpoint(lambda: self, local_addr=('127.0.0.1', port))
+            except OSError:
+                continue
+            self.port = port
+            break
+        # If every port is taken, this worker stays off the bridge
+        self.__ready = True
+
+        backlog = self.__backlog
+        self.__backlog = []
+        for event in backlog:
+            self.send(event)
+
+    def send(self, event: Any) -> None:
+        if self.__transport is None:
+            if not self.__ready and len(self.__backlog) < self.BACKLOG_SIZE:
+                self.__backlog.append(event)
+            return
+        payload = json.dumps({'type': type(event).__name__, 'event': list(event)}).encode('utf-8')
+        for port in self.ports:
+            if port != self.port:
+                self.__transport.sendto(payload, ('127.0.0.1', port))
+
+    def datagram_received(self, payload: bytes, addr: Tuple[str, int]) -> None:
+        try:
+            message = json.loads(payload)
+            event = EVENT_TYPES[message['type']](*message['event'])
+        except Exception:
+            return
+        self.bus.publish(event, forward=False)
+
+    def close(self) -> None:
+        if self.__transport is not None:
+            self.__transport.close()
+        self.__transport = None
+        self.__backlog = []
+
+
+class EventBus:
+    """
+    In-process publish/subscribe for score, dan, course, convention,
+    machine, arcade settings and profile changes.
+    Publishing never waits on subscribers; each one is fed from its own
+    bounded queue by its own task, off the request path. Set
+    IIDX_EVENT_BRIDGE_PORTS to a localhost port range to also share events
+    between worker processes. A worker joins the bridge as soon as start()
+    is called from its event loop, which subscribing or publishing from a
+    running loop also does, so processes that only listen, like the webui,
+    hear events without having to publish one first.
+    """
+
+    QUEUE_SIZE = 1024
+
+    def __init__(self) -> None:
+        self.__subscriptions: List[Subscription] = []
+        self.__bridge: Optional[EventBridge] = None
+        self.published = 0
+        ports = os.environ.get('IIDX_EVENT_BRIDGE_PORTS')
+        if ports:
+            self.__bridge = EventBridge(self, EventBridge.parse_ports(ports))
+
+    def subscribe(self, eventtypes: Iterable[Type[Any]], handler: Handler, maxsize: Optional[int] = None) -> Subscription:
+        subscription = Subscription(eventtypes, handler, maxsize or self.QUEUE_SIZE)
+        self.__subscriptions.append(subscription)
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            # Subscribed at import time, the bridge starts with the first request
+            return subscription
+        self.start()
+        return subscription
+
+    def start(self) -> None:
+        """
+        Join the bridge if it is enabled and this worker hasn't yet. Must be
+        called from the event loop.
+        """
+        if self.__bridge is not None and not self.__bridge.started:
+            self.__bridge.started = True
+            asyncio.get_running_loop().create_task(self.__bridge.start())
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        if subscription in self.__subscriptions:
+            self.__subscriptions.remove(subscription)
+        subscription.close()
+
+    def publish(self, event: Any, forward: bool = True) -> None:
+        """
+        Hand an event to every interested subscriber, and to the other
+        workers if the bridge is enabled. Must be called from the event loop.
+        """
+        self.published = self.published + 1
+        for subscription in self.__subscriptions:
+            if isinstance(event, subscription.eventtypes):
+                subscription.offer(event)
+
+        if forward and self.__bridge is not None:
+            # Held by the bridge until it is bound, if this is the first event
+            self.start()
+            self.__bridge.send(event)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'published': self.published,
+            'bridge_port': self.__bridge.port if self.__bridge is not None else None,
+            'subscriptions': [subscription.stats() for subscription in self.__subscriptions],
+        }
+
+
+event_bus = EventBus()
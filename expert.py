@@ -0,0 +1,38 @@
+# vim: set fileencoding=utf-8
+from typing import Dict, Tuple
+
+from core.common import ValidatedDict
+from core.data import UserID
+
+from .ranking import AchievementRanking, SortedIndex
+
+
+class ExpertPointRanking(AchievementRanking):
+    """
+    Per-course expert point leaderboards. A player's standing on a course is
+    the sum of their normal, hyper and another points for it.
+    """
+
+    ACHIEVEMENT_TYPE = 'expert_point'
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.__boards: Dict[Tuple[str, int, int], SortedIndex[UserID]] = {}
+
+    def update(self, game: str, version: int, userid: UserID, achievementid: int, achievement: ValidatedDict) -> None:
+        points = (
+            achievement.get_int('normal_points') +
+            achievement.get_int('hyper_points') +
+            achievement.get_int('another_points')
+        )
+        self.leaderboard(game, version, achievementid).update(userid, points)
+
+    def reset(self, game: str, version: int) -> None:
+        for key in [key for key in self.__boards if key[:2] == (game, version)]:
+            del self.__boards[key]
+
+    def leaderboard(self, game: str, version: int, courseid: int) -> SortedIndex[UserID]:
+        return self.__boards.setdefault((game, version, courseid), SortedIndex())
+
+
+expert_point_ranking = ExpertPointRanking()
@@ -0,0 +1,199 @@
+# vim: set fileencoding=utf-8
+import csv
+import io
+import json
+
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+from core.common import DBConstants
+from core.data import Data, UserID
+
+from .cache import profile_directory
+
+
+class ScoreExport:
+    """
+    Streams a version's high scores or attempt history as NDJSON or CSV rows.
+    Storage has no server side cursors, so rows are pulled one player at a
+    time, walking the profile directory, which keeps memory bounded by the
+    largest single player rather than by the whole network. Each player's
+    omnimix rows follow their plain ones, flagged in the omnimix column.
+    """
+
+    GAME = 'iidx'
+
+    KIND_SCORES = 'scores'
+    KIND_ATTEMPTS = 'attempts'
+
+    FORMAT_NDJSON = 'ndjson'
+    FORMAT_CSV = 'csv'
+
+    MEDIA_TYPES = {
+        FORMAT_NDJSON: 'application/x-ndjson',
+        FORMAT_CSV: 'text/csv',
+    }
+
+    FIELDS = {
+        KIND_SCORES: [
+            'userid', 'extid', 'name', 'omnimix', 'songid', 'chart', 'ex_score', 'pgreats', 'greats', 'clear_status',
+            'miss_count', 'plays', 'timestamp', 'update', 'location', 'shop', 'ghost',
+        ],
+        KIND_ATTEMPTS: [
+            'userid', 'extid', 'name', 'omnimix', 'songid', 'chart', 'ex_score', 'clear_status', 'miss_count',
+            'new_record', 'timestamp', 'location', 'shop', 'ghost',
+        ],
+    }
+
+    # Players fetched from the profile directory at a time
+    USER_BATCH = 100
+
+    def __init__(
+        self,
+        version: int,
+        kind: str,
+        fmt: str,
+        userid: Optional[UserID] = None,
+        songid: Optional[int] = None,
+        chart: Optional[int] = None,
+        since: Optional[int] = None,
+        until: Optional[int] = None,
+        ghost: bool = False,
+    ) -> None:
+        if kind not in self.FIELDS:
+            raise Exception(f"Invalid export kind {kind}")
+        if fmt not in self.MEDIA_TYPES:
+            raise Exception(f"Invalid export format {fmt}")
+        self.version = version
+        self.kind = kind
+        self.fmt = fmt
+        self.userid = userid
+        self.songid = songid
+        self.chart = chart
+        self.since = since
+        self.until = until
+        self.ghost = ghost
+
+    @property
+    def media_type(self) -> str:
+        return self.MEDIA_TYPES[self.fmt]
+
+    @property
+    def fields(self) -> List[str]:
+        if self.ghost:
+            return self.FIELDS[self.kind]
+        return [field for field in self.FIELDS[self.kind] if field != 'ghost']
+
+    def __in_range(self, timestamp: int) -> bool:
+        if self.since is not None and timestamp < self.since:
+            return False
+        if self.until is not None and timestamp >= self.until:
+            return False
+        return True
+
+    async def __users(self, data: Data) -> AsyncIterator[List[Tuple[UserID, str, int]]]:
+        if self.userid is not None:
+            profile = await data.local.user.get_profile(self.GAME, self.version, self.userid)
+            if profile is not None:
+                yield [(self.userid, profile.get('name', ''), profile.get_int('extid'))]
+            return
+
+        cursor: Optional[UserID] = None
+        while True:
+            page, cursor = await profile_directory.page(data, self.GAME, self.version, cursor, self.USER_BATCH)
+            if page:
+                yield page
+            if cursor is None:
+                return
+
+    async def __user_rows(self, data: Data, userid: UserID, name: str, extid: int, omnimix: bool) -> List[Dict[str, Any]]:
+        # Omnimix scores are kept apart, but share their profiles with the plain version
+        version = DBConstants.OMNIMIX_VERSION_BUMP + self.version if omnimix else self.version
+
+        rows: List[Dict[str, Any]] = []
+        if self.kind == self.KIND_SCORES:
+            scores = await data.local.music.get_all_scores(
+                game=self.GAME,
+                version=version,
+                userid=userid,
+                songid=self.songid,
+                songchart=self.chart,
+            )
+            for _, score in scores:
+                if not self.__in_range(score.update):
+                    continue
+                rows.append({
+                    'userid': userid,
+                    'extid': extid,
+                    'name': name,
+                    'omnimix': int(omnimix),
+                    'songid': score.id,
+                    'chart': score.chart,
+                    'ex_score': score.points,
+                    'pgreats': score.data.get_int('pgreats'),
+                    'greats': score.data.get_int('greats'),
+                    'clear_status': score.data.get_int('clear_status'),
+                    'miss_count': score.data.get_int('miss_count', -1),
+                    'plays': score.plays,
+                    'timestamp': score.timestamp,
+                    'update': score.update,
+                    'location': score.location,
+                    'shop': score.data.get_int('shop'),
+                    'ghost': score.data.get_bytes('ghost').hex() if self.ghost else None,
+                })
+        else:
+            attempts = await data.local.music.get_all_attempts(
+                game=self.GAME,
+                version=version,
+                userid=userid,
+                songid=self.songid,
+                songchart=self.chart,
+            )
+            for _, attempt in attempts:
+                if not self.__in_range(attempt.timestamp):
+                    continue
+                rows.append({
+                    'userid': userid,
+                    'extid': extid,
+                    'name': name,
+                    'omnimix': int(omnimix),
+                    'songid': attempt.id,
+                    'chart': attempt.chart,
+                    'ex_score': attempt.points,
+                    'clear_status': attempt.data.get_int('clear_status'),
+                    'miss_count': attempt.data.get_int('miss_count', -1),
+                    'new_record': attempt.new_record,
+                    'timestamp': attempt.timestamp,
+                    'location': attempt.location,
+                    'shop': attempt.data.get_int('shop'),
+                    'ghost': attempt.data.get_bytes('ghost').hex() if self.ghost else None,
+                })
+        return rows
+
+    def __encode(self, rows: List[Dict[str, Any]]) -> str:
+        fields = self.fields
+        if self.fmt == self.FORMAT_NDJSON:
+            return ''.join(
+                json.dumps({field: row[field] for field in fields}, ensure_ascii=False) + '\n'
+                for row in rows
+            )
+
+        out = io.StringIO()
+        writer = csv.writer(out)
+        writer.writerows([[row[field] for field in fields] for row in rows])
+        return out.getvalue()
+
+    async def stream(self, data: Data) -> AsyncIterator[str]:
+        """
+        Yield the export in chunks of one player's rows at a time.
+        """
+        if self.fmt == self.FORMAT_CSV:
+            out = io.StringIO()
+            csv.writer(out).writerow(self.fields)
+            yield out.getvalue()
+
+        async for page in self.__users(data):
+            for userid, name, extid in page:
+                for omnimix in [False, True]:
+                    rows = await self.__user_rows(data, userid, name, extid, omnimix)
+                    if rows:
+                        yield self.__encode(rows)
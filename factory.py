@@ -1,10 +1,10 @@
-import os
+import bisect
+import importlib
 
-from typing import Dict, Optional, Any
+from typing import Callable, Dict, List, Optional, Any, Sequence, Tuple, Type
 
 from core.base import Base, Factory
 
-from .handlers.bistrover import IIDXBistrover
 from core.common import Model, VersionConstants
 from core.data import Data
 
@@ -13,10 +13,45 @@ MANAGED_VERSION = [
 ]
 
 
+class ManagedClasses(Sequence):
+    """
+    Stands in for a factory's MANAGED_CLASSES list, importing every handler
+    the first time core walks it for scheduled work or settings, rather than
+    when the plugin is imported or registered.
+    """
+
+    def __init__(self, load: Callable[[], List[Type[Base]]]) -> None:
+        self.__load = load
+        self.__classes: Optional[List[Type[Base]]] = None
+
+    def __get(self) -> List[Type[Base]]:
+        if self.__classes is None:
+            self.__classes = self.__load()
+        return self.__classes
+
+    def __getitem__(self, index: Any) -> Any:
+        return self.__get()[index]
+
+    def __len__(self) -> int:
+        return len(self.__get())
+
+
 class IIDXFactory(Factory):
-    MANAGED_CLASSES = [
-        IIDXBistrover,
+    MANAGED_CLASSES: Sequence[Type[Base]] = ManagedClasses(lambda: IIDXFactory.load_all())
+
+    # Where the handler for each version lives, imported on first use
+    VERSION_HANDLERS: Dict[int, Tuple[str, str]] = {
+        VersionConstants.IIDX_BISTROVER: ('.handlers.bistrover', 'IIDXBistrover'),
+    }
+
+    # First datecode of every version, oldest first. The newest version is
+    # assumed for anything dated after it.
+    VERSION_DATES: List[Tuple[int, int]] = [
+        (2020102800, VersionConstants.IIDX_BISTROVER),
     ]
+    VERSION_CLASSES: Dict[int, Type[Base]] = {}
+
+    __date_starts: List[int] = [date for date, _ in VERSION_DATES]
 
     @classmethod
     def register_all(cls) -> None:
@@ -24,12 +59,37 @@ class IIDXFactory(Factory):
             Base.register(game, IIDXFactory)
 
     @classmethod
-    def create(cls, data: Data, config: Dict[str, Any], model: Model, parentmodel: Optional[Model] = None) -> Optional[Base]:
-        def version_from_date(date: int) -> Optional[int]:
-            if date >= 2020102800:
-                return VersionConstants.IIDX_BISTROVER
+    def handler_for(cls, version: Optional[int]) -> Optional[Type[Base]]:
+        """
+        Return the handler class for a version, importing its module the
+        first time it is asked for.
+        """
+        handler = cls.VERSION_CLASSES.get(version)
+        if handler is None:
+            location = cls.VERSION_HANDLERS.get(version)
+            if location is None:
+                return None
+            module, name = location
+            handler = getattr(importlib.import_module(module, __package__), name)
+            cls.VERSION_CLASSES[version] = handler
+        return handler
+
+    @classmethod
+    def load_all(cls) -> List[Type[Base]]:
+        """
+        Import every handler, for work that has to visit all of them.
+        """
+        return [cls.handler_for(version) for version in cls.VERSION_HANDLERS]
+
+    @classmethod
+    def version_from_date(cls, date: int) -> Optional[int]:
+        index = bisect.bisect_right(cls.__date_starts, date) - 1
+        if index < 0:
             return None
+        return cls.VERSION_DATES[index][1]
 
+    @classmethod
+    def create(cls, data: Data, config: Dict[str, Any], model: Model, parentmodel: Optional[Model] = None) -> Optional[Base]:
         if model.game == 'LDJ':
             if model.version is None:
                 if parentmodel is None:
@@ -39,16 +99,13 @@ class IIDXFactory(Factory):
                 # an educated guess if we happen to be summoned for old profile lookup.
                 if parentmodel.game not in ['LDJ']:
                     return None
-                parentversion = version_from_date(parentmodel.version)
-                if parentversion == VersionConstants.IIDX_BISTROVER:
-                    return IIDXBistrover(data, config, model)
-
-                # Unknown older version
-                return None
+                version = cls.version_from_date(parentmodel.version)
+            else:
+                version = cls.version_from_date(model.version)
 
-            version = version_from_date(model.version)
-            if version == VersionConstants.IIDX_BISTROVER:
-                return IIDXBistrover(data, config, model)
+            handler = cls.handler_for(version)
+            if handler is not None:
+                return handler(data, config, model)
 
         # Unknown game version
         return None
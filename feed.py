@@ -0,0 +1,157 @@
+# vim: set fileencoding=utf-8
+import asyncio
+import json
+
+from collections import OrderedDict
+from typing import Any, AsyncIterator, Dict, Hashable, List, Optional, Set
+
+from core.common import DBConstants
+from core.data import Data, UserID
+
+from .cache import LRUCache
+from .events import AttemptRecorded, ScoreImproved, event_bus
+
+
+class FeedClient:
+    """
+    One connected browser. Messages wait in a small buffer keyed by what they
+    are about, so a newer message for the same player and chart replaces the
+    one still waiting, and once the buffer is full the oldest message is
+    dropped. A slow browser therefore sees the latest plays instead of
+    falling further and further behind.
+    """
+
+    def __init__(self, arcade: Optional[int], version: Optional[int], maxsize: int) -> None:
+        self.arcade = arcade
+        self.version = version
+        self.maxsize = maxsize
+        self.coalesced = 0
+        self.dropped = 0
+        self.__pending: 'OrderedDict[Hashable, Dict[str, Any]]' = OrderedDict()
+        self.__ready = asyncio.Event()
+
+    def wants(self, event: Any) -> bool:
+        if self.arcade is not None and event.arcade != self.arcade:
+            return False
+        if self.version is not None and event.version != self.version:
+            return False
+        return True
+
+    def offer(self, key: Hashable, message: Dict[str, Any]) -> None:
+        if key in self.__pending:
+            self.coalesced = self.coalesced + 1
+        self.__pending[key] = message
+        self.__pending.move_to_end(key)
+        while len(self.__pending) > self.maxsize:
+            self.__pending.popitem(last=False)
+            self.dropped = self.dropped + 1
+        self.__ready.set()
+
+    async def take(self, timeout: float) -> List[Dict[str, Any]]:
+        """
+        Wait up to timeout seconds for messages and return everything waiting.
+        """
+        try:
+            await asyncio.wait_for(self.__ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            return []
+        self.__ready.clear()
+        messages = list(self.__pending.values())
+        self.__pending.clear()
+        return messages
+
+
+class LiveFeed:
+    """
+    Server-sent event feed of plays and new records for the webui's live
+    screen. A single event bus subscription fans every play out to all
+    connected browsers, each optionally limited to one arcade.
+    """
+
+    CLIENT_BUFFER = 50
+    KEEPALIVE = 15.0
+
+    def __init__(self) -> None:
+        self.__clients: Set[FeedClient] = set()
+        self.__names: LRUCache[str] = LRUCache(4096, 600.0)
+        event_bus.subscribe([ScoreImproved, AttemptRecorded], self.__publish)
+
+    async def __publish(self, event: Any) -> None:
+        if isinstance(event, ScoreImproved):
+            kind = 'record'
+            message = {
+                'userid': event.userid,
+                'songid': event.songid,
+                'chart': event.chart,
+                'ex_score': event.ex_score,
+                'old_ex_score': event.old_ex_score,
+                'clear_status': event.clear_status,
+            }
+        else:
+            if event.userid is None:
+                # Anonymous plays have nobody to show
+                return
+            kind = 'play'
+            message = {
+                'userid': event.userid,
+                'songid': event.songid,
+                'chart': event.chart,
+                'ex_score': event.ex_score,
+                'clear_status': event.clear_status,
+                'miss_count': event.miss_count,
+            }
+        message['type'] = kind
+        message['version'] = event.version
+        message['arcade'] = event.arcade
+
+        key = (kind, event.userid, event.songid, event.chart)
+        for client in self.__clients:
+            if client.wants(event):
+                client.offer(key, message)
+
+    async def __name(self, data: Data, version: int, userid: UserID) -> str:
+        # Plays carry the music version, omnimix plays share the plain version's profiles
+        if version >= DBConstants.OMNIMIX_VERSION_BUMP:
+            version = version - DBConstants.OMNIMIX_VERSION_BUMP
+
+        name = self.__names.get((version, userid))
+        if name is None:
+            profile = await data.local.user.get_profile('iidx', version, userid)
+            name = profile.get('name', '') if profile is not None else ''
+            self.__names.put((version, userid), name)
+        return name
+
+    async def stream(self, data: Data, arcade: Optional[int], version: Optional[int]) -> AsyncIterator[str]:
+        """
+        Yield server-sent events for one browser until it disconnects.
+        """
+        # This process may never publish a play itself, so join the bridge to hear them
+        event_bus.start()
+        client = FeedClient(arcade, version, self.CLIENT_BUFFER)
+        self.__clients.add(client)
+        try:
+            yield 'retry: 5000\n\n'
+            while True:
+                messages = await client.take(self.KEEPALIVE)
+                if not messages:
+                    # Keeps proxies from closing an idle connection
+                    yield ': keepalive\n\n'
+                    continue
+
+                chunks = []
+                for message in messages:
+                    message = dict(message, name=await self.__name(data, message['version'], message['userid']))
+                    chunks.append(f'event: {message["type"]}\ndata: {json.dumps(message, ensure_ascii=False)}\n\n')
+                yield ''.join(chunks)
+        finally:
+            self.__clients.discard(client)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'clients': len(self.__clients),
+            'coalesced': sum(client.coalesced for client in self.__clients),
+            'dropped': sum(client.dropped for client in self.__clients),
+        }
+
+
+live_feed = LiveFeed()
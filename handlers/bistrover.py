@@ -1,4 +1,5 @@
 # vim: set fileencoding=utf-8
+import asyncio
 import copy
 import random
 import struct
@@ -6,6 +7,11 @@ from typing import Optional, Dict, Any, List, Tuple
 
 from ..course import IIDXCourse
 from ..base import IIDXBase
+from ..cache import arcade_settings, retry_responses, time_sensitive_settings
+from ..djrank import dj_rank_ranking
+from ..expert import expert_point_ranking
+from ..radar import notes_radar_ranking
+from ..locks import profile_locks
 
 from core.common import ValidatedDict, VersionConstants, Time, ID, intish
 from core.data import Data, UserID, Score
@@ -93,10 +99,75 @@ class IIDXBistrover(IIDXCourse, IIDXBase):
     GAME_CHART_TYPE_A14 = 8
     GAME_CHART_TYPE_L14 = 9
 
+    # Classic courses are sent by ranking classicentry instead
+    GAME_COURSE_TYPE_INTERNET_RANKING = 0
+    GAME_COURSE_TYPE_SECRET = 1
+
     FAVORITE_LIST_LENGTH = 20
 
+    DAILIES_WEEKS_AHEAD = 4
+
     def previous_version(self) -> Optional[IIDXBase]:
-        return IIDXBistrover(self.data, self.config, self.model)
+        # No older version is served by this plugin, so old profile lookups
+        # stay on this version and there is no need for a second handler.
+        return self
+
+    @classmethod
+    async def run_scheduled_work(cls, data: Data, config: Dict[str, Any]) -> List[Tuple[str, Dict[str, Any]]]:
+        """
+        Once a week, make sure daily recommendations are scheduled for the
+        weeks ahead.
+        """
+        events = []
+        if await data.local.network.should_schedule(cls.game, cls.version, 'daily_charts', 'weekly'):
+            days = await cls.schedule_dailies(data, cls.DAILIES_WEEKS_AHEAD)
+            await data.local.network.mark_scheduled(cls.game, cls.version, 'daily_charts', 'weekly')
+            if days > 0:
+                events.append((
+                    'iidx_dailies',
+                    {
+                        'version': cls.version,
+                        'days': days,
+                    },
+                ))
+        return events
+
+    @classmethod
+    async def schedule_dailies(cls, data: Data, weeks: int) -> int:
+        """
+        Pre-schedule three daily recommended songs for every day in the given
+        number of weeks that doesn't have them yet. Each day's songs are picked
+        with the day number as the seed, so rerunning this never reshuffles a
+        day. Returns the number of days that were scheduled.
+        """
+        all_songs = sorted({song.id for song in await data.local.music.get_all_songs(cls.game, cls.version)})
+        if len(all_songs) < 3:
+            return 0
+
+        scheduled = {
+            int(entry['start_time'] / 86400) for entry in
+            await data.local.game.get_all_time_sensitive_settings(cls.game, cls.version, 'dailies')
+        }
+        today = int(Time.now() / 86400)
+        days = [day for day in range(today, today + (weeks * 7)) if day not in scheduled]
+
+        # Core can only write one schedule entry at a time, so write a week's
+        # worth together and leave the rest of the connection pool to requests
+        for start in range(0, len(days), 7):
+            await asyncio.gather(*[
+                data.local.game.put_time_sensitive_settings(
+                    cls.game,
+                    cls.version,
+                    'dailies',
+                    {
+                        'start_time': day * 86400,
+                        'end_time': (day + 1) * 86400,
+                        'music': random.Random(day).sample(all_songs, 3),
+                    },
+                )
+                for day in days[start:(start + 7)]
+            ])
+        return len(days)
 
     def game_to_db_chart(self, db_chart: int) -> int:
         return {
@@ -326,7 +397,7 @@ class IIDXBistrover(IIDXCourse, IIDXBase):
         return [scorestruct[s] for s in scorestruct]
 
     async def handle_IIDX28shop_getname_request(self, request: Node) -> Node:
-        machine = await self.data.local.machine.get_machine(self.config['machine']['pcbid'])
+        machine = await self.get_current_machine()
         if machine is not None:
             machine_name = machine.name
             close = machine.data.get_bool('close')
@@ -371,13 +442,10 @@ class IIDXBistrover(IIDXCourse, IIDXBase):
 
     async def handle_IIDX28shop_getconvention_request(self, request: Node) -> Node:
         root = Node.void('IIDX28shop')
-        machine = await self.data.local.machine.get_machine(self.config['machine']['pcbid'])
-        if machine.arcade is not None:
-            course = await self.data.local.machine.get_settings(machine.arcade, self.game, self.music_version, 'shop_course')
+        machine = await self.get_current_machine()
+        if machine is not None and machine.arcade is not None:
+            course = await arcade_settings.get(self.data, machine.arcade, self.game, self.music_version, 'shop_course')
         else:
-            course = None
-
-        if course is None:
             course = ValidatedDict()
 
         root.set_attribute('music_0', str(course.get_int('music_0', 20032)))
@@ -388,18 +456,78 @@ class IIDXBistrover(IIDXCourse, IIDXBase):
         return root
 
     async def handle_IIDX28shop_setconvention_request(self, request: Node) -> Node:
-        machine = await self.data.local.machine.get_machine(self.config['machine']['pcbid'])
-        if machine.arcade is not None:
+        machine = await self.get_current_machine()
+        if machine is not None and machine.arcade is not None:
             course = ValidatedDict()
             course.replace_int('music_0', request.child_value('music_0'))
             course.replace_int('music_1', request.child_value('music_1'))
             course.replace_int('music_2', request.child_value('music_2'))
             course.replace_int('music_3', request.child_value('music_3'))
             course.replace_bool('valid', request.child_value('valid'))
-            await self.data.local.machine.put_settings(machine.arcade, self.game, self.music_version, 'shop_course', course)
+            await arcade_settings.put(self.data, machine.arcade, self.game, self.music_version, 'shop_course', course)
 
         return Node.void('IIDX28shop')
 
+    async def handle_IIDX28ranking_entry_request(self, request: Node) -> Node:
+        extid = int(request.attribute('iidxid'))
+        courseid = int(request.attribute('coid'))
+        chart = self.game_to_db_chart(int(request.attribute('clid')))
+        course_type = int(request.attribute('regist_type'))
+        clear_status = self.game_to_db_status(int(request.attribute('clr')))
+        pgreats = int(request.attribute('pgnum'))
+        greats = int(request.attribute('gnum'))
+
+        coursetype = {
+            self.GAME_COURSE_TYPE_INTERNET_RANKING: self.COURSE_TYPE_INTERNET_RANKING,
+            self.GAME_COURSE_TYPE_SECRET: self.COURSE_TYPE_SECRET,
+        }.get(course_type)
+        if coursetype is None:
+            raise Exception(f'Unknown registration type {course_type} for course entry!')
+
+        userid = await self.data.local.user.from_extid(self.game, self.version, extid)
+        if userid is not None:
+            await self.update_course(
+                userid,
+                coursetype,
+                courseid,
+                chart,
+                clear_status,
+                pgreats,
+                greats,
+            )
+
+        # Report where this player now stands on the course
+        leaderboard = await self.get_course_leaderboard(coursetype, courseid, chart)
+        rank = leaderboard.rank(userid) if userid is not None else None
+
+        root = Node.void('IIDX28ranking')
+        root.set_attribute('anum', str(len(leaderboard)))
+        root.set_attribute('jun', str(rank or 0))
+        return root
+
+    async def handle_IIDX28ranking_classicentry_request(self, request: Node) -> Node:
+        extid = int(request.attribute('iidx_id'))
+        courseid = int(request.attribute('course_id'))
+        coursestyle = int(request.attribute('play_style'))
+        clear_status = self.game_to_db_status(int(request.attribute('clear_flg')))
+        pgreats = int(request.attribute('pgnum'))
+        greats = int(request.attribute('gnum'))
+
+        userid = await self.data.local.user.from_extid(self.game, self.version, extid)
+        if userid is not None:
+            # Classic courses are tracked per play style rather than per chart
+            await self.update_course(
+                userid,
+                self.COURSE_TYPE_CLASSIC,
+                courseid,
+                coursestyle,
+                clear_status,
+                pgreats,
+                greats,
+            )
+
+        return Node.void('IIDX28ranking')
+
     async def handle_IIDX28ranking_getranker_request(self, request: Node) -> Node:
         root = Node.void('IIDX28ranking')
 
@@ -445,7 +573,7 @@ class IIDXBistrover(IIDXCourse, IIDXBase):
                 # Grab most played for user/rival
                 most_played = [
                     play[0] for play in
-                    await self.data.local.music.get_most_played(self.game, self.music_version, userid, 20)
+                    await self.play_counts.get_most_played(userid, 20)
                 ]
                 if len(most_played) < 20:
                     most_played.extend([0] * (20 - len(most_played)))
@@ -507,6 +635,16 @@ class IIDXBistrover(IIDXCourse, IIDXBase):
         return root
 
     async def handle_IIDX28music_reg_request(self, request: Node) -> Node:
+        # Cabinets retry this on network hiccups, don't save the score twice,
+        # even when the retry arrives before the first attempt has finished
+        retry_key = retry_responses.key(self.config['machine']['pcbid'], request)
+        return await retry_responses.once(retry_key, lambda: self.register_score(request))
+
+    async def register_score(self, request: Node) -> Node:
+        """
+        Save a score sent by music_reg and build the response with the
+        player's standing on the song.
+        """
         extid = int(request.attribute('iidxid'))
         musicid = int(request.attribute('mid'))
         game_chart = int(request.attribute('clid'))
@@ -730,11 +868,12 @@ class IIDXBistrover(IIDXCourse, IIDXBase):
 
         userid = await self.data.local.user.from_extid(self.game, self.version, extid)
         if userid is not None:
-            profile = self.get_profile(userid)
-            if profile is None:
-                profile = ValidatedDict()
-            profile.replace_int('shop_location', location)
-            await self.put_profile(userid, profile)
+            async with profile_locks.hold(userid):
+                profile = await self.get_profile(userid)
+                if profile is None:
+                    profile = ValidatedDict()
+                profile.replace_int('shop_location', location)
+                await self.put_profile_keeping_settings(userid, profile)
 
         root = Node.void('IIDX28pc')
         return root
@@ -744,7 +883,7 @@ class IIDXBistrover(IIDXCourse, IIDXBase):
         userid = await self.data.local.user.from_refid(self.game, self.version, refid)
         if userid is not None:
             oldversion = self.previous_version()
-            profile = oldversion.get_profile(userid)
+            profile = await oldversion.get_profile(userid)
         else:
             profile = None
 
@@ -805,10 +944,16 @@ class IIDXBistrover(IIDXCourse, IIDXBase):
         return root
 
     async def handle_IIDX28pc_save_request(self, request: Node) -> Node:
-        extid = int(request.attribute('iidxid'))
-        await self.put_profile_by_extid(extid, request)
+        # Cabinets retry this on network hiccups, don't add deller twice,
+        # even when the retry arrives before the first attempt has finished
+        retry_key = retry_responses.key(self.config['machine']['pcbid'], request)
 
-        return Node.void('IIDX28pc')
+        async def save() -> Node:
+            extid = int(request.attribute('iidxid'))
+            await self.put_profile_by_extid(extid, request)
+            return Node.void('IIDX28pc')
+
+        return await retry_responses.once(retry_key, save)
 
     async def handle_IIDX28pc_logout_request(self, request: Node) -> Node:
         return Node.void('IIDX28pc')
@@ -918,22 +1063,26 @@ class IIDXBistrover(IIDXCourse, IIDXBase):
         root.add_child(grade)
         grade.set_attribute('sgid', str(self.db_to_game_rank(profile.get_int(self.DAN_RANKING_SINGLE, -1), self.GAME_CLTYPE_SINGLE)))
         grade.set_attribute('dgid', str(self.db_to_game_rank(profile.get_int(self.DAN_RANKING_DOUBLE, -1), self.GAME_CLTYPE_DOUBLE)))
-        achievements = await self.data.local.user.get_achievements(self.game, self.version, userid)
-        for rank in achievements:
-            if rank.type == self.DAN_RANKING_SINGLE:
-                grade.add_child(Node.u8_array('g', [
-                    self.GAME_CLTYPE_SINGLE,
-                    self.db_to_game_rank(rank.id, self.GAME_CLTYPE_SINGLE),
-                    rank.data.get_int('stages_cleared'),
-                    rank.data.get_int('percent'),
-                ]))
-            if rank.type == self.DAN_RANKING_DOUBLE:
-                grade.add_child(Node.u8_array('g', [
-                    self.GAME_CLTYPE_DOUBLE,
-                    self.db_to_game_rank(rank.id, self.GAME_CLTYPE_DOUBLE),
-                    rank.data.get_int('stages_cleared'),
-                    rank.data.get_int('percent'),
-                ]))
+
+        # Load achievements once, partitioned by type for the sections below
+        achievements: Dict[str, List[Any]] = {}
+        for achievement in await self.data.local.user.get_achievements(self.game, self.version, userid):
+            achievements.setdefault(achievement.type, []).append(achievement)
+
+        for rank in achievements.get(self.DAN_RANKING_SINGLE, []):
+            grade.add_child(Node.u8_array('g', [
+                self.GAME_CLTYPE_SINGLE,
+                self.db_to_game_rank(rank.id, self.GAME_CLTYPE_SINGLE),
+                rank.data.get_int('stages_cleared'),
+                rank.data.get_int('percent'),
+            ]))
+        for rank in achievements.get(self.DAN_RANKING_DOUBLE, []):
+            grade.add_child(Node.u8_array('g', [
+                self.GAME_CLTYPE_DOUBLE,
+                self.db_to_game_rank(rank.id, self.GAME_CLTYPE_DOUBLE),
+                rank.data.get_int('stages_cleared'),
+                rank.data.get_int('percent'),
+            ]))
 
         # User settings
         settings_dict = profile.get_dict('settings')
@@ -982,10 +1131,7 @@ class IIDXBistrover(IIDXCourse, IIDXBase):
         root.add_child(rlist)
 
         # DJ RANK
-        for dj_rank in achievements:
-            if dj_rank.type != 'dj_rank':
-                continue
-
+        for dj_rank in achievements.get('dj_rank', []):
             dj_rank_node = Node.void('dj_rank')
             root.add_child(dj_rank_node)
             dj_rank_node.set_attribute('style', str(dj_rank.id))
@@ -993,54 +1139,34 @@ class IIDXBistrover(IIDXCourse, IIDXBase):
             dj_rank_node.add_child(Node.s32_array('point', dj_rank.data.get_int_array('point', 15)))
 
         # notes radar saving
-        for notes_radar in achievements:
-            if notes_radar.type != 'notes_radar':
-                continue
-
+        for notes_radar in achievements.get('notes_radar', []):
             notes_radar_node = Node.void('notes_radar')
             root.add_child(notes_radar_node)
             notes_radar_node.set_attribute('style', str(notes_radar.id))
             notes_radar_node.add_child(Node.s32_array('radar_score', notes_radar.data.get_int_array('radar_score', 6)))
 
-        dj_rank_ranking_node = Node.void('dj_rank_ranking')
-        root.add_child(dj_rank_ranking_node)
-        dj_rank_ranking_node.set_attribute('style', '0')
-        for j in range(15):
-            detail = Node.void('detail')
-            dj_rank_ranking_node.add_child(detail)
-            detail.set_attribute('category', str(j))
-            detail.set_attribute('total_user', '0')
-            detail.set_attribute('rank', '0')
-            detail.set_attribute('platinum_point', '0')
-            detail.set_attribute('platinum_rank', '0')
-            detail.set_attribute('gold_point', '0')
-            detail.set_attribute('gold_rank', '0')
-            detail.set_attribute('silver_point', '0')
-            detail.set_attribute('silver_rank', '0')
-            detail.set_attribute('bronze_point', '0')
-            detail.set_attribute('bronze_rank', '0')
-            detail.set_attribute('white_point', '0')
-            detail.set_attribute('white_rank', '0')
-
-        dj_rank_ranking_node = Node.void('dj_rank_ranking')
-        root.add_child(dj_rank_ranking_node)
-        dj_rank_ranking_node.set_attribute('style', '1')
-        for j in range(15):
-            detail = Node.void('detail')
-            dj_rank_ranking_node.add_child(detail)
-            detail.set_attribute('category', str(j))
-            detail.set_attribute('total_user', '0')
-            detail.set_attribute('rank', '0')
-            detail.set_attribute('platinum_point', '0')
-            detail.set_attribute('platinum_rank', '0')
-            detail.set_attribute('gold_point', '0')
-            detail.set_attribute('gold_rank', '0')
-            detail.set_attribute('silver_point', '0')
-            detail.set_attribute('silver_rank', '0')
-            detail.set_attribute('bronze_point', '0')
-            detail.set_attribute('bronze_rank', '0')
-            detail.set_attribute('white_point', '0')
-            detail.set_attribute('white_rank', '0')
+        # Network-wide DJ rank standings
+        await dj_rank_ranking.load(self.data, self.game, self.version)
+        for style in [self.GAME_CLTYPE_SINGLE, self.GAME_CLTYPE_DOUBLE]:
+            dj_rank_ranking_node = Node.void('dj_rank_ranking')
+            root.add_child(dj_rank_ranking_node)
+            dj_rank_ranking_node.set_attribute('style', str(style))
+            for ranking in dj_rank_ranking.details(self.game, self.version, style, userid):
+                detail = Node.void('detail')
+                dj_rank_ranking_node.add_child(detail)
+                detail.set_attribute('category', str(ranking['category']))
+                detail.set_attribute('total_user', str(ranking['total_user']))
+                detail.set_attribute('rank', str(ranking['rank']))
+                detail.set_attribute('platinum_point', str(ranking['platinum_point']))
+                detail.set_attribute('platinum_rank', str(ranking['platinum_rank']))
+                detail.set_attribute('gold_point', str(ranking['gold_point']))
+                detail.set_attribute('gold_rank', str(ranking['gold_rank']))
+                detail.set_attribute('silver_point', str(ranking['silver_point']))
+                detail.set_attribute('silver_rank', str(ranking['silver_rank']))
+                detail.set_attribute('bronze_point', str(ranking['bronze_point']))
+                detail.set_attribute('bronze_rank', str(ranking['bronze_rank']))
+                detail.set_attribute('white_point', str(ranking['white_point']))
+                detail.set_attribute('white_rank', str(ranking['white_rank']))
 
         tonyutsu = Node.void('tonyutsu')
         tonyutsu_dict = profile.get_dict('tonyutsu')
@@ -1060,7 +1186,7 @@ class IIDXBistrover(IIDXCourse, IIDXBase):
                 join_shop.set_attribute('join_name', machine.name)
 
         # Daily recommendations
-        entry = await self.data.local.game.get_time_sensitive_settings(self.game, self.version, 'dailies')
+        entry = await time_sensitive_settings.get(self.data, self.game, self.version, 'dailies')
         if entry is not None:
             packinfo = Node.void('packinfo')
             root.add_child(packinfo)
@@ -1083,9 +1209,10 @@ class IIDXBistrover(IIDXCourse, IIDXBase):
             achievement_node.set_attribute('pack', '0')
             achievement_node.set_attribute('pack_comp', '0')
         else:
-            daily_played = await self.data.local.user.get_achievement(self.game, self.version, userid, pack_id, 'daily')
-            if daily_played is None:
-                daily_played = ValidatedDict()
+            daily_played = ValidatedDict()
+            for daily in achievements.get('daily', []):
+                if daily.id == pack_id:
+                    daily_played = daily.data
             achievement_node.set_attribute('pack', str(daily_played.get_int('pack_flg')))
             achievement_node.set_attribute('pack_comp', str(daily_played.get_int('pack_comp')))
 
@@ -1111,14 +1238,13 @@ class IIDXBistrover(IIDXCourse, IIDXBase):
         # Expert points
         expert_point = Node.void('expert_point')
         root.add_child(expert_point)
-        for rank in achievements:
-            if rank.type == 'expert_point':
-                detail = Node.void('detail')
-                expert_point.add_child(detail)
-                detail.set_attribute('course_id', str(rank.id))
-                detail.set_attribute('n_point', str(rank.data.get_int('normal_points')))
-                detail.set_attribute('h_point', str(rank.data.get_int('hyper_points')))
-                detail.set_attribute('a_point', str(rank.data.get_int('another_points')))
+        for rank in achievements.get('expert_point', []):
+            detail = Node.void('detail')
+            expert_point.add_child(detail)
+            detail.set_attribute('course_id', str(rank.id))
+            detail.set_attribute('n_point', str(rank.data.get_int('normal_points')))
+            detail.set_attribute('h_point', str(rank.data.get_int('hyper_points')))
+            detail.set_attribute('a_point', str(rank.data.get_int('another_points')))
 
         # language setting
         language = Node.void('language_setting')
@@ -1294,6 +1420,10 @@ class IIDXBistrover(IIDXCourse, IIDXBase):
                 expert_point_achievement,
             )
 
+            # Keep the course's expert point leaderboard current
+            await expert_point_ranking.load(self.data, self.game, self.version)
+            expert_point_ranking.update(self.game, self.version, userid, courseid, expert_point_achievement)
+
         # Favorites saving
         for favorite in request.children:
             singles = []
@@ -1359,6 +1489,10 @@ class IIDXBistrover(IIDXCourse, IIDXBase):
                 }
             )
 
+            # Keep the network-wide standings current
+            await dj_rank_ranking.load(self.data, self.game, self.version)
+            dj_rank_ranking.update(self.game, self.version, userid, rankid, ValidatedDict({'rank': rank, 'point': point}))
+
         # note radar saving
         for notes_radar in request.children:
             if notes_radar.name != 'notes_radar':
@@ -1378,6 +1512,10 @@ class IIDXBistrover(IIDXCourse, IIDXBase):
                 }
             )
 
+            # Keep the network-wide radar statistics current
+            await notes_radar_ranking.load(self.data, self.game, self.version)
+            notes_radar_ranking.update(self.game, self.version, userid, rankid, ValidatedDict({'radar_score': score}))
+
         # Step-up mode
         step = request.child('step')
         if step is not None:
@@ -0,0 +1,412 @@
+# vim: set fileencoding=utf-8
+import argparse
+import asyncio
+import csv
+import json
+import sys
+import time
+import urllib.request
+import uuid
+
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, AsyncIterator, Dict, List, NamedTuple, Optional, Tuple
+
+from core.common import DBConstants, ValidatedDict, GameConstants
+from core.data import Data, UserID
+
+from .base import IIDXBase
+from .browser import score_browser
+from .events import ScoreImproved, event_bus
+from .locks import profile_locks
+from .playcount import IIDXPlayCounts
+
+
+# Mirrors the range checks IIDXBase.update_score applies to live plays
+VALID_CHARTS = frozenset([
+    IIDXBase.CHART_TYPE_B7,
+    IIDXBase.CHART_TYPE_N7,
+    IIDXBase.CHART_TYPE_H7,
+    IIDXBase.CHART_TYPE_A7,
+    IIDXBase.CHART_TYPE_L7,
+    IIDXBase.CHART_TYPE_B14,
+    IIDXBase.CHART_TYPE_N14,
+    IIDXBase.CHART_TYPE_H14,
+    IIDXBase.CHART_TYPE_A14,
+    IIDXBase.CHART_TYPE_L14,
+])
+VALID_CLEAR_STATUSES = frozenset([
+    IIDXBase.CLEAR_STATUS_NO_PLAY,
+    IIDXBase.CLEAR_STATUS_FAILED,
+    IIDXBase.CLEAR_STATUS_ASSIST_CLEAR,
+    IIDXBase.CLEAR_STATUS_EASY_CLEAR,
+    IIDXBase.CLEAR_STATUS_CLEAR,
+    IIDXBase.CLEAR_STATUS_HARD_CLEAR,
+    IIDXBase.CLEAR_STATUS_EX_HARD_CLEAR,
+    IIDXBase.CLEAR_STATUS_FULL_COMBO,
+])
+
+
+class ImportRow(NamedTuple):
+    extid: int
+    omnimix: bool
+    songid: int
+    chart: int
+    clear_status: int
+    pgreats: int
+    greats: int
+    miss_count: int
+    ghost: Optional[bytes]
+    timestamp: Optional[int]
+
+
+def parse_chunk(
+    fmt: str,
+    header: Optional[List[str]],
+    lines: List[str],
+    lineno: int,
+) -> Tuple[List[ImportRow], List[str]]:
+    """
+    Parse and validate a chunk of lines, returning the rows along with an
+    error for every line that was rejected. Lives at module level so chunks
+    can be handed to a process pool.
+    """
+    rows: List[ImportRow] = []
+    errors: List[str] = []
+
+    for offset, line in enumerate(lines):
+        if not line.strip():
+            continue
+        try:
+            if fmt == ScoreImport.FORMAT_CSV:
+                record = dict(zip(header, next(csv.reader([line]))))
+            else:
+                record = json.loads(line)
+
+            # Userids are local to the network that exported them, only extids carry over
+            if record.get('extid') in [None, '']:
+                raise Exception("Missing extid")
+            extid = int(record['extid'])
+            omnimix = record.get('omnimix') not in [None, '', 0, '0', False]
+
+            chart = int(record['chart'])
+            if chart not in VALID_CHARTS:
+                raise Exception(f"Invalid chart {chart}")
+            clear_status = int(record['clear_status'])
+            if clear_status not in VALID_CLEAR_STATUSES:
+                raise Exception(f"Invalid clear status value {clear_status}")
+            pgreats = int(record['pgreats'])
+            greats = int(record['greats'])
+            if pgreats < 0 or greats < 0:
+                raise Exception("Invalid judgement counts")
+            miss_count = int(record['miss_count']) if record.get('miss_count') not in [None, ''] else -1
+            if miss_count < -1:
+                raise Exception(f"Invalid miss count {miss_count}")
+
+            rows.append(ImportRow(
+                extid,
+                omnimix,
+                int(record['songid']),
+                chart,
+                clear_status,
+                pgreats,
+                greats,
+                miss_count,
+                bytes.fromhex(record['ghost']) if record.get('ghost') else None,
+                int(record['timestamp']) if record.get('timestamp') not in [None, ''] else None,
+            ))
+        except Exception as e:
+            errors.append(f"Line {lineno + offset}: {e}")
+
+    return rows, errors
+
+
+class ScoreImport:
+    """
+    Bulk import of IIDX high scores, for example when migrating players from
+    another network. Rows are matched to players by extid, which unlike the
+    userid means the same player on both networks, and rows without one are
+    rejected. Rows flagged omnimix go to the omnimix scores of the version,
+    which share their profiles with the plain version. Parsing runs in a
+    process pool for large files, rows are reduced per user, song and chart
+    before touching storage, and every player's existing bests are fetched
+    with one query. The same EX score and miss count rules as
+    IIDXBase.update_score decide what is kept, and the changed scores are
+    written in concurrent batches under the player's profile lock, with a
+    ScoreImproved event for every EX score that went up.
+    """
+
+    FORMAT_NDJSON = 'ndjson'
+    FORMAT_CSV = 'csv'
+
+    # Lines per parse job, and how many lines it takes to be worth a process pool
+    CHUNK_SIZE = 5000
+    POOL_THRESHOLD = 20000
+
+    # Writes in flight at once
+    BATCH_SIZE = 200
+
+    # Errors reported back, the rest are only counted
+    MAX_ERRORS = 100
+
+    def __init__(self, data: Data, version: int, fmt: str, attempts: bool = True) -> None:
+        if fmt not in [self.FORMAT_NDJSON, self.FORMAT_CSV]:
+            raise Exception(f"Invalid import format {fmt}")
+        self.data = data
+        self.game = GameConstants.IIDX
+        self.version = version
+        self.fmt = fmt
+        self.attempts = attempts
+
+    async def __parse(self, content: bytes) -> Tuple[List[ImportRow], List[str]]:
+        lines = content.decode('utf-8-sig').splitlines()
+        header = None
+        lineno = 1
+        if self.fmt == self.FORMAT_CSV and lines:
+            header = next(csv.reader(lines[:1]))
+            lines = lines[1:]
+            lineno = 2
+
+        jobs = [
+            (self.fmt, header, lines[i:(i + self.CHUNK_SIZE)], lineno + i)
+            for i in range(0, len(lines), self.CHUNK_SIZE)
+        ]
+        if len(lines) >= self.POOL_THRESHOLD:
+            loop = asyncio.get_running_loop()
+            with ProcessPoolExecutor() as pool:
+                results = await asyncio.gather(*[loop.run_in_executor(pool, parse_chunk, *job) for job in jobs])
+        else:
+            results = [parse_chunk(*job) for job in jobs]
+
+        rows: List[ImportRow] = []
+        errors: List[str] = []
+        for chunkrows, chunkerrors in results:
+            rows.extend(chunkrows)
+            errors.extend(chunkerrors)
+        return rows, errors
+
+    async def validate(self, content: bytes) -> Tuple[List[ImportRow], List[str]]:
+        """
+        Parse and validate a file without importing anything.
+        """
+        return await self.__parse(content)
+
+    def __merge(self, scoredata: ValidatedDict, points: int, row: ImportRow) -> Tuple[int, bool, bool]:
+        """
+        Merge a row into a best score in place, returning the new EX score,
+        whether anything changed and whether the EX score went up.
+        """
+        changed = False
+        raised = False
+        ex_score = (row.pgreats * 2) + row.greats
+
+        if row.clear_status > scoredata.get_int('clear_status'):
+            scoredata.replace_int('clear_status', row.clear_status)
+            changed = True
+        if ex_score > points:
+            scoredata.replace_int('pgreats', row.pgreats)
+            scoredata.replace_int('greats', row.greats)
+            if row.ghost is not None:
+                scoredata.replace_bytes('ghost', row.ghost)
+            points = ex_score
+            changed = True
+            raised = True
+
+        old_miss_count = scoredata.get_int('miss_count', -1)
+        if row.miss_count != -1 and (old_miss_count == -1 or old_miss_count > row.miss_count):
+            scoredata.replace_int('miss_count', row.miss_count)
+            changed = True
+
+        return points, changed, raised
+
+    async def __resolve(self, extids: List[int]) -> Dict[int, Optional[UserID]]:
+        userids: List[Optional[UserID]] = []
+        for i in range(0, len(extids), self.BATCH_SIZE):
+            userids.extend(await asyncio.gather(*[
+                self.data.local.user.from_extid(self.game, self.version, extid)
+                for extid in extids[i:(i + self.BATCH_SIZE)]
+            ]))
+        return dict(zip(extids, userids))
+
+    async def __import_user(self, userid: UserID, version: int, rows: List[ImportRow]) -> int:
+        async with profile_locks.hold(userid):
+            written = await self.__merge_user(userid, version, rows)
+
+        if self.attempts:
+            # Takes the profile lock itself
+            await IIDXPlayCounts(self.data, version).rebuild(userid)
+        return written
+
+    async def __merge_user(self, userid: UserID, version: int, rows: List[ImportRow]) -> int:
+        existing = {
+            (score.id, score.chart): score
+            for score in await self.data.local.music.get_scores(self.game, version, userid)
+        }
+
+        # Best score data, EX score, whether it changed and whether the EX score went up
+        bests: Dict[Tuple[int, int], Tuple[ValidatedDict, int, bool, bool]] = {}
+        for row in rows:
+            key = (row.songid, row.chart)
+            if key not in bests:
+                score = existing.get(key)
+                if score is not None:
+                    bests[key] = (score.data, score.points, False, False)
+                else:
+                    bests[key] = (ValidatedDict({'clear_status': IIDXBase.CLEAR_STATUS_NO_PLAY, 'miss_count': -1}), -1, True, True)
+            scoredata, points, changed, raised = bests[key]
+            points, rowchanged, rowraised = self.__merge(scoredata, points, row)
+            bests[key] = (scoredata, points, changed or rowchanged, raised or rowraised)
+
+        writes = [
+            self.data.local.music.put_score(self.game, version, userid, songid, chart, 0, points, scoredata, raised)
+            for (songid, chart), (scoredata, points, changed, raised) in bests.items()
+            if changed
+        ]
+        if self.attempts:
+            for row in rows:
+                history = ValidatedDict({
+                    'clear_status': row.clear_status,
+                    'miss_count': row.miss_count,
+                })
+                if row.ghost is not None:
+                    history['ghost'] = row.ghost
+                writes.append(self.data.local.music.put_attempt(
+                    self.game,
+                    version,
+                    userid,
+                    row.songid,
+                    row.chart,
+                    0,
+                    (row.pgreats * 2) + row.greats,
+                    history,
+                    False,
+                    timestamp=row.timestamp,
+                ))
+
+        for i in range(0, len(writes), self.BATCH_SIZE):
+            await asyncio.gather(*writes[i:(i + self.BATCH_SIZE)])
+        for (songid, chart), (scoredata, points, _, raised) in bests.items():
+            score_browser.invalidate(version, userid, songid, chart)
+            if raised:
+                old = existing.get((songid, chart))
+                event_bus.publish(ScoreImproved(
+                    self.game,
+                    version,
+                    userid,
+                    songid,
+                    chart,
+                    points,
+                    old.points if old is not None else 0,
+                    scoredata.get_int('clear_status'),
+                    0,
+                    None,
+                ))
+        return len(writes)
+
+    async def run(self, content: bytes) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Import the given file, yielding progress after parsing and after every
+        player, and a summary at the end.
+        """
+        start = time.monotonic()
+        rows, errors = await self.__parse(content)
+        yield {
+            'stage': 'parsed',
+            'rows': len(rows),
+            'rejected': len(errors),
+            'seconds': round(time.monotonic() - start, 3),
+        }
+
+        byuser: Dict[Tuple[int, bool], List[ImportRow]] = {}
+        for row in rows:
+            byuser.setdefault((row.extid, row.omnimix), []).append(row)
+        userids = await self.__resolve(list({extid for extid, _ in byuser}))
+
+        imported = 0
+        written = 0
+        for (extid, omnimix), userrows in byuser.items():
+            userid = userids[extid]
+            if userid is None:
+                errors.append(f"No profile for extid {extid}, skipped {len(userrows)} rows")
+                continue
+
+            # Handlers keep omnimix scores under the music version
+            version = DBConstants.OMNIMIX_VERSION_BUMP + self.version if omnimix else self.version
+            written += await self.__import_user(userid, version, userrows)
+            imported += len(userrows)
+            elapsed = time.monotonic() - start
+            yield {
+                'stage': 'importing',
+                'imported': imported,
+                'rows': len(rows),
+                'rows_per_second': round(imported / elapsed, 1) if elapsed > 0 else None,
+            }
+
+        elapsed = time.monotonic() - start
+        yield {
+            'stage': 'done',
+            'imported': imported,
+            'written': written,
+            'rejected': len(errors),
+            'errors': errors[:self.MAX_ERRORS],
+            'seconds': round(elapsed, 3),
+            'rows_per_second': round(imported / elapsed, 1) if elapsed > 0 else None,
+        }
+
+
+def main() -> None:
+    """
+    Upload a score file to a running server's webui import endpoint and print
+    its progress as it comes back, or only validate the file locally.
+    """
+    parser = argparse.ArgumentParser(description="Bulk import IIDX scores from an NDJSON or CSV file.")
+    parser.add_argument('file', help="Score file, in the same layout as the webui export.")
+    parser.add_argument('--version', type=int, required=True, help="Game version to import into.")
+    parser.add_argument('--format', choices=[ScoreImport.FORMAT_NDJSON, ScoreImport.FORMAT_CSV], default=ScoreImport.FORMAT_NDJSON)
+    parser.add_argument('--server', default='http://127.0.0.1:8000', help="Base URL of the server's webui.")
+    parser.add_argument('--no-attempts', action='store_true', help="Only merge bests, don't add score history.")
+    parser.add_argument('--check', action='store_true', help="Only validate the file, don't upload it.")
+    args = parser.parse_args()
+
+    with open(args.file, 'rb') as fp:
+        content = fp.read()
+
+    if args.check:
+        start = time.monotonic()
+        rows, errors = asyncio.run(ScoreImport(None, args.version, args.format).validate(content))
+        for error in errors:
+            print(error)
+        print(f"{len(rows)} valid rows, {len(errors)} rejected in {time.monotonic() - start:.2f}s")
+        sys.exit(1 if errors else 0)
+
+    boundary = uuid.uuid4().hex
+    fields = {
+        'version': str(args.version),
+        'format': args.format,
+        'attempts': '0' if args.no_attempts else '1',
+    }
+    body = b''.join(
+        f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode('utf-8')
+        for name, value in fields.items()
+    )
+    body += (
+        f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="scores.{args.format}"\r\n'
+        'Content-Type: application/octet-stream\r\n\r\n'
+    ).encode('utf-8') + content + f'\r\n--{boundary}--\r\n'.encode('utf-8')
+
+    request = urllib.request.Request(
+        f'{args.server.rstrip("/")}/plugin/iidx/import',
+        data=body,
+        headers={'Content-Type': f'multipart/form-data; boundary={boundary}'},
+        method='POST',
+    )
+    with urllib.request.urlopen(request) as response:
+        for line in response:
+            progress = json.loads(line)
+            if progress.get('stage') == 'done':
+                for error in progress.get('errors', []):
+                    print(error)
+            print(' '.join(f'{key}={value}' for key, value in progress.items() if key != 'errors'), flush=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,181 @@
+# vim: set fileencoding=utf-8
+import argparse
+import asyncio
+import random
+import os
+import sys
+import tempfile
+import time
+
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, IO, List, Optional
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+class ShardedLock:
+    """
+    A fixed pool of asyncio locks, hashed by key. Lets read-modify-write
+    sections for a single user serialize without blocking every other user
+    behind one global lock. Keeps simple contention counters so operators
+    can tell whether the pool is too small.
+    """
+
+    def __init__(self, shards: int = 64) -> None:
+        self.shards = shards
+        self.__locks: Optional[List[asyncio.Lock]] = None
+        self.acquisitions = 0
+        self.contended = 0
+        self.wait_time = 0.0
+
+    def __shard(self, key: int) -> asyncio.Lock:
+        if self.__locks is None:
+            # Created on first use, from inside the running loop, since before
+            # Python 3.10 a lock is tied to the loop current at construction.
+            self.__locks = [asyncio.Lock() for _ in range(self.shards)]
+        return self.__locks[hash(key) % self.shards]
+
+    @asynccontextmanager
+    async def hold(self, key: int) -> AsyncIterator[None]:
+        lock = self.__shard(key)
+        self.acquisitions = self.acquisitions + 1
+        if lock.locked():
+            self.contended = self.contended + 1
+            start = time.perf_counter()
+            await lock.acquire()
+            self.wait_time = self.wait_time + (time.perf_counter() - start)
+        else:
+            await lock.acquire()
+        try:
+            yield
+        finally:
+            lock.release()
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            'shards': self.shards,
+            'acquisitions': self.acquisitions,
+            'contended': self.contended,
+            'wait_time': self.wait_time,
+        }
+
+
+class HostLock:
+    """
+    Per-key locks shared by every process on the host, for read-modify-write
+    sections that game workers and the web UI both run against the same
+    profile. Keys are hashed onto a fixed pool of lock files. Inside a process
+    the matching shard of a ShardedLock is taken first, so only one task per
+    process ever waits on a lock file, and it polls instead of blocking the
+    event loop. Without fcntl only the process local lock is taken.
+    """
+
+    POLL_INTERVAL = 0.002
+
+    def __init__(self, name: str, shards: int = 64) -> None:
+        self.name = name
+        self.shards = shards
+        self.__local = ShardedLock(shards)
+        self.__files: Dict[int, IO[str]] = {}
+
+    def __file(self, shard: int) -> IO[str]:
+        lockfile = self.__files.get(shard)
+        if lockfile is None:
+            lockfile = open(os.path.join(tempfile.gettempdir(), f'iidx_{self.name}_{shard}.lock'), 'a')
+            self.__files[shard] = lockfile
+        return lockfile
+
+    @asynccontextmanager
+    async def hold(self, key: int) -> AsyncIterator[None]:
+        async with self.__local.hold(key):
+            if fcntl is None:
+                yield
+                return
+
+            lockfile = self.__file(hash(key) % self.shards)
+            while True:
+                try:
+                    fcntl.flock(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    await asyncio.sleep(self.POLL_INTERVAL)
+            try:
+                yield
+            finally:
+                fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+    def stats(self) -> Dict[str, float]:
+        return self.__local.stats()
+
+
+async def stress(users: int, writers: int, saves: int, latency: float, shards: int, locked: bool) -> Dict[str, float]:
+    """
+    Fire interleaved read-modify-write saves at a small pool of users, the
+    way concurrent pc_save, grade_raised and update_score requests do, and
+    count how many updates were lost. Every save reads a counter, waits as
+    if it were talking to the database and writes the counter back plus one.
+    """
+    locks = ShardedLock(shards)
+    profiles = {userid: 0 for userid in range(users)}
+
+    async def save(rng: random.Random, userid: int) -> None:
+        await asyncio.sleep(rng.random() * latency)
+        plays = profiles[userid]
+        await asyncio.sleep(rng.random() * latency)
+        profiles[userid] = plays + 1
+
+    async def writer(seed: int) -> None:
+        rng = random.Random(seed)
+        for _ in range(saves):
+            userid = rng.randrange(users)
+            if locked:
+                async with locks.hold(userid):
+                    await save(rng, userid)
+            else:
+                await save(rng, userid)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[writer(seed) for seed in range(writers)])
+    seconds = time.perf_counter() - start
+
+    expected = writers * saves
+    result = {
+        'saves': expected,
+        'lost': expected - sum(profiles.values()),
+        'seconds': seconds,
+        'saves_per_second': expected / seconds,
+    }
+    result.update(locks.stats())
+    return result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Check that sharded profile locks prevent lost updates.")
+    parser.add_argument('--users', type=int, default=200, help="Users the saves are spread over.")
+    parser.add_argument('--writers', type=int, default=20, help="Concurrent writers.")
+    parser.add_argument('--saves', type=int, default=50, help="Saves made by each writer.")
+    parser.add_argument('--latency', type=float, default=0.002, help="Longest simulated database call, in seconds.")
+    parser.add_argument('--shards', type=int, default=64, help="Locks in the pool.")
+    args = parser.parse_args()
+
+    unlocked = asyncio.run(stress(args.users, args.writers, args.saves, args.latency, args.shards, False))
+    locked = asyncio.run(stress(args.users, args.writers, args.saves, args.latency, args.shards, True))
+    print(f"unlocked: {unlocked['lost']} of {unlocked['saves']} updates lost, {unlocked['saves_per_second']:.0f} saves/s")
+    print(
+        f"locked: {locked['lost']} of {locked['saves']} updates lost, {locked['saves_per_second']:.0f} saves/s, "
+        f"{locked['contended']} of {locked['acquisitions']} acquisitions contended"
+    )
+    if locked['lost'] != 0:
+        sys.exit(1)
+
+
+profile_locks = ShardedLock()
+# Taken inside profile_locks by anything that writes a profile's web UI settings
+settings_locks = HostLock('settings')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,253 @@
+# vim: set fileencoding=utf-8
+import bisect
+import inspect
+import os
+import time
+
+from typing import Any, Awaitable, Dict, List, Optional, Sequence, Tuple
+
+from core.protocol import Node
+
+
+LATENCY_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0]
+DB_CALL_BUCKETS = [0, 1, 2, 5, 10, 20, 50, 100, 200]
+NODE_BUCKETS = [1, 10, 50, 100, 500, 1000, 5000, 10000, 50000]
+
+
+def format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ''
+    pairs = []
+    for name, value in labels.items():
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+
+def format_value(value: float) -> str:
+    if isinstance(value, int):
+        return str(value)
+    return repr(float(value))
+
+
+class Histogram:
+    """
+    Fixed bucket histogram, kept as plain counts so an observation is a
+    bisect and two additions.
+    """
+
+    def __init__(self, buckets: Sequence[float]) -> None:
+        self.buckets = list(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum = self.sum + value
+        self.count = self.count + 1
+
+    def lines(self, name: str, labels: Dict[str, str]) -> List[str]:
+        lines = []
+        cumulative = 0
+        for bucket, count in zip(self.buckets + ['+Inf'], self.counts):
+            cumulative = cumulative + count
+            le = bucket if isinstance(bucket, str) else format_value(bucket)
+            lines.append(f'{name}_bucket{format_labels(dict(labels, le=le))} {cumulative}')
+        lines.append(f'{name}_sum{format_labels(labels)} {format_value(self.sum)}')
+        lines.append(f'{name}_count{format_labels(labels)} {self.count}')
+        return lines
+
+
+class CallTally:
+    """
+    Calls made to data.local during a single request, by API and method.
+    """
+
+    def __init__(self) -> None:
+        self.calls: Dict[str, int] = {}
+        self.seconds: Dict[str, float] = {}
+
+    def record(self, method: str, seconds: float) -> None:
+        self.calls[method] = self.calls.get(method, 0) + 1
+        self.seconds[method] = self.seconds.get(method, 0.0) + seconds
+
+    async def timed(self, method: str, start: float, result: Awaitable[Any]) -> Any:
+        try:
+            return await result
+        finally:
+            self.record(method, time.perf_counter() - start)
+
+    def total(self) -> int:
+        return sum(self.calls.values())
+
+
+class InstrumentedAPI:
+    """
+    Stands in for one data.local API, such as data.local.music, and tallies
+    every method call made through it.
+    """
+
+    def __init__(self, api: Any, name: str, tally: CallTally) -> None:
+        self.__api = api
+        self.__name = name
+        self.__tally = tally
+
+    def __getattr__(self, attr: str) -> Any:
+        value = getattr(self.__api, attr)
+        if not callable(value):
+            return value
+
+        method = f'{self.__name}.{attr}'
+        tally = self.__tally
+
+        def call(*args: Any, **kwargs: Any) -> Any:
+            start = time.perf_counter()
+            result = value(*args, **kwargs)
+            if inspect.isawaitable(result):
+                return tally.timed(method, start, result)
+            tally.record(method, time.perf_counter() - start)
+            return result
+
+        return call
+
+
+class InstrumentedLocal:
+    def __init__(self, local: Any, tally: CallTally) -> None:
+        self.__local = local
+        self.__tally = tally
+        self.__apis: Dict[str, InstrumentedAPI] = {}
+
+    def __getattr__(self, attr: str) -> Any:
+        api = self.__apis.get(attr)
+        if api is None:
+            api = InstrumentedAPI(getattr(self.__local, attr), attr, self.__tally)
+            self.__apis[attr] = api
+        return api
+
+
+class InstrumentedData:
+    """
+    Wraps a request's Data so that calls through data.local are tallied.
+    Everything else is passed through untouched.
+    """
+
+    def __init__(self, data: Any, tally: CallTally) -> None:
+        self.__data = data
+        self.local = InstrumentedLocal(data.local, tally)
+
+    def __getattr__(self, attr: str) -> Any:
+        return getattr(self.__data, attr)
+
+
+class HandlerMetrics:
+    def __init__(self) -> None:
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.db_calls = Histogram(DB_CALL_BUCKETS)
+        self.nodes = Histogram(NODE_BUCKETS)
+        self.errors = 0
+        self.method_calls: Dict[str, int] = {}
+        self.method_seconds: Dict[str, float] = {}
+
+
+class Metrics:
+    """
+    Latency, data.local calls and response size for every game request
+    handled by this process. Off unless IIDX_METRICS is 1 or true, and while
+    off a request only pays for checking the flag. Numbers are kept per worker
+    process and are not shared over the event bridge, so the webui endpoint
+    only shows game requests when the webui is served by the same process as
+    the game. Scrape each worker on its own.
+    """
+
+    def __init__(self) -> None:
+        self.enabled = os.environ.get('IIDX_METRICS', '').strip().lower() in ['1', 'true']
+        self.__handlers: Dict[str, HandlerMetrics] = {}
+
+    @staticmethod
+    def count_nodes(node: Optional[Node]) -> int:
+        if node is None:
+            return 0
+        count = 0
+        stack = [node]
+        while stack:
+            current = stack.pop()
+            count = count + 1
+            stack.extend(current.children)
+        return count
+
+    def instrument(self, data: Any) -> Tuple[InstrumentedData, CallTally]:
+        tally = CallTally()
+        return InstrumentedData(data, tally), tally
+
+    def record(self, handler: str, seconds: float, tally: CallTally, response: Optional[Node], failed: bool) -> None:
+        metrics = self.__handlers.get(handler)
+        if metrics is None:
+            metrics = HandlerMetrics()
+            self.__handlers[handler] = metrics
+
+        metrics.latency.observe(seconds)
+        metrics.db_calls.observe(tally.total())
+        if failed:
+            metrics.errors = metrics.errors + 1
+        else:
+            metrics.nodes.observe(self.count_nodes(response))
+        for method, calls in tally.calls.items():
+            metrics.method_calls[method] = metrics.method_calls.get(method, 0) + calls
+            metrics.method_seconds[method] = metrics.method_seconds.get(method, 0.0) + tally.seconds[method]
+
+    def render(self, stats: Sequence[Tuple[str, Dict[str, str], Dict[str, Any]]] = ()) -> str:
+        """
+        Return everything recorded so far in the Prometheus text format,
+        followed by the given stats() dictionaries of caches, locks and the
+        like. Only their numeric values are exported.
+        """
+        handlers = sorted(self.__handlers.items())
+        lines = [f'iidx_metrics_enabled {int(self.enabled)}']
+
+        def family(name: str, kind: str, help: str) -> None:
+            lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} {kind}')
+
+        if handlers:
+            family('iidx_handler_latency_seconds', 'histogram', 'Time spent handling a game request.')
+            for handler, metrics in handlers:
+                lines.extend(metrics.latency.lines('iidx_handler_latency_seconds', {'handler': handler}))
+
+            family('iidx_handler_db_calls', 'histogram', 'Calls to data.local made by a single game request.')
+            for handler, metrics in handlers:
+                lines.extend(metrics.db_calls.lines('iidx_handler_db_calls', {'handler': handler}))
+
+            family('iidx_handler_response_nodes', 'histogram', 'Nodes in the response to a game request.')
+            for handler, metrics in handlers:
+                lines.extend(metrics.nodes.lines('iidx_handler_response_nodes', {'handler': handler}))
+
+            family('iidx_handler_errors_total', 'counter', 'Game requests that raised.')
+            for handler, metrics in handlers:
+                lines.append(f'iidx_handler_errors_total{format_labels({"handler": handler})} {metrics.errors}')
+
+            family('iidx_db_calls_total', 'counter', 'Calls to data.local, by handler and method.')
+            for handler, metrics in handlers:
+                for method, calls in sorted(metrics.method_calls.items()):
+                    lines.append(f'iidx_db_calls_total{format_labels({"handler": handler, "method": method})} {calls}')
+
+            family('iidx_db_call_seconds_total', 'counter', 'Time spent in data.local, by handler and method.')
+            for handler, metrics in handlers:
+                for method, seconds in sorted(metrics.method_seconds.items()):
+                    labels = format_labels({"handler": handler, "method": method})
+                    lines.append(f'iidx_db_call_seconds_total{labels} {format_value(seconds)}')
+
+        # Samples of one metric have to be listed together
+        samples: Dict[str, List[str]] = {}
+        for name, labels, values in stats:
+            for key, value in values.items():
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    continue
+                samples.setdefault(f'{name}_{key}', []).append(f'{name}_{key}{format_labels(labels)} {format_value(value)}')
+        for name in samples:
+            lines.extend(samples[name])
+
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
@@ -0,0 +1,195 @@
+# vim: set fileencoding=utf-8
+import argparse
+import json
+import urllib.parse
+import urllib.request
+
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+
+from core.common import DBConstants, GameConstants
+from core.data import Data, UserID
+
+from .locks import profile_locks
+
+
+class IIDXPlayCounts:
+    """
+    Per-user play count index. Every attempt a user records bumps a per-song
+    counter, and all of a user's counters live in a single achievement. The
+    user's most played songs are kept in a second, small achievement and
+    updated along with the counters, so keeping the index current costs a
+    couple of reads and writes per play, and most played lookups read at most
+    MOST_PLAYED_LENGTH entries no matter how long the user's history is.
+    """
+
+    PLAY_COUNTS_TYPE = 'play_counts'
+    PLAY_COUNTS_ID = 0
+    MOST_PLAYED_TYPE = 'most_played'
+    MOST_PLAYED_ID = 0
+    MOST_PLAYED_LENGTH = 20
+
+    def __init__(self, data: Data, version: int, game: str = GameConstants.IIDX) -> None:
+        self.data = data
+        self.game = game
+        self.version = version
+
+    @staticmethod
+    def __rank(play: Tuple[int, int]) -> Tuple[int, int]:
+        # Most plays first, lower song IDs first on ties
+        return (-play[1], play[0])
+
+    def __top(self, counts: Dict[int, int]) -> List[Tuple[int, int]]:
+        return sorted(counts.items(), key=self.__rank)[:self.MOST_PLAYED_LENGTH]
+
+    def __bump(self, top: List[Tuple[int, int]], songid: int, plays: int) -> bool:
+        """
+        Given the most played list and a song whose count just went up by one,
+        update the list in place and return whether it changed. Every other
+        count stayed the same, so the song can only move up or enter at the end.
+        """
+        top[:] = [play for play in top if play[0] != songid]
+        if len(top) == self.MOST_PLAYED_LENGTH and self.__rank((songid, plays)) > self.__rank(top[-1]):
+            return False
+        top.append((songid, plays))
+        top.sort(key=self.__rank)
+        del top[self.MOST_PLAYED_LENGTH:]
+        return True
+
+    async def __get_counts(self, userid: UserID) -> Optional[Dict[int, int]]:
+        play_counts = await self.data.local.user.get_achievement(
+            self.game,
+            self.version,
+            userid,
+            self.PLAY_COUNTS_ID,
+            self.PLAY_COUNTS_TYPE,
+        )
+        if play_counts is None:
+            return None
+        return dict(zip(play_counts.get('songs', []), play_counts.get('plays', [])))
+
+    async def __get_top(self, userid: UserID) -> Optional[List[Tuple[int, int]]]:
+        most_played = await self.data.local.user.get_achievement(
+            self.game,
+            self.version,
+            userid,
+            self.MOST_PLAYED_ID,
+            self.MOST_PLAYED_TYPE,
+        )
+        if most_played is None:
+            return None
+        return list(zip(most_played.get('songs', []), most_played.get('plays', [])))
+
+    async def __put_counts(self, userid: UserID, counts: Dict[int, int]) -> None:
+        await self.data.local.user.put_achievement(
+            self.game,
+            self.version,
+            userid,
+            self.PLAY_COUNTS_ID,
+            self.PLAY_COUNTS_TYPE,
+            {
+                'songs': list(counts.keys()),
+                'plays': list(counts.values()),
+            },
+        )
+
+    async def __put_top(self, userid: UserID, top: List[Tuple[int, int]]) -> None:
+        await self.data.local.user.put_achievement(
+            self.game,
+            self.version,
+            userid,
+            self.MOST_PLAYED_ID,
+            self.MOST_PLAYED_TYPE,
+            {
+                'songs': [songid for songid, _ in top],
+                'plays': [plays for _, plays in top],
+            },
+        )
+
+    async def record_play(self, userid: UserID, songid: int) -> None:
+        """
+        Given a user and a song they just recorded an attempt on, bump the play
+        count for that song. Expects the attempt itself to already be saved.
+        """
+        async with profile_locks.hold(userid):
+            counts = await self.__get_counts(userid)
+            top = await self.__get_top(userid)
+            if counts is None or top is None:
+                # Index was never built for this user, build it from history which
+                # already includes this attempt.
+                await self.__rebuild(userid)
+                return
+
+            counts[songid] = counts.get(songid, 0) + 1
+            await self.__put_counts(userid, counts)
+            if self.__bump(top, songid, counts[songid]):
+                await self.__put_top(userid, top)
+
+    async def get_most_played(self, userid: UserID, count: int = MOST_PLAYED_LENGTH) -> List[Tuple[int, int]]:
+        """
+        Return up to count (songid, plays) tuples for a user, most played first.
+        Only the first MOST_PLAYED_LENGTH songs are indexed.
+        """
+        top = await self.__get_top(userid)
+        if top is None:
+            async with profile_locks.hold(userid):
+                top = self.__top(await self.__rebuild(userid))
+        return top[:count]
+
+    async def rebuild(self, userid: UserID) -> Dict[int, int]:
+        """
+        Rebuild the play count index for a single user from their attempt history.
+        """
+        async with profile_locks.hold(userid):
+            return await self.__rebuild(userid)
+
+    async def rebuild_all(self) -> int:
+        """
+        Backfill the play count index for every player of this version from
+        existing attempts, one player at a time so only a single player's
+        history is held in memory. Returns the number of users that were rebuilt.
+        """
+        # Omnimix scores are kept apart, but share their profiles with the plain version
+        version = self.version
+        if version >= DBConstants.OMNIMIX_VERSION_BUMP:
+            version = version - DBConstants.OMNIMIX_VERSION_BUMP
+
+        users = 0
+        for userid, _ in await self.data.local.user.get_all_profiles(self.game, version):
+            await self.rebuild(userid)
+            users = users + 1
+        return users
+
+    async def __rebuild(self, userid: UserID) -> Dict[int, int]:
+        attempts = await self.data.local.music.get_all_attempts(self.game, self.version, userid=userid)
+        counts = dict(Counter(attempt.id for _, attempt in attempts))
+        await self.__put_counts(userid, counts)
+        await self.__put_top(userid, self.__top(counts))
+        return counts
+
+
+def main() -> None:
+    """
+    Ask a running server's webui to backfill the play count index of a
+    version from existing attempts, omnimix included.
+    """
+    parser = argparse.ArgumentParser(description="Rebuild the IIDX most played index from attempt history.")
+    parser.add_argument('--version', type=int, required=True, help="Game version to rebuild.")
+    parser.add_argument('--server', default='http://127.0.0.1:8000', help="Base URL of the server's webui.")
+    args = parser.parse_args()
+
+    request = urllib.request.Request(
+        f'{args.server.rstrip("/")}/plugin/iidx/rebuildplaycounts',
+        data=urllib.parse.urlencode({'version': str(args.version)}).encode('utf-8'),
+        method='POST',
+    )
+    with urllib.request.urlopen(request) as response:
+        result = json.loads(response.read())
+    if not result.get('success'):
+        print(result.get('error_msg'))
+        raise SystemExit(1)
+    print(f"rebuilt {result['data']['users']} users")
+
+
+if __name__ == '__main__':
+    main()
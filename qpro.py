@@ -0,0 +1,186 @@
+# vim: set fileencoding=utf-8
+import asyncio
+import hashlib
+import io
+import os
+
+from typing import Any, Dict, List, Optional, Tuple
+
+from .assets import AssetPipeline
+from .cache import LRUCache
+from .catalog import Catalog
+
+
+# Pillow's Image module once imported, False if it isn't installed
+Image: Any = None
+
+
+def get_image() -> Any:
+    """
+    Import Pillow the first time a preview is asked for, so processes that
+    never render one, like game workers importing the webui, never load it.
+    Returns None when it isn't installed.
+    """
+    global Image
+    if Image is None:
+        try:
+            from PIL import Image as PILImage  # type: ignore
+            Image = PILImage
+        except ImportError:
+            Image = False
+    return Image or None
+
+
+class QProRenderer:
+    """
+    Composites the dumped QPro part images into a single preview image, so the
+    webui loads one image per preview instead of one per part. Renders are
+    stored on disk under a name derived from the source images' fingerprints,
+    and the most recent ones are also kept in memory under that name.
+    Needs Pillow, when it isn't installed available() returns False.
+    """
+
+    PARTS = ['head', 'hair', 'face', 'hand', 'body']
+
+    FORMATS = {
+        'png': ('PNG', 'image/png'),
+        'webp': ('WEBP', 'image/webp'),
+    }
+
+    # Canvas size of the preview, matching the .qpro box in qpro.css
+    WIDTH = 170
+    HEIGHT = 200
+
+    # Left, top, width and height of each layer as a percentage of the canvas,
+    # matching the layer classes in qpro.css
+    BOXES = {
+        'hair': (12.94, 5.0, 77.06, 88.0),
+        'head': (14.71, 5.0, 77.06, 88.0),
+        'face': (29.41, 15.0, 44.17, 39.5),
+        'body': (14.71, 5.0, 76.47, 88.0),
+        'arm_r': (12.35, 44.5, 38.82, 48.5),
+        'arm_l': (50.0, 44.5, 41.76, 48.5),
+        'leg_r': (26.47, 61.25, 30.0, 33.0),
+        'leg_l': (42.65, 61.25, 30.0, 33.0),
+        'hand_r': (1.47, 0.0, 62.35, 88.0),
+        'hand_l': (44.12, 0.0, 47.65, 88.0),
+    }
+
+    # Layers back to front, as (part, image name, box)
+    LAYERS = [
+        ('head', 'qp_head_b', 'head'),
+        ('hair', 'qp_hair_b', 'hair'),
+        ('body', 'qp_leg_l_lower', 'leg_l'),
+        ('body', 'qp_leg_l_upper', 'leg_l'),
+        ('body', 'qp_arm_r_lower', 'arm_r'),
+        ('body', 'qp_arm_r_upper', 'arm_r'),
+        ('hand', 'qp_hand_r', 'hand_r'),
+        ('body', 'qp_leg_r_lower', 'leg_r'),
+        ('body', 'qp_leg_r_upper', 'leg_r'),
+        ('body', 'qp_body_b', 'body'),
+        ('body', 'qp_body_f', 'body'),
+        ('face', 'qp_face_neutral', 'face'),
+        ('hair', 'qp_hair_f', 'hair'),
+        ('head', 'qp_head_f', 'head'),
+        ('body', 'qp_arm_l_lower', 'arm_l'),
+        ('body', 'qp_arm_l_upper', 'arm_l'),
+        ('hand', 'qp_hand_l', 'hand_l'),
+    ]
+
+    def __init__(self, assets: AssetPipeline, catalog: Catalog, cachedir: str, scale: int = 2) -> None:
+        self.assets = assets
+        self.catalog = catalog
+        self.cachedir = cachedir
+        self.scale = scale
+        self.__renders: LRUCache[bytes] = LRUCache(256)
+
+    def available(self) -> bool:
+        return get_image() is not None
+
+    def __ifs(self, part: str, index: int) -> Optional[str]:
+        entry = self.catalog.get(part, index)
+        if entry is None:
+            return None
+        return entry['ifs'].replace('.ifs', '')
+
+    def __layers(self, selection: Dict[str, int]) -> Optional[List[Tuple[str, str]]]:
+        layers: List[Tuple[str, str]] = []
+        for part, image, box in self.LAYERS:
+            ifs = self.__ifs(part, selection[part])
+            if ifs is None:
+                return None
+            layers.append((f'images/{ifs}/{image}.png', box))
+        return layers
+
+    def images(self, part: str, index: int) -> Dict[str, str]:
+        """
+        Return the fingerprinted URL of every image making up one part, by
+        image name, for browsers that have to layer the parts themselves.
+        """
+        ifs = self.__ifs(part, index)
+        if ifs is None:
+            return {}
+        return {
+            image: self.assets.url(f'images/{ifs}/{image}.png')
+            for layerpart, image, _ in self.LAYERS
+            if layerpart == part
+        }
+
+    def __composite(self, layers: List[Tuple[str, str]], fmt: str) -> bytes:
+        width = self.WIDTH * self.scale
+        height = self.HEIGHT * self.scale
+        image = get_image()
+        canvas = image.new('RGBA', (width, height), (0, 0, 0, 0))
+        for name, box in layers:
+            asset = self.assets.get(name)
+            if asset is None:
+                # Not every costume has every layer
+                continue
+            left, top, boxwidth, boxheight = self.BOXES[box]
+            with image.open(asset.path) as part:
+                part = part.convert('RGBA').resize((
+                    max(1, round(width * boxwidth / 100)),
+                    max(1, round(height * boxheight / 100)),
+                ))
+                canvas.alpha_composite(part, (round(width * left / 100), round(height * top / 100)))
+
+        out = io.BytesIO()
+        canvas.save(out, format=self.FORMATS[fmt][0])
+        return out.getvalue()
+
+    async def render(self, selection: Dict[str, int], fmt: str = 'png') -> Optional[Tuple[str, bytes]]:
+        """
+        Given a part index for each of the five QPro parts, return the digest
+        and content of the composited preview, or None if a part is unknown.
+        """
+        layers = self.__layers(selection)
+        if layers is None:
+            return None
+
+        # Name the render after the content of everything that went into it, so
+        # a part image changing on disk is never served from an older render
+        digest = hashlib.sha256(fmt.encode('utf-8'))
+        digest.update(str(self.scale).encode('utf-8'))
+        for name, box in layers:
+            asset = self.assets.get(name)
+            digest.update(f'{name}:{asset.etag if asset is not None else "-"}:{box};'.encode('utf-8'))
+        etag = digest.hexdigest()[:32]
+
+        content = self.__renders.get(etag)
+        if content is not None:
+            return etag, content
+
+        path = os.path.join(self.cachedir, f'{etag}.{fmt}')
+        if os.path.isfile(path):
+            with open(path, 'rb') as fp:
+                content = fp.read()
+        else:
+            content = await asyncio.get_running_loop().run_in_executor(None, self.__composite, layers, fmt)
+            os.makedirs(self.cachedir, exist_ok=True)
+            tmppath = f'{path}.{os.getpid()}.tmp'
+            with open(tmppath, 'wb') as fp:
+                fp.write(content)
+            os.replace(tmppath, path)
+
+        self.__renders.put(etag, content)
+        return etag, content
@@ -0,0 +1,64 @@
+# vim: set fileencoding=utf-8
+from typing import Dict, List, Optional, Tuple
+
+from core.common import ValidatedDict
+from core.data import UserID
+
+from .ranking import AchievementRanking, SortedIndex
+
+
+class NotesRadarRanking(AchievementRanking):
+    """
+    Network-wide notes radar statistics. Keeps a sorted array of scores for
+    every style and radar axis, so where a player sits on each axis is a
+    binary search rather than a pass over every saved profile.
+    """
+
+    ACHIEVEMENT_TYPE = 'notes_radar'
+
+    AXES = [
+        'notes',
+        'chord',
+        'peak',
+        'charge',
+        'scratch',
+        'soflan',
+    ]
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.__boards: Dict[Tuple[str, int, int, int], SortedIndex[UserID]] = {}
+
+    def __board(self, game: str, version: int, style: int, axis: int) -> SortedIndex[UserID]:
+        return self.__boards.setdefault((game, version, style, axis), SortedIndex())
+
+    def update(self, game: str, version: int, userid: UserID, achievementid: int, achievement: ValidatedDict) -> None:
+        scores = achievement.get_int_array('radar_score', len(self.AXES))
+        for axis in range(len(self.AXES)):
+            self.__board(game, version, achievementid, axis).update(userid, scores[axis])
+
+    def reset(self, game: str, version: int) -> None:
+        for key in [key for key in self.__boards if key[:2] == (game, version)]:
+            del self.__boards[key]
+
+    def percentiles(self, game: str, version: int, style: int, userid: UserID) -> Optional[List[Dict[str, float]]]:
+        """
+        Return, for every axis, the player's score and the percentage of
+        players scoring below them. Returns None if the player has no radar.
+        """
+        percentiles: List[Dict[str, float]] = []
+        for axis, name in enumerate(self.AXES):
+            board = self.__board(game, version, style, axis)
+            score = board.get(userid)
+            if score is None:
+                return None
+            below = len(board) - board.count_at_least(score)
+            percentiles.append({
+                'axis': name,
+                'score': score,
+                'percentile': round(100.0 * below / len(board), 2),
+            })
+        return percentiles
+
+
+notes_radar_ranking = NotesRadarRanking()
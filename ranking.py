@@ -0,0 +1,296 @@
+# vim: set fileencoding=utf-8
+import argparse
+import asyncio
+import random
+import time
+
+from typing import Any, Dict, Generic, Hashable, List, Optional, Tuple, TypeVar
+
+from core.common import ValidatedDict
+from core.data import Data, UserID
+
+
+K = TypeVar('K', bound=Hashable)
+
+
+class IndexNode:
+    __slots__ = ['item', 'priority', 'left', 'right', 'size']
+
+    def __init__(self, item: Tuple[int, Any], priority: float) -> None:
+        self.item = item
+        self.priority = priority
+        self.left: Optional['IndexNode'] = None
+        self.right: Optional['IndexNode'] = None
+        self.size = 1
+
+
+def node_size(node: Optional[IndexNode]) -> int:
+    return node.size if node is not None else 0
+
+
+class SortedIndex(Generic[K]):
+    """
+    Keeps one value per key (usually a user ID) alongside an order statistic
+    tree of all (value, key) pairs, so that updating an entry, finding a rank,
+    a tier cutoff or a page of the leaderboard are all O(log n). The tree is a
+    treap, each node counts the entries below it. Higher values rank first,
+    ties share the same rank.
+    """
+
+    def __init__(self) -> None:
+        self.__values: Dict[K, int] = {}
+        self.__root: Optional[IndexNode] = None
+        self.__random = random.Random()
+
+    def __len__(self) -> int:
+        return len(self.__values)
+
+    def __contains__(self, key: K) -> bool:
+        return key in self.__values
+
+    def __split(self, node: Optional[IndexNode], item: Tuple[int, Any], inclusive: bool) -> Tuple[Optional[IndexNode], Optional[IndexNode]]:
+        """
+        Split a subtree into the items before the given one, and the rest. The
+        given item goes to the first half when inclusive is set.
+        """
+        if node is None:
+            return None, None
+        if node.item < item or (inclusive and node.item == item):
+            node.right, right = self.__split(node.right, item, inclusive)
+            node.size = 1 + node_size(node.left) + node_size(node.right)
+            return node, right
+        left, node.left = self.__split(node.left, item, inclusive)
+        node.size = 1 + node_size(node.left) + node_size(node.right)
+        return left, node
+
+    def __merge(self, left: Optional[IndexNode], right: Optional[IndexNode]) -> Optional[IndexNode]:
+        if left is None:
+            return right
+        if right is None:
+            return left
+        if left.priority > right.priority:
+            left.right = self.__merge(left.right, right)
+            left.size = 1 + node_size(left.left) + node_size(left.right)
+            return left
+        right.left = self.__merge(left, right.left)
+        right.size = 1 + node_size(right.left) + node_size(right.right)
+        return right
+
+    def __select(self, index: int) -> Tuple[int, Any]:
+        """
+        Return the (value, key) pair at a 0-based position, lowest value first.
+        """
+        node = self.__root
+        while node is not None:
+            left = node_size(node.left)
+            if index < left:
+                node = node.left
+            elif index == left:
+                return node.item
+            else:
+                index = index - (left + 1)
+                node = node.right
+        raise Exception(f'Index {index} is out of range!')
+
+    def __count_below(self, value: int, inclusive: bool) -> int:
+        """
+        Return how many entries hold less than the given value, or no more
+        than it when inclusive is set.
+        """
+        count = 0
+        node = self.__root
+        while node is not None:
+            if node.item[0] < value or (inclusive and node.item[0] == value):
+                count = count + node_size(node.left) + 1
+                node = node.right
+            else:
+                node = node.left
+        return count
+
+    def get(self, key: K) -> Optional[int]:
+        return self.__values.get(key)
+
+    def update(self, key: K, value: int) -> None:
+        if key in self.__values:
+            self.remove(key)
+        self.__values[key] = value
+        item = (value, key)
+        left, right = self.__split(self.__root, item, False)
+        self.__root = self.__merge(self.__merge(left, IndexNode(item, self.__random.random())), right)
+
+    def remove(self, key: K) -> None:
+        value = self.__values.pop(key, None)
+        if value is None:
+            return
+        left, right = self.__split(self.__root, (value, key), False)
+        _, right = self.__split(right, (value, key), True)
+        self.__root = self.__merge(left, right)
+
+    def rank_of_value(self, value: int) -> int:
+        """
+        Return the 1-based rank that the given value would have.
+        """
+        return len(self.__values) - self.__count_below(value, True) + 1
+
+    def rank(self, key: K) -> Optional[int]:
+        value = self.__values.get(key)
+        if value is None:
+            return None
+        return self.rank_of_value(value)
+
+    def value_at_rank(self, rank: int) -> Optional[int]:
+        """
+        Return the value held by whoever sits at the given 1-based rank.
+        """
+        if rank < 1 or rank > len(self.__values):
+            return None
+        return self.__select(len(self.__values) - rank)[0]
+
+    def count_at_least(self, value: int) -> int:
+        return len(self.__values) - self.__count_below(value, False)
+
+    def top(self, count: int, offset: int = 0) -> List[Tuple[K, int]]:
+        """
+        Return a page of (key, value) tuples, best first.
+        """
+        end = len(self.__values) - offset
+        start = max(0, end - count)
+        page = []
+        for index in range(end - 1, start - 1, -1):
+            value, key = self.__select(index)
+            page.append((key, value))
+        return page
+
+    def clear(self) -> None:
+        self.__values.clear()
+        self.__root = None
+
+
+class AchievementRanking:
+    """
+    Base for rankings built from a single achievement type. Every achievement
+    of that type is loaded per game version in the background on first use,
+    so the request that asks first is never held up waiting for it, and
+    loaded again every REFRESH_INTERVAL seconds to pick up saves made by
+    other processes. Saves in this process are applied straight away by
+    calling update().
+    """
+
+    ACHIEVEMENT_TYPE = ''
+    REFRESH_INTERVAL = 300.0
+
+    def __init__(self) -> None:
+        self.__loaded: Dict[Tuple[str, int], float] = {}
+        self.__loading: Dict[Tuple[str, int], asyncio.Task] = {}
+
+    async def load(self, data: Data, game: str, version: int, wait: bool = False) -> None:
+        """
+        Make sure the ranking for a game version is loaded and fresh. Unless
+        wait is set this only starts loading and returns right away, so a
+        ranking that was never loaded stays empty until the load finishes.
+        With wait set, a ranking that was never loaded is waited for.
+        """
+        key = (game, version)
+        loaded = self.__loaded.get(key)
+        if loaded is not None and (time.monotonic() - loaded) < self.REFRESH_INTERVAL:
+            return
+
+        task = self.__loading.get(key)
+        if task is None:
+            task = asyncio.get_running_loop().create_task(self.__load(data, game, version))
+            self.__loading[key] = task
+        if wait and loaded is None:
+            await asyncio.shield(task)
+
+    async def __load(self, data: Data, game: str, version: int) -> None:
+        key = (game, version)
+        try:
+            achievements = await data.local.user.get_all_achievements(
+                game,
+                version,
+                achievementtype=self.ACHIEVEMENT_TYPE,
+            )
+        except Exception:
+            # Tried again on next use
+            return
+        finally:
+            del self.__loading[key]
+
+        # Swapped in without yielding, so nobody sees a half built ranking
+        self.reset(game, version)
+        for userid, achievement in achievements:
+            self.update(game, version, userid, achievement.id, achievement.data)
+        self.__loaded[key] = time.monotonic()
+
+    async def rebuild(self, data: Data, game: str, version: int) -> None:
+        """
+        Throw away what we have for a game version and load it again.
+        """
+        task = self.__loading.get((game, version))
+        if task is not None:
+            await asyncio.shield(task)
+        self.__loaded.pop((game, version), None)
+        await self.load(data, game, version, wait=True)
+
+    def update(self, game: str, version: int, userid: UserID, achievementid: int, achievement: ValidatedDict) -> None:
+        raise Exception('Implement in specific ranking class!')
+
+    def reset(self, game: str, version: int) -> None:
+        raise Exception('Implement in specific ranking class!')
+
+
+def bench(users: int, courses: int, plays: int, seed: int = 0) -> Dict[str, float]:
+    """
+    Replay course entry traffic against in-memory course leaderboards, the
+    way a busy ranking event does. Every play raises the player's EX score
+    on a random course chart if it beat their best, then asks for their rank
+    and the board size, just as the course entry response does. Reports
+    throughput and per play latency percentiles.
+    """
+    rng = random.Random(seed)
+    boards: List[SortedIndex[int]] = [SortedIndex() for _ in range(courses)]
+    latencies: List[float] = []
+
+    start = time.perf_counter()
+    for _ in range(plays):
+        board = boards[rng.randrange(courses)]
+        userid = rng.randrange(users)
+        ex_score = rng.randrange(4000)
+
+        begin = time.perf_counter()
+        old_ex_score = board.get(userid)
+        if old_ex_score is None or old_ex_score < ex_score:
+            board.update(userid, ex_score)
+        board.rank(userid)
+        len(board)
+        latencies.append(time.perf_counter() - begin)
+    seconds = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        'plays': plays,
+        'seconds': seconds,
+        'plays_per_second': plays / seconds,
+        'p50': latencies[len(latencies) // 2],
+        'p99': latencies[min(len(latencies) - 1, (len(latencies) * 99) // 100)],
+        'entries': sum(len(board) for board in boards),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark course leaderboard updates and rank lookups.")
+    parser.add_argument('--users', type=int, default=50000, help="Players entering courses.")
+    parser.add_argument('--courses', type=int, default=20, help="Course charts being played.")
+    parser.add_argument('--plays', type=int, default=200000, help="Course entries to replay.")
+    args = parser.parse_args()
+
+    result = bench(args.users, args.courses, args.plays)
+    print(
+        f"{result['plays']} plays over {result['entries']:.0f} leaderboard entries, "
+        f"{result['plays_per_second']:.0f} plays/s, "
+        f"p50 {result['p50'] * 1000000:.1f}us, p99 {result['p99'] * 1000000:.1f}us"
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,47 @@
 import os
 import json
+import hashlib
+import copy
 
 from core import root_exe
+from core.common import DBConstants
 from core.data import Data
 from fastapi import Request
-from fastapi.responses import JSONResponse
-from fastapi.templating import Jinja2Templates
-
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+
+from .assets import AssetPipeline
+from .browser import ScoreBrowser, score_browser
+from .cache import arcade_settings, ghost_averages, machines, profile_directory, retry_responses
+from .catalog import Catalog
+from .convention import convention_ranking
+from .events import ProfileSaved, event_bus
+from .expert import expert_point_ranking
+from .export import ScoreExport
 from .factory import MANAGED_VERSION
-
-templates = Jinja2Templates(os.path.join(root_exe, "plugins", "iidx", "templates"))
+from .feed import live_feed
+from .importer import ScoreImport
+from .locks import profile_locks, settings_locks
+from .metrics import metrics
+from .playcount import IIDXPlayCounts
+from .qpro import QProRenderer
+from .radar import notes_radar_ranking
+
+templates = None
+assets = AssetPipeline(os.path.join(root_exe, "plugins", "iidx", "static"))
+catalogs = {
+    "theme": Catalog(os.path.join(root_exe, "plugins", "iidx", "static", "themeData.json")),
+    "qpro": Catalog(os.path.join(root_exe, "plugins", "iidx", "static", "qproData.json")),
+}
+qproRenderer = QProRenderer(assets, catalogs["qpro"], os.path.join(root_exe, "plugins", "iidx", "cache", "qpro"))
+
+CARDS_PAGE_SIZE = 100
+CARDS_PAGE_SIZE_MAX = 1000
+CARDS_CHUNK_SIZE = 50
+CATALOG_PAGE_SIZE_MAX = 1000
+SCORES_PAGE_SIZE = 100
+SCORES_PAGE_SIZE_MAX = 1000
+RANKING_PAGE_SIZE = 20
+RANKING_PAGE_SIZE_MAX = 1000
 
 themeTypeList = [
     "frame",
@@ -25,15 +57,116 @@ themeTypeList = [
     "pacemaker"
 ]
 
+qproPartList = [
+    "head",
+    "hair",
+    "face",
+    "hand",
+    "body",
+]
+
+patchableSettings = set(themeTypeList) | {f"qpro.{part}" for part in qproPartList}
+
+SETTINGS_VERSION = 'settings_version'
+
 
 def menu_handler(add_menu):
     add_menu("theme", "User Theme")
     add_menu("qpro", "Change QPro")
+    add_menu("live", "Live Plays")
 
 
 def static_handler(add_static):
     add_static(os.path.join(root_exe, "plugins", "iidx", "static"))
 
+    # Assets are fingerprinted and templates compiled on first use, unless
+    # this process is known to serve the webui and asks for it up front
+    if os.environ.get('IIDX_PREWARM_WEBUI', '').strip().lower() in ['1', 'true']:
+        prewarm()
+
+
+def get_templates():
+    """
+    Create the template loader on first use, so processes that only serve
+    game traffic never import Jinja2.
+    """
+    global templates
+    if templates is None:
+        from fastapi.templating import Jinja2Templates
+        templates = Jinja2Templates(os.path.join(root_exe, "plugins", "iidx", "templates"))
+    return templates
+
+
+def prewarm():
+    """
+    Compile every template and fingerprint every asset ahead of the first request.
+    """
+    env = get_templates().env
+    for name in env.list_templates():
+        env.get_template(name)
+    assets.build()
+
+
+async def patch_profile_settings(data: Data, version: int, userid: int, patch: dict, settingsVersion=None) -> dict:
+    """
+    Apply a field level patch to a profile's settings. Keys are either a
+    settings field like "frame" or a qpro part like "qpro.head". When a
+    settings version is given and someone saved settings since it was read,
+    nothing is written and the current values of the patched fields are
+    returned as a conflict instead. The version is checked and bumped under
+    a lock that game workers in other processes take too when they save the
+    profile, and they keep whatever settings were saved here.
+    """
+    if not isinstance(patch, dict):
+        return {'success': 0, 'error_msg': "Wrong input value."}
+    for field, value in patch.items():
+        if field not in patchableSettings or not isinstance(value, int):
+            return {'success': 0, 'error_msg': f"Cannot set {field}."}
+        if field.startswith('qpro.'):
+            valid = catalogs["qpro"].valid(field[5:], value)
+        else:
+            valid = catalogs["theme"].valid(field, value)
+        if not valid:
+            return {'success': 0, 'error_msg': f"Unknown {field} {value}."}
+
+    async with profile_locks.hold(userid), settings_locks.hold(userid):
+        profile = await data.local.user.get_profile('iidx', version, userid)
+        if profile is None:
+            return {'success': 0, 'error_msg': "No profile for this user."}
+
+        settings = profile.get('settings') or {}
+        currentVersion = profile.get(SETTINGS_VERSION, 0)
+        if settingsVersion is not None and settingsVersion != currentVersion:
+            conflict = {}
+            for field in patch:
+                if field.startswith('qpro.'):
+                    conflict[field] = (settings.get('qpro') or {}).get(field[5:], 0)
+                else:
+                    conflict[field] = settings.get(field, 0)
+            return {
+                'success': 0,
+                'error_msg': "Settings were changed elsewhere.",
+                'settings_version': currentVersion,
+                'conflict': conflict,
+            }
+
+        oldSettings = copy.deepcopy(settings)
+        for field, value in patch.items():
+            if field.startswith('qpro.'):
+                settings.setdefault('qpro', {})[field[5:]] = value
+            else:
+                settings[field] = value
+        if settings == oldSettings:
+            # Nothing changed, so whoever holds this version is still current
+            return {'success': 1, 'error_msg': '', 'settings_version': currentVersion}
+        profile['settings'] = settings
+        profile[SETTINGS_VERSION] = currentVersion + 1
+
+        await data.local.user.put_profile('iidx', version, userid, profile)
+    event_bus.publish(ProfileSaved('iidx', version, userid, profile.get('name', ''), profile.get_int('extid')))
+
+    return {'success': 1, 'error_msg': '', 'settings_version': currentVersion + 1}
+
 
 async def handle_iidx_getversions_post(request: Request, data: Data):
     resData = []
@@ -46,32 +179,280 @@ async def handle_iidx_getversions_post(request: Request, data: Data):
 
 
 async def handle_iidx_getcards_post(request: Request, data: Data):
+    # The directory is kept current by profile saves in the game workers
+    event_bus.start()
     formData = await request.form()
 
     try:
         version = int(formData['version'])
+        cursor = int(formData['cursor']) if formData.get('cursor') else None
+        count = min(int(formData.get('count', CARDS_PAGE_SIZE)), CARDS_PAGE_SIZE_MAX)
+        prefix = formData.get('prefix') or None
     except:
         res = {'success': 0, 'error_msg': "Wrong input value."}
-        return JSONResponse(content=json.dumps(res))
+        return JSONResponse(content=res)
+    if count < 1:
+        res = {'success': 0, 'error_msg': "Wrong input value."}
+        return JSONResponse(content=res)
 
-    cardsList = await data.local.user.get_all_cards()
+    page, next_cursor = await profile_directory.page(data, 'iidx', version, cursor, count, prefix)
 
-    resData = []
-    for card in cardsList:
-        userid = card[1]
-        profile = await data.local.user.get_profile('iidx', version, userid)
+    async def stream():
+        yield '{"success": 1, "error_msg": "", "data": ['
+        for i in range(0, len(page), CARDS_CHUNK_SIZE):
+            chunk = [
+                {"userid": userid, "name": name, "extid": extid}
+                for userid, name, extid in page[i:(i + CARDS_CHUNK_SIZE)]
+            ]
+            yield (',' if i > 0 else '') + json.dumps(chunk)[1:-1]
+        yield '], "next": ' + json.dumps(next_cursor) + '}'
 
-        resData.append({
-            "userid": userid,
-            "name": profile['name']
-        })
+    return StreamingResponse(stream(), media_type='application/json')
+
+
+async def handle_iidx_catalog_get(request: Request, data: Data):
+    await assets.ready()
+    try:
+        catalog = catalogs[request.query_params.get('name', '')]
+        catalogtype = request.query_params.get('type') or None
+        search = request.query_params.get('search') or None
+        offset = max(int(request.query_params.get('offset', 0)), 0)
+        count = min(int(request.query_params.get('count', CATALOG_PAGE_SIZE_MAX)), CATALOG_PAGE_SIZE_MAX)
+        if count < 1:
+            raise ValueError(count)
+    except (KeyError, ValueError):
+        res = {'success': 0, 'error_msg': "Wrong input value."}
+        return JSONResponse(content=res)
+
+    resData = {}
+    for name in ([catalogtype] if catalogtype is not None else catalog.types()):
+        resData[name] = [
+            dict(entry, id=catalogid)
+            for catalogid, entry in catalog.slice(name, offset, count, search)
+        ]
+        if catalog is catalogs["qpro"]:
+            # Part images are handed out fingerprinted, so they can be cached forever
+            for entry in resData[name]:
+                entry['images'] = qproRenderer.images(name, entry['id'])
+
+    # The catalog only changes when its file or one of the part images does
+    headers = {
+        'ETag': (
+            f'"{catalog.version}-{assets.generation}-'
+            f'{hashlib.sha1(str(request.query_params).encode("utf-8")).hexdigest()[:16]}"'
+        ),
+        'Cache-Control': 'public, no-cache',
+    }
+    if request.headers.get('if-none-match') == headers['ETag']:
+        return Response(status_code=304, headers=headers)
 
     res = {'success': 1, 'error_msg': '', 'data': resData}
+    return JSONResponse(content=res, headers=headers)
+
+
+async def handle_iidx_export_get(request: Request, data: Data):
+    params = request.query_params
+
+    def optionalInt(name):
+        return int(params[name]) if params.get(name) else None
+
+    try:
+        version = int(params['version'])
+        if version not in MANAGED_VERSION:
+            raise ValueError(version)
+        export = ScoreExport(
+            version,
+            params.get('kind', ScoreExport.KIND_SCORES),
+            params.get('format', ScoreExport.FORMAT_NDJSON),
+            userid=optionalInt('userid'),
+            songid=optionalInt('songid'),
+            chart=optionalInt('chart'),
+            since=optionalInt('since'),
+            until=optionalInt('until'),
+            ghost=params.get('ghost') == 'hex',
+        )
+    except Exception:
+        res = {'success': 0, 'error_msg': "Wrong input value."}
+        return JSONResponse(content=res)
+
+    filename = f'iidx-{version}-{export.kind}.{export.fmt}'
+    return StreamingResponse(
+        export.stream(data),
+        media_type=export.media_type,
+        headers={'Content-Disposition': f'attachment; filename="{filename}"'},
+    )
+
+
+async def handle_iidx_import_post(request: Request, data: Data):
+    formData = await request.form()
+
+    try:
+        version = int(formData['version'])
+        if version not in MANAGED_VERSION:
+            raise ValueError(version)
+        scoreImport = ScoreImport(
+            data,
+            version,
+            formData.get('format', ScoreImport.FORMAT_NDJSON),
+            attempts=formData.get('attempts', '1') != '0',
+        )
+        content = await formData['file'].read()
+    except Exception:
+        res = {'success': 0, 'error_msg': "Wrong input value."}
+        return JSONResponse(content=res)
+
+    async def stream():
+        # One progress line per player, ending with the summary
+        async for progress in scoreImport.run(content):
+            yield json.dumps(progress, ensure_ascii=False) + '\n'
+
+    return StreamingResponse(stream(), media_type='application/x-ndjson')
+
+
+async def handle_iidx_scores_get(request: Request, data: Data):
+    # Views are dropped when a game worker saves a better score
+    event_bus.start()
+    params = request.query_params
+
+    def optionalInt(name):
+        return int(params[name]) if params.get(name) else None
+
+    try:
+        view = params.get('view', 'user')
+        version = int(params['version'])
+        cursor = ScoreBrowser.decode_cursor(params.get('cursor'))
+        count = min(int(params.get('count', SCORES_PAGE_SIZE)), SCORES_PAGE_SIZE_MAX)
+        if count < 1:
+            raise ValueError(count)
+        if view == 'user':
+            columns = ScoreBrowser.USER_COLUMNS
+            rows, next_cursor = await score_browser.user(
+                data,
+                version,
+                int(params['userid']),
+                cursor,
+                count,
+                lamp=optionalInt('lamp'),
+                level=optionalInt('level'),
+            )
+        elif view == 'chart':
+            columns = ScoreBrowser.CHART_COLUMNS
+            rows, next_cursor = await score_browser.chart(
+                data,
+                version,
+                int(params['songid']),
+                int(params['chart']),
+                cursor,
+                count,
+            )
+        else:
+            raise ValueError(view)
+    except (KeyError, ValueError):
+        res = {'success': 0, 'error_msg': "Wrong input value."}
+        return JSONResponse(content=res)
+
+    res = {
+        'success': 1,
+        'error_msg': '',
+        'columns': columns,
+        'data': rows,
+        'next': ScoreBrowser.encode_cursor(next_cursor),
+    }
     return JSONResponse(content=res)
 
 
+async def handle_iidx_live_get(request: Request, data: Data):
+    await assets.ready()
+    # Join the bridge before the page opens its feed, plays come from the game workers
+    event_bus.start()
+    return get_templates().TemplateResponse("live.html", {"request": request, "asset": assets.url})
+
+
+async def handle_iidx_livefeed_get(request: Request, data: Data):
+    try:
+        arcade = int(request.query_params['arcade']) if request.query_params.get('arcade') else None
+        version = int(request.query_params['version']) if request.query_params.get('version') else None
+    except ValueError:
+        res = {'success': 0, 'error_msg': "Wrong input value."}
+        return JSONResponse(content=res)
+
+    return StreamingResponse(
+        live_feed.stream(data, arcade, version),
+        media_type='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+    )
+
+
+async def handle_iidx_metrics_get(request: Request, data: Data):
+    bus = event_bus.stats()
+    stats = [
+        ('iidx_cache', {'cache': 'machines'}, machines.stats()),
+        ('iidx_cache', {'cache': 'arcade_settings'}, arcade_settings.stats()),
+        ('iidx_cache', {'cache': 'retry_responses'}, retry_responses.stats()),
+        ('iidx_cache', {'cache': 'ghost_averages'}, ghost_averages.stats()),
+        ('iidx_profile_locks', {}, profile_locks.stats()),
+        ('iidx_event_bus', {}, {'published': bus['published']}),
+        ('iidx_live_feed', {}, live_feed.stats()),
+    ]
+    return Response(content=metrics.render(stats), media_type='text/plain; version=0.0.4')
+
+
+async def handle_iidx_asset_get(request: Request, data: Data):
+    await assets.ready()
+    asset = assets.get(request.query_params.get('name', ''))
+    if asset is None:
+        return Response(status_code=404)
+
+    headers = {
+        'ETag': f'"{asset.etag}"',
+        'Vary': 'Accept-Encoding',
+    }
+    if request.query_params.get('v') == asset.etag:
+        # Fingerprinted URLs change whenever the content does
+        headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    else:
+        headers['Cache-Control'] = 'public, no-cache'
+
+    if request.headers.get('if-none-match') in [headers['ETag'], f'W/{headers["ETag"]}']:
+        return Response(status_code=304, headers=headers)
+
+    encoding, content = assets.read(asset, request.headers.get('accept-encoding', ''))
+    if encoding != 'identity':
+        headers['Content-Encoding'] = encoding
+    return Response(content=content, media_type=asset.media_type, headers=headers)
+
+
+async def handle_iidx_qprorender_get(request: Request, data: Data):
+    await assets.ready()
+    if not qproRenderer.available():
+        # Pillow isn't installed, the page falls back to layering the parts itself
+        return Response(status_code=501)
+
+    fmt = request.query_params.get('format', 'png')
+    try:
+        selection = {part: int(request.query_params[part]) for part in qproPartList}
+    except (KeyError, ValueError):
+        return Response(status_code=400)
+    if fmt not in QProRenderer.FORMATS:
+        return Response(status_code=400)
+
+    render = await qproRenderer.render(selection, fmt)
+    if render is None:
+        return Response(status_code=404)
+
+    etag, content = render
+    headers = {
+        'ETag': f'"{etag}"',
+        'Cache-Control': 'public, no-cache',
+    }
+    if request.headers.get('if-none-match') in [headers['ETag'], f'W/{headers["ETag"]}']:
+        return Response(status_code=304, headers=headers)
+    return Response(content=content, media_type=QProRenderer.FORMATS[fmt][1], headers=headers)
+
+
 async def handle_iidx_theme_get(request: Request, data: Data):
-    return templates.TemplateResponse("theme.html", {"request": request})
+    await assets.ready()
+    return get_templates().TemplateResponse("theme.html", {"request": request, "asset": assets.url})
 
 
 async def handle_iidx_theme_post(request: Request, data: Data):
@@ -82,6 +463,7 @@ async def handle_iidx_theme_post(request: Request, data: Data):
     try:
         userid = int(formData['userid'])
         version = int(formData['version'])
+        settingsVersion = int(formData['settings_version']) if formData.get('settings_version') else None
 
         for themeType in themeTypeList:
             themeInputMap[themeType] = int(formData[themeType])
@@ -89,17 +471,7 @@ async def handle_iidx_theme_post(request: Request, data: Data):
         res = {'success': 0, 'error_msg': "Wrong input value."}
         return JSONResponse(content=json.dumps(res))
 
-    profile = await data.local.user.get_profile('iidx', version, userid)
-
-    if 'settings' not in profile:
-        profile['settings'] = {}
-
-    for themeType in themeTypeList:
-        profile['settings'][themeType] = themeInputMap[themeType]
-
-    await data.local.user.put_profile('iidx', version, userid, profile)
-
-    res = {'success': 1, 'error_msg': ''}
+    res = await patch_profile_settings(data, version, userid, themeInputMap, settingsVersion)
     return JSONResponse(content=res)
 
 
@@ -125,12 +497,13 @@ async def handle_iidx_gettheme_post(request: Request, data: Data):
         else:
             resData[themeType] = 0
 
-    res = {'success': 1, 'error_msg': '', 'data': resData}
+    res = {'success': 1, 'error_msg': '', 'data': resData, 'settings_version': profile.get(SETTINGS_VERSION, 0)}
     return JSONResponse(content=res)
 
 
 async def handle_iidx_qpro_get(request: Request, data: Data):
-    return templates.TemplateResponse("qpro.html", {"request": request})
+    await assets.ready()
+    return get_templates().TemplateResponse("qpro.html", {"request": request, "asset": assets.url})
 
 
 async def handle_iidx_qpro_post(request: Request, data: Data):
@@ -139,32 +512,16 @@ async def handle_iidx_qpro_post(request: Request, data: Data):
     try:
         userid = int(formData['userid'])
         version = int(formData['version'])
-        head = int(formData['head'])
-        hair = int(formData['hair'])
-        face = int(formData['face'])
-        hand = int(formData['hand'])
-        body = int(formData['body'])
+        settingsVersion = int(formData['settings_version']) if formData.get('settings_version') else None
+        qproInputMap = {
+            f"qpro.{part}": int(formData[part])
+            for part in qproPartList
+        }
     except ValueError:
         res = {'success': 0, 'error_msg': "Wrong Form Value."}
         return JSONResponse(content=res)
 
-    profile = await data.local.user.get_profile('iidx', version, userid)
-
-    if 'settings' not in profile:
-        profile['settings'] = {}
-
-    if 'qpro' not in profile['settings']:
-        profile['settings']['qpro'] = {}
-
-    profile['settings']['qpro']['head'] = head
-    profile['settings']['qpro']['hair'] = hair
-    profile['settings']['qpro']['face'] = face
-    profile['settings']['qpro']['hand'] = hand
-    profile['settings']['qpro']['body'] = body
-
-    await data.local.user.put_profile('iidx', version, userid, profile)
-
-    res = {'success': 1, 'error_msg': ''}
+    res = await patch_profile_settings(data, version, userid, qproInputMap, settingsVersion)
     return JSONResponse(content=res)
 
 
@@ -197,5 +554,190 @@ async def handle_iidx_getqpro_post(request: Request, data: Data):
             "hand": 0,
             "body": 0,
         }
+    res = {'success': 1, 'error_msg': '', 'data': resData, 'settings_version': profile.get(SETTINGS_VERSION, 0)}
+    return JSONResponse(content=res)
+
+
+async def handle_iidx_rebuildplaycounts_post(request: Request, data: Data):
+    formData = await request.form()
+
+    try:
+        version = int(formData['version'])
+    except:
+        res = {'success': 0, 'error_msg': "Wrong input value."}
+        return JSONResponse(content=res)
+
+    # Handlers count plays under the music version, so omnimix cabinets have their own index
+    users = await IIDXPlayCounts(data, version).rebuild_all()
+    await IIDXPlayCounts(data, DBConstants.OMNIMIX_VERSION_BUMP + version).rebuild_all()
+
+    res = {'success': 1, 'error_msg': '', 'data': {'users': users}}
+    return JSONResponse(content=res)
+
+
+async def handle_iidx_convention_post(request: Request, data: Data):
+    # Leaderboards and names are kept current by plays and profile saves in the game workers
+    event_bus.start()
+    formData = await request.form()
+
+    try:
+        arcade = int(formData['arcade'])
+        version = int(formData['version'])
+        chart = int(formData['chart'])
+        omnimix = bool(int(formData.get('omnimix', 0)))
+        count = min(int(formData.get('count', RANKING_PAGE_SIZE)), RANKING_PAGE_SIZE_MAX)
+        offset = max(int(formData.get('offset', 0)), 0)
+    except:
+        res = {'success': 0, 'error_msg': "Wrong input value."}
+        return JSONResponse(content=res)
+    if count < 1:
+        res = {'success': 0, 'error_msg': "Wrong input value."}
+        return JSONResponse(content=res)
+
+    # Handlers keep conventions under the music version, which differs for omnimix cabinets
+    music_version = DBConstants.OMNIMIX_VERSION_BUMP + version if omnimix else version
+
+    music, leaderboard = await convention_ranking.leaderboard(data, 'iidx', music_version, arcade, chart)
+    if leaderboard is None:
+        res = {'success': 0, 'error_msg': "No convention running for this arcade."}
+        return JSONResponse(content=res)
+
+    page = leaderboard.top(count, offset)
+    names = await profile_directory.names(data, 'iidx', version, [userid for userid, _ in page])
+
+    resData = []
+    for userid, total in page:
+        resData.append({
+            "userid": userid,
+            "name": names.get(userid, ''),
+            "rank": leaderboard.rank_of_value(total),
+            "score": total,
+        })
+
+    res = {
+        'success': 1,
+        'error_msg': '',
+        'data': {
+            "music": music,
+            "total": len(leaderboard),
+            "ranking": resData,
+        },
+    }
+    return JSONResponse(content=res)
+
+
+async def handle_iidx_notesradar_post(request: Request, data: Data):
+    formData = await request.form()
+
+    try:
+        userid = int(formData['userid'])
+        version = int(formData['version'])
+    except:
+        res = {'success': 0, 'error_msg': "Wrong input value."}
+        return JSONResponse(content=res)
+
+    await notes_radar_ranking.load(data, 'iidx', version, wait=True)
+
+    resData = {}
+    for style, name in [(0, 'single'), (1, 'double')]:
+        resData[name] = notes_radar_ranking.percentiles('iidx', version, style, userid)
+
+    res = {'success': 1, 'error_msg': '', 'data': resData}
+    return JSONResponse(content=res)
+
+
+async def handle_iidx_rebuildnotesradar_post(request: Request, data: Data):
+    formData = await request.form()
+
+    try:
+        version = int(formData['version'])
+    except:
+        res = {'success': 0, 'error_msg': "Wrong input value."}
+        return JSONResponse(content=res)
+
+    await notes_radar_ranking.rebuild(data, 'iidx', version)
+
+    res = {'success': 1, 'error_msg': ''}
+    return JSONResponse(content=res)
+
+
+async def handle_iidx_expertpoint_post(request: Request, data: Data):
+    # Names are kept current by profile saves in the game workers
+    event_bus.start()
+    formData = await request.form()
+
+    try:
+        courseid = int(formData['courseid'])
+        version = int(formData['version'])
+        count = min(int(formData.get('count', RANKING_PAGE_SIZE)), RANKING_PAGE_SIZE_MAX)
+        offset = max(int(formData.get('offset', 0)), 0)
+    except:
+        res = {'success': 0, 'error_msg': "Wrong input value."}
+        return JSONResponse(content=res)
+    if count < 1:
+        res = {'success': 0, 'error_msg': "Wrong input value."}
+        return JSONResponse(content=res)
+
+    await expert_point_ranking.load(data, 'iidx', version, wait=True)
+    leaderboard = expert_point_ranking.leaderboard('iidx', version, courseid)
+
+    page = leaderboard.top(count, offset)
+    names = await profile_directory.names(data, 'iidx', version, [userid for userid, _ in page])
+
+    resData = []
+    for userid, points in page:
+        resData.append({
+            "userid": userid,
+            "name": names.get(userid, ''),
+            "rank": leaderboard.rank_of_value(points),
+            "points": points,
+        })
+
+    res = {'success': 1, 'error_msg': '', 'data': {"total": len(leaderboard), "ranking": resData}}
+    return JSONResponse(content=res)
+
+
+async def handle_iidx_patchsettings_post(request: Request, data: Data):
+    formData = await request.form()
+
+    try:
+        userid = int(formData['userid'])
+        version = int(formData['version'])
+        settingsVersion = int(formData['settings_version']) if formData.get('settings_version') else None
+        patch = json.loads(formData['patch'])
+        if not isinstance(patch, dict):
+            raise ValueError()
+    except:
+        res = {'success': 0, 'error_msg': "Wrong input value."}
+        return JSONResponse(content=res)
+
+    res = await patch_profile_settings(data, version, userid, patch, settingsVersion)
+    return JSONResponse(content=res)
+
+
+async def handle_iidx_patchsettingsbatch_post(request: Request, data: Data):
+    try:
+        body = await request.json()
+        version = int(body['version'])
+        updates = [
+            (
+                int(update['userid']),
+                update['patch'],
+                int(update['settings_version']) if update.get('settings_version') is not None else None,
+            )
+            for update in body['updates']
+        ]
+        if not all(isinstance(patch, dict) for _, patch, _ in updates):
+            raise ValueError()
+    except:
+        res = {'success': 0, 'error_msg': "Wrong input value."}
+        return JSONResponse(content=res)
+
+    resData = []
+    for userid, patch, settingsVersion in updates:
+        result = await patch_profile_settings(data, version, userid, patch, settingsVersion)
+        result['userid'] = userid
+        resData.append(result)
+
     res = {'success': 1, 'error_msg': '', 'data': resData}
     return JSONResponse(content=res)